@@ -35,6 +35,10 @@ import getpass
 import StringIO
 import htmllib
 import formatter
+try: # hashlib is available since Python 2.5
+    from hashlib import md5 as _md5
+except ImportError: # fall back to md5 on older Python versions
+    from md5 import new as _md5
 if sys.platform != "win32":
     import fcntl
     
@@ -445,6 +449,75 @@ def open_temporary_file(mode = "w+b", suffix = ""):
     return (file_name, os.fdopen(fd, mode))
 
 
+def md5(string = ""):
+    """Return a new MD5 hash object.
+
+    'string' -- The initial input to the hash.
+
+    returns -- An object with the 'update', 'digest' and 'hexdigest'
+    methods of the objects created by 'hashlib.md5'."""
+
+    return _md5(string)
+
+
+def make_directories(path):
+    """Create a directory, and its parents, if they do not exist.
+
+    'path' -- The path to the directory.
+
+    Unlike 'os.makedirs', this function does not fail if another
+    process creates the directory at the same time."""
+
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+
+
+def write_file_atomically(path, write):
+    """Replace the contents of a file, all at once.
+
+    'path' -- The path to the file.  The directory containing it is
+    created, if necessary.
+
+    'write' -- A callable, which is passed a file object open for
+    writing in binary mode, and writes the new contents to it.
+
+    The contents are written to a temporary file in the same directory,
+    which is then renamed to 'path', so that other processes reading
+    'path' see either the old contents or the new ones, but never a
+    partial file.  If the contents cannot be written, the temporary
+    file is removed and the exception is raised again."""
+
+    directory = os.path.dirname(os.path.abspath(path))
+    make_directories(directory)
+    fd, temporary = tempfile.mkstemp(dir = directory)
+    try:
+        f = os.fdopen(fd, "wb")
+        try:
+            write(f)
+        finally:
+            f.close()
+        try:
+            os.rename(temporary, path)
+        except OSError:
+            # On Windows, 'rename' does not replace existing files.
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            os.rename(temporary, path)
+    except:
+        exc_info = sys.exc_info()
+        try:
+            os.remove(temporary)
+        except OSError:
+            pass
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+
 def close_file_on_exec(fd):
     """Prevent 'fd' from being inherited across 'exec'.
     
@@ -591,7 +664,9 @@ def parse_time_iso(time_string):
     returns -- The time as a float, like that returned by
     'time.time'."""
 
-    return time.mktime(time.strptime(time_string, "%Y-%m-%dT%H:%M:%SZ"))
+    # The time is in UTC, so 'time.mktime', which assumes local time,
+    # cannot be used.
+    return float(timegm(time.strptime(time_string, "%Y-%m-%dT%H:%M:%SZ")))
 
 
 def make_unique_tag():
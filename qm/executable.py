@@ -5,7 +5,7 @@
 # Date:   11/14/2002
 #
 # Contents:
-#   Executable, RedirectedExecutable
+#   Executable, RedirectedExecutable, ResourceUsage
 #
 # Copyright (c) 2002, 2003 by CodeSourcery, LLC.  All rights reserved. 
 #
@@ -20,6 +20,7 @@ import qm.common
 import signal
 import string
 import sys
+import threading
 import time
 
 # The classes in this module are implemented differently depending on
@@ -44,6 +45,45 @@ else:
 # Classes
 #######################################################################
 
+class ResourceUsage(object):
+    """A 'ResourceUsage' accumulates resources consumed by child processes.
+
+    Under UNIX, every child process reaped by an 'Executable' reports
+    the resources it (and any of its own children that it waited for)
+    consumed.  While resource accounting is active in a thread (see
+    'start_resource_accounting'), those figures are added to the
+    'ResourceUsage' for that thread.
+
+    CPU times are measured in seconds.  The maximum resident set size
+    is measured in kilobytes and is the maximum over all children, not
+    the sum.  Block I/O is measured in the number of blocks read and
+    written by the file system."""
+
+    def __init__(self):
+
+        self.children = 0
+        self.user_time = 0.0
+        self.system_time = 0.0
+        self.max_rss = 0
+        self.blocks_in = 0
+        self.blocks_out = 0
+
+
+    def Add(self, rusage):
+        """Add the resources described by 'rusage'.
+
+        'rusage' -- A 'resource.struct_rusage', as returned by
+        'os.wait4', describing a child process that has terminated."""
+
+        self.children += 1
+        self.user_time += rusage.ru_utime
+        self.system_time += rusage.ru_stime
+        self.max_rss = max(self.max_rss, rusage.ru_maxrss)
+        self.blocks_in += rusage.ru_inblock
+        self.blocks_out += rusage.ru_oublock
+
+
+
 class Executable(object):
     """An 'Executable' is a program that the operating system can run.
 
@@ -278,7 +318,7 @@ class Executable(object):
             # Get its exit code.
             return win32process.GetExitCodeProcess(child)
         else:
-            status = os.waitpid(child, 0)[1]
+            status = wait_for_child(child)
             self.__child = None
 
             # See if an exception was pushed back up the pipe.
@@ -1010,12 +1050,76 @@ class Filter(RedirectedExecutable):
                                                  : self.__next + 64 * 1024])
 
 
+########################################################################
+# Functions
+#######################################################################
+
+def start_resource_accounting():
+    """Begin accumulating the resources used by children of this thread.
+
+    returns -- A new 'ResourceUsage'.  Every child process subsequently
+    reaped by an 'Executable' in the calling thread will be added to
+    it, until 'stop_resource_accounting' is called.
+
+    Accounting is per thread so that tests run concurrently by a
+    'ThreadTarget' are charged only for their own children."""
+
+    usage = ResourceUsage()
+    _resource_accounting.usage = usage
+    return usage
+
+
+def stop_resource_accounting():
+    """Stop accumulating resources for the calling thread.
+
+    returns -- The 'ResourceUsage' that was active in this thread, or
+    'None' if accounting was not active."""
+
+    usage = getattr(_resource_accounting, "usage", None)
+    _resource_accounting.usage = None
+    return usage
+
+
+def wait_for_child(pid):
+    """Wait for the child process 'pid' to terminate.
+
+    'pid' -- The process ID of a child process.
+
+    returns -- The exit status of the child, as returned by 'waitpid'.
+
+    If resource accounting is active in the calling thread, the
+    resources consumed by the child are recorded.  This function is
+    not used under Windows."""
+
+    assert sys.platform != "win32"
+
+    # 'os.wait4' is not available on all platforms, or in older
+    # versions of Python.
+    if not hasattr(os, "wait4"):
+        return os.waitpid(pid, 0)[1]
+
+    status, rusage = os.wait4(pid, 0)[1:]
+    usage = getattr(_resource_accounting, "usage", None)
+    if usage is not None:
+        usage.Add(rusage)
+    return status
+
 ########################################################################
 # Variables
 #######################################################################
 
+_resource_accounting = threading.local()
+"""Per-thread resource accounting state.
+
+The 'usage' attribute, if present and not 'None', is the
+'ResourceUsage' to which reaped children should be charged."""
+
 __all__ = ["Executable",
            "TimeoutExecutable",
            "RedirectedExecutable",
-           "Filter"]
+           "Filter",
+           "ResourceUsage",
+           "start_resource_accounting",
+           "stop_resource_accounting",
+           "wait_for_child"]
        
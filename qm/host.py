@@ -15,9 +15,29 @@
 # Imports
 #######################################################################
 
+import cPickle
+import filecmp
+import qm.common
+from   qm.common import md5
 from   qm.executable import RedirectedExecutable
 from   qm.extension import Extension
+from   qm.fields import IntegerField, TextField
+import os
 import os.path
+import shutil
+import tempfile
+import threading
+import time
+
+########################################################################
+# Variables
+#######################################################################
+
+_upload_caches = {}
+"""The '_UploadCache' for each upload cache file, indexed by path."""
+
+_upload_caches_lock = threading.Lock()
+"""The lock that protects '_upload_caches'."""
 
 ########################################################################
 # Classes
@@ -38,6 +58,26 @@ class Host(Extension):
     on many hosts."""
 
     kind = "host"
+
+    upload_cache = TextField(
+        description = """The file in which to record uploaded files.
+
+        If not empty, the name of a file on the local machine in which
+        to record the files uploaded to this host.  A file whose
+        contents match those of the copy already uploaded to the same
+        place on this host, in this test run or an earlier one, is not
+        uploaded again.  Programs uploaded by 'UploadAndRun' are left
+        on the remote host.  Several hosts may use the same file."""
+        )
+
+    upload_cache_interval = IntegerField(
+        default_value = 3600,
+        description = """The number of seconds between checks of uploaded files.
+
+        A file recorded in the 'upload_cache' is checked against the
+        copy on the remote host if it has not been checked within
+        this many seconds."""
+        )
     
     class Executable(RedirectedExecutable):
         """An 'Executable' is a simple redirected executable.
@@ -118,7 +158,11 @@ class Host(Extension):
         basename of the 'local_file'.
 
         If the 'local_file' and 'remote_file' are the same, then this
-        function succeeds, but takes no action."""
+        function succeeds, but takes no action.
+
+        Derived classes that copy files to another machine should use
+        '_GetStaleUploads' and '_RecordUploads' so that files recorded
+        in the 'upload_cache' are not copied again."""
 
         raise NotImplementedError
 
@@ -140,6 +184,50 @@ class Host(Extension):
         raise NotImplementedError
 
 
+    def UploadFiles(self, local_files, remote_dir = None):
+        """Copy each of the 'local_files' to the remote machine.
+
+        'local_files' -- A sequence of names of files on the local
+        machine.
+
+        'remote_dir' -- The directory on the remote machine in which
+        to place the files.  The 'remote_dir' must be a relative path.
+        It is interpreted relative to the default directory.  If
+        'None', the files are placed in the default directory.
+
+        Each file is given the basename of the corresponding
+        'local_file'.  Derived classes may override this method to copy
+        all of the files at once."""
+
+        for local_file in local_files:
+            remote_file = os.path.basename(local_file)
+            if remote_dir is not None:
+                remote_file = os.path.join(remote_dir, remote_file)
+            self.UploadFile(local_file, remote_file)
+
+
+    def DownloadFiles(self, remote_files, local_dir = None):
+        """Copy each of the 'remote_files' to the local machine.
+
+        'remote_files' -- A sequence of names of files on the remote
+        machine.  Each name must be a relative path.  It is
+        interpreted relative to the default directory.
+
+        'local_dir' -- The directory on the local machine in which to
+        place the files.  If 'None', the files are placed in the
+        current directory.
+
+        Each file is given the basename of the corresponding
+        'remote_file'.  Derived classes may override this method to
+        copy all of the files at once."""
+
+        for remote_file in remote_files:
+            local_file = os.path.basename(remote_file)
+            if local_dir is not None:
+                local_file = os.path.join(local_dir, local_file)
+            self.DownloadFile(remote_file, local_file)
+
+
     def UploadAndRun(self, path, arguments, environment = None,
                      timeout = -1):
         """Run a program on the remote host.
@@ -156,9 +244,21 @@ class Host(Extension):
         returns -- As for 'Run'.
 
         The program is uploaded to the default directory on the remote
-        host, run, and then deleted."""
+        host, run, and then deleted.  If 'upload_cache' is set, the
+        program is instead given a name based on its contents, and is
+        not deleted, so that it need not be uploaded again.  Either
+        way, the program is copied with 'UploadFiles', so that hosts
+        that copy files in batches need not override this method."""
+
+        if self.upload_cache:
+            remote_file = self._UploadCachedFile(path)
+            return self.Run(remote_file,
+                            arguments,
+                            environment,
+                            timeout,
+                            relative = True)
         
-        self.UploadFile(path)
+        self.UploadFiles([path])
         basename = os.path.basename(path)
         result = self.Run(basename,
                           arguments,
@@ -175,3 +275,292 @@ class Host(Extension):
         'remote_file' -- A relative path to the file to be deleted."""
 
         raise NotImplementedError
+
+
+    def _UploadCachedFile(self, local_file):
+        """Upload 'local_file' under a name based on its contents.
+
+        'local_file' -- The name of a file on the local machine.
+
+        returns -- The name of the copy of 'local_file' on the remote
+        host, relative to the default directory.
+
+        The remote file is named after a hash of the contents of
+        'local_file', so a file with the same name on the remote host
+        has the same contents.  It is not uploaded again if the
+        'upload_cache' shows that it is already present."""
+
+        remote_file = "qmtest-%s-%s" % (_compute_digest(local_file),
+                                        os.path.basename(local_file))
+        cache = _get_upload_cache(self.upload_cache)
+        # Hold the lock for this file so that no other thread runs
+        # the program while it is being uploaded.
+        lock = cache.GetLock((self._GetUploadIdentity(), remote_file))
+        lock.acquire()
+        try:
+            self.__UploadAs(local_file, remote_file)
+        finally:
+            lock.release()
+        return remote_file
+
+
+    def _GetUploadIdentity(self):
+        """Return a string identifying the files on the remote host.
+
+        returns -- A string that is the same for two hosts only if a
+        file uploaded to one of them can be found under the same name
+        on the other.  Uploads are recorded in the 'upload_cache'
+        separately for each identity.
+
+        This method returns the name of the class of the host.
+        Derived classes should add the name of the remote machine,
+        and anything else that determines where files are placed."""
+
+        return "%s.%s" % (self.__class__.__module__,
+                          self.__class__.__name__)
+
+
+    def _GetStaleUploads(self, uploads):
+        """Return the uploads that must be performed.
+
+        'uploads' -- A sequence of pairs '(local_file, remote_file)'
+        giving files to be copied to the remote host.  Each
+        'remote_file' is relative to the default directory.
+
+        returns -- A list of the pairs in 'uploads' for which the
+        'upload_cache' does not show that 'remote_file' is a copy of
+        'local_file'.  A copy that has not been checked within
+        'upload_cache_interval' seconds is checked again with
+        '_IsCopyOf'.  If 'upload_cache' is empty, all of the pairs are
+        returned."""
+
+        if not self.upload_cache:
+            return list(uploads)
+        cache = _get_upload_cache(self.upload_cache)
+        identity = self._GetUploadIdentity()
+        now = time.time()
+        stale = []
+        checked = {}
+        for local_file, remote_file in uploads:
+            key = (identity, remote_file)
+            digest = _compute_digest(local_file)
+            record = cache.Get(key)
+            if record is not None and record[0] == digest:
+                if now - record[1] <= self.upload_cache_interval:
+                    continue
+                if self._IsCopyOf(local_file, remote_file):
+                    checked[key] = (digest, now)
+                    continue
+            stale.append((local_file, remote_file))
+        if checked:
+            cache.Record(checked)
+        return stale
+
+
+    def _RecordUploads(self, uploads):
+        """Record that files have been copied to the remote host.
+
+        'uploads' -- A sequence of pairs '(local_file, remote_file)',
+        as for '_GetStaleUploads', giving files that have just been
+        copied.
+
+        Nothing is recorded if 'upload_cache' is empty."""
+
+        if not self.upload_cache:
+            return
+        identity = self._GetUploadIdentity()
+        now = time.time()
+        records = {}
+        for local_file, remote_file in uploads:
+            records[(identity, remote_file)] \
+                = (_compute_digest(local_file), now)
+        if records:
+            _get_upload_cache(self.upload_cache).Record(records)
+
+
+    def _IsCopyOf(self, local_file, remote_file):
+        """Return true iff 'remote_file' is a copy of 'local_file'.
+
+        'local_file' -- The name of a file on the local machine.
+
+        'remote_file' -- The name of a file on the remote machine,
+        relative to the default directory.
+
+        returns -- True iff 'remote_file' exists and has the same
+        contents as 'local_file'.
+
+        This method downloads 'remote_file'.  Derived classes may
+        override it to perform a cheaper check."""
+
+        directory = tempfile.mkdtemp()
+        try:
+            try:
+                self.DownloadFiles([remote_file], directory)
+                temporary = os.path.join(directory,
+                                         os.path.basename(remote_file))
+                return filecmp.cmp(local_file, temporary, False)
+            except (EnvironmentError, qm.common.QMException):
+                return False
+        finally:
+            shutil.rmtree(directory, True)
+
+
+    def __UploadAs(self, local_file, remote_file):
+        """Copy 'local_file' to 'remote_file' with 'UploadFiles'.
+
+        'local_file' -- The name of a file on the local machine.
+
+        'remote_file' -- The name of the copy in the default directory
+        on the remote machine.  It must not contain a directory
+        separator.
+
+        'UploadFiles' keeps the basename of each file, so the file is
+        first given the name 'remote_file' on the local machine."""
+
+        directory = tempfile.mkdtemp()
+        try:
+            link = os.path.join(directory, remote_file)
+            try:
+                os.link(os.path.abspath(local_file), link)
+            except (AttributeError, OSError):
+                # Hard links are not available on all systems, or
+                # between file systems.
+                shutil.copy2(local_file, link)
+            self.UploadFiles([link])
+        finally:
+            shutil.rmtree(directory, True)
+
+
+
+class _UploadCache(object):
+    """A record of the files uploaded to hosts.
+
+    The record is kept in a file on the local machine, so that files
+    uploaded during one test run can be used by later test runs, and
+    by other processes in the same test run.  Each entry is indexed by
+    a pair '(identity, remote_file)' giving the identity of the host,
+    as returned by 'Host._GetUploadIdentity', and the name of the file
+    on that host."""
+
+    def __init__(self, path):
+        """Create a new '_UploadCache'.
+
+        'path' -- The name of the file containing the record."""
+
+        self.__path = path
+        self.__lock = threading.Lock()
+        self.__file_locks = {}
+        self.__records = self.__Read()
+
+
+    def GetLock(self, key):
+        """Return the lock for the file indicated by 'key'.
+
+        'key' -- A pair '(identity, remote_file)'.
+
+        returns -- A lock that should be held while uploading the
+        file, if it must not be used before the upload completes."""
+
+        self.__lock.acquire()
+        try:
+            return self.__file_locks.setdefault(key, threading.Lock())
+        finally:
+            self.__lock.release()
+
+
+    def Get(self, key):
+        """Return the record of the file indicated by 'key'.
+
+        'key' -- A pair '(identity, remote_file)'.
+
+        returns -- A pair '(digest, checked)' giving the MD5 digest of
+        the contents of the file, and the time at which it was last
+        uploaded or found to be present, or 'None' if it has never
+        been uploaded."""
+
+        self.__lock.acquire()
+        try:
+            if not self.__records.has_key(key):
+                # Another process may have uploaded the file.
+                self.__records.update(self.__Read())
+            return self.__records.get(key)
+        finally:
+            self.__lock.release()
+
+
+    def Record(self, records):
+        """Record that files are present on their hosts.
+
+        'records' -- A map from pairs '(identity, remote_file)' to
+        pairs '(digest, checked)', as returned by 'Get'."""
+
+        self.__lock.acquire()
+        try:
+            merged = self.__Read()
+            merged.update(self.__records)
+            merged.update(records)
+            self.__records = merged
+            # Other processes never see a partial record.
+            qm.common.write_file_atomically(
+                self.__path,
+                lambda f: cPickle.dump(merged, f, cPickle.HIGHEST_PROTOCOL))
+        finally:
+            self.__lock.release()
+
+
+    def __Read(self):
+        """Read the record from the file.
+
+        returns -- A map from keys to records, as for 'Record'.  The
+        map is empty if the file does not exist or cannot be read."""
+
+        try:
+            f = open(self.__path, "rb")
+        except IOError:
+            return {}
+        try:
+            try:
+                return cPickle.load(f)
+            except (EOFError, cPickle.UnpicklingError):
+                return {}
+        finally:
+            f.close()
+
+########################################################################
+# Functions
+#######################################################################
+
+def _compute_digest(path):
+    """Return the MD5 digest of the contents of 'path'.
+
+    'path' -- The name of a file on the local machine.
+
+    returns -- The digest, as a string of hexadecimal digits."""
+
+    digest = md5()
+    f = open(path, "rb")
+    try:
+        for block in iter(lambda: f.read(64 * 1024), ""):
+            digest.update(block)
+    finally:
+        f.close()
+    return digest.hexdigest()
+
+
+def _get_upload_cache(path):
+    """Return the '_UploadCache' for 'path'.
+
+    'path' -- The name of an upload cache file.
+
+    returns -- The '_UploadCache' for 'path'.  All hosts in this
+    process that use 'path' share the same '_UploadCache'."""
+
+    _upload_caches_lock.acquire()
+    try:
+        cache = _upload_caches.get(path)
+        if cache is None:
+            cache = _UploadCache(path)
+            _upload_caches[path] = cache
+        return cache
+    finally:
+        _upload_caches_lock.release()
@@ -87,6 +87,30 @@ def get_shell_for_script():
     return shell
 
 
+def get_cpu_count():
+    """Return the number of processors available on this computer.
+
+    returns -- A positive integer giving the number of processors.  If
+    the number cannot be determined, 1 is returned."""
+
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        pass
+    try:
+        count = os.sysconf("SC_NPROCESSORS_ONLN")
+        if count > 0:
+            return count
+    except (AttributeError, ValueError, OSError):
+        pass
+    try:
+        return max(1, int(os.environ["NUMBER_OF_PROCESSORS"]))
+    except (KeyError, ValueError):
+        pass
+    return 1
+
+
 ########################################################################
 # Local Variables:
 # mode: python
@@ -128,6 +128,32 @@ def get_host_name():
 
     return posix.uname()[1]
 
+def get_load_average():
+    """Return the system load average over the last minute.
+
+    returns -- A floating-point number giving the average number of
+    runnable processes, or 'None' if it cannot be determined."""
+
+    try:
+        return os.getloadavg()[0]
+    except (AttributeError, OSError):
+        return None
+
+
+def get_run_queue_length():
+    """Return the number of processes that are presently runnable.
+
+    returns -- An integer giving the number of runnable processes and
+    threads on the system at this moment, or 'None' if it cannot be
+    determined.  Unlike the load average, this value responds
+    immediately to changes in the system load."""
+
+    try:
+        fields = open("/proc/loadavg").read().split()
+        return int(fields[3].split("/")[0])
+    except (IOError, IndexError, ValueError):
+        return None
+
 ########################################################################
 # initialization
 ########################################################################
@@ -83,6 +83,23 @@ def _get_host_name():
     return "localhost"
 
 
+def get_load_average():
+    """Return the system load average over the last minute.
+
+    returns -- 'None'; Windows does not provide a load average."""
+
+    return None
+
+
+def get_run_queue_length():
+    """Return the number of processes that are presently runnable.
+
+    returns -- 'None'; this information is not available on
+    Windows."""
+
+    return None
+
+
 def open_in_browser(url):
     """Open a browser window and point it at 'url'.
 
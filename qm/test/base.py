@@ -30,6 +30,7 @@ import qm.structured_text
 from   qm.test.context import *
 from   qm.test.result import *
 import qm.xmlutil
+import shutil
 import string
 import sys
 import tempfile
@@ -346,7 +347,8 @@ def load_results(file, database):
     results.  If 'file' is not a string, then it is must be a seekable
     file object, and this function will look for a 'FileResultReader'
     that accepts the file.  If 'file' is a string, then it is treated as
-    either a filename or as an extension descriptor.
+    either a filename or as an extension descriptor.  Files compressed
+    with gzip or zstd are decompressed before they are read.
 
     'database' -- The current database.
 
@@ -360,14 +362,26 @@ def load_results(file, database):
     else:
         f = file
     if f:
-        # Find the first FileResultStream that will accept this file.
+        f = _decompress_results(f)
+        # Look at the start of the file to find the readers that may
+        # accept it, rather than trying every reader on the whole file.
+        head = f.read(_results_head_size)
+        f.seek(0)
+        matching = []
+        others = []
         for c in get_extension_classes("result_reader", database):
             if issubclass(c, FileResultReader):
-                try:
-                    return c({"file" : f})
-                except FileResultReader.InvalidFile:
-                    # Go back to the beginning of the file.
-                    f.seek(0)
+                if c._signature_regexp is None:
+                    others.append(c)
+                elif c._signature_regexp.match(head):
+                    matching.append(c)
+        # Find the first FileResultStream that will accept this file.
+        for c in matching + others:
+            try:
+                return c({"file" : f})
+            except FileResultReader.InvalidFile:
+                # Go back to the beginning of the file.
+                f.seek(0)
     if not isinstance(file, types.StringTypes):
         raise FileResultReader.InvalidFile, \
               "not a valid results file"
@@ -384,6 +398,62 @@ def load_results(file, database):
     return cl(args)
         
 
+_results_head_size = 4096
+"""The number of bytes examined to find the readers for a results file."""
+
+_compression_formats = (
+    ("\x1f\x8b", "gzip"),
+    ("\x28\xb5\x2f\xfd", "zstandard"),
+    )
+"""The compressed formats accepted by 'load_results'.
+
+Each element is a pair giving the bytes at the start of a compressed
+file, and the name of the module used to decompress it."""
+
+def _decompress_results(f):
+    """Decompress a results file, if it is compressed.
+
+    'f' -- A seekable file object.
+
+    returns -- If 'f' is compressed, a temporary file containing the
+    decompressed contents of 'f', in which case 'f' is closed.
+    Otherwise, 'f' itself.
+
+    Result readers may seek in the file, or map it into memory, so
+    compressed files are decompressed in full, rather than read
+    through a decompressing file object."""
+
+    magic = f.read(4)
+    f.seek(0)
+    for prefix, module_name in _compression_formats:
+        if magic.startswith(prefix):
+            break
+    else:
+        return f
+    try:
+        module = __import__(module_name)
+    except ImportError:
+        raise FileResultReader.InvalidFile, \
+              qm.error("compressed results unsupported",
+                       module = module_name)
+    if module_name == "gzip":
+        compressed = module.GzipFile(fileobj = f, mode = "rb")
+    else:
+        compressed = module.ZstdDecompressor().stream_reader(f)
+    decompressed = tempfile.TemporaryFile()
+    try:
+        shutil.copyfileobj(compressed, decompressed)
+    except Exception, e:
+        # The compressed data is damaged.
+        decompressed.close()
+        raise FileResultReader.InvalidFile, \
+              "could not decompress results: %s" % str(e)
+    compressed.close()
+    f.close()
+    decompressed.seek(0)
+    return decompressed
+
+
 def load_expectations(file, database, annotations = None):
     """Read expectations from a file.
 
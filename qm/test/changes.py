@@ -0,0 +1,189 @@
+########################################################################
+#
+# File:   changes.py
+# Author: agent
+# Date:   2026-10-19
+#
+# Contents:
+#   Functions for selecting the tests affected by source changes.
+#
+# Copyright (c) 2026 by CodeSourcery, LLC.  All rights reserved.
+#
+# For license terms see the file COPYING.
+#
+########################################################################
+
+########################################################################
+# Imports
+########################################################################
+
+import os
+import qm.common
+from   qm.common import md5
+import qm.test.database
+from   qm.test.result import Result
+
+########################################################################
+# Classes
+########################################################################
+
+class SourceDigests(object):
+    """A 'SourceDigests' computes digests of the source files of tests.
+
+    The digest of each file is computed only once, so files shared by
+    many tests, such as headers, are read only once."""
+
+    def __init__(self):
+        """Construct a new 'SourceDigests'."""
+
+        # A map from paths to the digests of the files' contents, or
+        # 'None' for files that do not exist.
+        self.__files = {}
+
+
+    def GetDigest(self, files):
+        """Return a digest of 'files'.
+
+        'files' -- A sequence of paths, as returned by
+        'Database.GetTestSourceFiles'.
+
+        returns -- A string that changes whenever the contents of one
+        of the 'files' change, or a file is created or removed."""
+
+        digest = md5()
+        for path in files:
+            digest.update(repr((path, self.__GetFileDigest(path))))
+        return digest.hexdigest()
+
+
+    def __GetFileDigest(self, path):
+        """Return a digest of the file at 'path'.
+
+        'path' -- The path to a file.
+
+        returns -- A digest of the contents of the file, or 'None' if
+        the file cannot be read."""
+
+        if not self.__files.has_key(path):
+            try:
+                f = open(path, "rb")
+                try:
+                    self.__files[path] = md5(f.read()).hexdigest()
+                finally:
+                    f.close()
+            except IOError:
+                self.__files[path] = None
+        return self.__files[path]
+
+########################################################################
+# Functions
+########################################################################
+
+def parse_time(since):
+    """Parse the time given to '--changed-since'.
+
+    'since' -- A string giving a time, either in ISO 8601 format, as
+    in the 'qmtest.run.start_time' annotation, or in the format
+    accepted by 'qm.common.parse_time'.
+
+    returns -- The number of seconds since the start of the UNIX
+    epoch.  Raises 'ValueError' if 'since' is not a valid time."""
+
+    try:
+        return qm.common.parse_time_iso(since)
+    except ValueError:
+        return qm.common.parse_time(since)
+
+
+def load_previous_run(results):
+    """Return the results of a previous test run.
+
+    'results' -- A 'ResultReader' for the results of the previous
+    test run.
+
+    returns -- A pair '(start_time, previous)'.  The 'start_time' is
+    the time at which the test run started, in seconds since the start
+    of the UNIX epoch, or 'None' if the results do not record it.  The
+    'previous' is a map from test IDs to their 'Result's."""
+
+    previous = {}
+    for result in results:
+        if result.GetKind() == Result.TEST:
+            previous[result.GetId()] = result
+    start_time = results.GetAnnotations().get("qmtest.run.start_time")
+    if start_time is not None:
+        try:
+            start_time = qm.common.parse_time_iso(start_time)
+        except ValueError:
+            start_time = None
+    return start_time, previous
+
+
+def select_changed(database, test_ids, since, previous = None,
+                   expectations = None):
+    """Return the tests whose source files have changed.
+
+    'database' -- The 'Database' containing the tests.
+
+    'test_ids' -- A sequence of test names.
+
+    'since' -- The time, in seconds since the start of the UNIX epoch,
+    after which a change to a source file counts.
+
+    'previous' -- If not 'None', a map from test IDs to the 'Result's
+    of a previous test run, as returned by 'load_previous_run'.
+
+    'expectations' -- If 'previous' is not 'None', the
+    'ExpectationDatabase' giving the expected outcomes of the tests.
+
+    returns -- A list of the elements of 'test_ids' that should be
+    run.
+
+    A test is selected if 'Database.GetTestSourceFiles' does not know
+    its source files, or if one of them is missing or was modified
+    after 'since'.  If the previous result for the test records the
+    digest of its source files, the digest is compared instead, so
+    that files whose modification times changed, but whose contents
+    did not, are ignored.  Tests that were not part of the previous
+    test run, or whose outcomes in it were unexpected, are always
+    selected."""
+
+    digests = SourceDigests()
+    selected = []
+    for test_id in test_ids:
+        if previous is not None:
+            result = previous.get(test_id)
+            if (result is None
+                or (expectations.Lookup(test_id).GetOutcome()
+                    != result.GetOutcome())):
+                selected.append(test_id)
+                continue
+        try:
+            files = database.GetTestSourceFiles(test_id)
+        except qm.test.database.NoSuchTestError:
+            # The error is reported when the test is run.
+            files = None
+        if files is None:
+            selected.append(test_id)
+            continue
+        if previous is not None and result.has_key(Result.SOURCE_DIGEST):
+            if digests.GetDigest(files) != result[Result.SOURCE_DIGEST]:
+                selected.append(test_id)
+            continue
+        for path in files:
+            try:
+                if os.stat(path).st_mtime > since:
+                    break
+            except OSError:
+                break
+        else:
+            continue
+        selected.append(test_id)
+    return selected
+
+########################################################################
+# Local Variables:
+# mode: python
+# indent-tabs-mode: nil
+# fill-column: 72
+# End:
@@ -89,6 +89,14 @@ class CompilationTestDatabase(Database):
                                                        '.cc':'cplusplus',
                                                        '.C':'cplusplus',
                                                        '.f':'fortran'})
+    shared_headers = SetField(TextField(
+        title = "Shared Headers",
+        description = """Files on which every test depends.
+
+        The paths of files, relative to the source directory, that
+        are used by all of the tests, such as headers that many of
+        the test programs include.  When one of these files changes,
+        'qmtest run --changed-since' runs every test."""))
     _is_generic_database = True
     
 
@@ -138,6 +146,17 @@ class CompilationTestDatabase(Database):
         return ids
     
 
+    def GetTestSourceFiles(self, test_id):
+
+        src = os.path.join(self.srcdir, test_id)
+        if (os.path.splitext(test_id)[1] not in self.test_extensions
+            or not os.path.isfile(src)):
+            raise NoSuchTestError(test_id)
+        return ([os.path.abspath(src)]
+                + [os.path.abspath(os.path.join(self.srcdir, h))
+                   for h in self.shared_headers])
+
+
     def GetExtension(self, id):
 
         if not id:
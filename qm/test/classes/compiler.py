@@ -23,13 +23,18 @@ GNU Compiler Collection and the Edison Design Group compilers."""
 # Imports
 ########################################################################
 
+import cPickle
 from   qm.executable import *
 import os
 import os.path
 import qm
+import qm.common
+from   qm.common import md5
+import shutil
 import StringIO
 import re
 import sys
+import tempfile
 if sys.platform != "win32":
     import resource
 
@@ -308,6 +313,65 @@ class Compiler:
             return ".obj"
         else:
             return ".o"
+
+
+    def GetOutputFiles(self, mode, files, output = None):
+        """Return the files that a compilation will create.
+
+        'mode' -- The compilation mode (one of the 'Compiler.modes').
+
+        'files' -- As for 'Compile'.
+
+        'output' -- As for 'Compile'.
+
+        returns -- A list of the names of the files that the
+        compilation will create, relative to the directory in which
+        the compiler is run, or 'None' if they are not known."""
+
+        if output:
+            return [output]
+        if mode == self.MODE_PREPROCESS:
+            # The preprocessed source is written to the standard output.
+            return []
+        elif mode == self.MODE_LINK:
+            return ["a.out"]
+        elif mode == self.MODE_COMPILE:
+            extension = ".s"
+        elif mode == self.MODE_ASSEMBLE:
+            extension = self.GetObjectExtension()
+        else:
+            return None
+        outputs = []
+        for f in files:
+            basename, file_extension = os.path.splitext(os.path.basename(f))
+            # Object files and libraries are not compiled again.
+            if file_extension not in (".o", ".obj", ".a", ".so", ".lib"):
+                outputs.append(basename + extension)
+        return outputs
+
+
+    def GetCacheInputs(self, dir, command, timeout = -1):
+        """Return the inputs to 'command' that are not named in it.
+
+        'dir' -- The directory in which 'command' will be run.
+
+        'command' -- A sequence of strings, as returned by
+        'GetCompilationCommand'.
+
+        'timeout' -- As for 'ExecuteCommand'.
+
+        returns -- A string that changes whenever a file read by
+        'command', but not named in it, changes, or 'None' if the
+        result of 'command' should not be cached.
+
+        A 'CompilationCache' uses this string, along with the contents
+        of the files named in 'command', to decide whether 'command'
+        has been run before.  This method returns 'None', since a
+        compiler may read files, such as headers, that are not named
+        in 'command'.  Derived classes that can account for those
+        files should override it."""
+
+        return None
         
     
     def _GetModeSwitches(self, mode):
@@ -330,6 +394,191 @@ class Compiler:
             
         
 
+class CompilationCache:
+    """A 'CompilationCache' reuses the results of earlier compilations.
+
+    When a compilation command is run, the files it creates, its exit
+    status, and its output are stored in the cache directory.  If the
+    same command is run again, with the same compiler, on source files
+    with the same contents, the stored files are copied into place and
+    the stored status and output are returned, without running the
+    compiler.  Because the output is the same, the diagnostics parsed
+    from it are the same too.  Only the commands of compilers whose
+    'GetCacheInputs' method does not return 'None' are cached.
+
+    Several processes may use the same cache directory at once."""
+
+    def __init__(self, directory):
+        """Construct a new 'CompilationCache'.
+
+        'directory' -- The directory in which to store compilation
+        results.  It is created if it does not exist."""
+
+        self.__directory = directory
+
+
+    def ExecuteCommand(self, compiler, dir, command, outputs, timeout = -1):
+        """Execute 'command' in 'dir', reusing an earlier result.
+
+        'compiler' -- The 'Compiler' that created 'command'.
+
+        'dir' -- As for 'Compiler.ExecuteCommand'.
+
+        'command' -- As for 'Compiler.ExecuteCommand'.
+
+        'outputs' -- A list of the files that 'command' creates, as
+        returned by 'Compiler.GetOutputFiles'.  If 'None', 'command'
+        is run, but its result is not cached.
+
+        'timeout' -- As for 'Compiler.ExecuteCommand'.
+
+        returns -- As for 'Compiler.ExecuteCommand'."""
+
+        key = None
+        if outputs is not None:
+            key = self.__GetKey(compiler, dir, command, outputs, timeout)
+        if key is None:
+            return compiler.ExecuteCommand(dir, command, timeout)
+        entry = os.path.join(self.__directory, key[:2], key)
+        cached = self.__Restore(entry, dir, outputs)
+        if cached is not None:
+            return cached
+        status, output = compiler.ExecuteCommand(dir, command, timeout)
+        # A compiler that was killed, perhaps because it ran for too
+        # long, might not do so the next time.
+        if sys.platform == "win32" or os.WIFEXITED(status):
+            self.__Store(entry, dir, outputs, status, output)
+        return (status, output)
+
+
+    def __GetKey(self, compiler, dir, command, outputs, timeout):
+        """Return the key under which the result of 'command' is stored.
+
+        'compiler' -- The 'Compiler' that created 'command'.
+
+        'dir' -- The directory in which 'command' will be run.
+
+        'command' -- The compilation command.
+
+        'outputs' -- The files that 'command' creates.
+
+        'timeout' -- The maximum number of seconds the compiler is
+        permitted to run.
+
+        returns -- A string, or 'None' if the result of 'command'
+        should not be cached."""
+
+        # Identify the compiler executable by its size and
+        # modification time, so that the cache is not used after the
+        # compiler is rebuilt.
+        path = command[0]
+        if not os.path.dirname(path):
+            for d in os.environ.get("PATH", "").split(os.pathsep):
+                if os.path.isfile(os.path.join(d, path)):
+                    path = os.path.join(d, path)
+                    break
+        try:
+            info = os.stat(os.path.join(dir, path))
+        except OSError:
+            return None
+        inputs = compiler.GetCacheInputs(dir, command, timeout)
+        if inputs is None:
+            return None
+        digest = md5()
+        digest.update(repr((os.path.abspath(os.path.join(dir, path)),
+                            info.st_size, info.st_mtime,
+                            command, outputs)))
+        # Add the contents of the files named in the command.  The
+        # outputs may be left over from an earlier compilation.
+        for argument in command[1:]:
+            if argument in outputs:
+                continue
+            name = os.path.join(dir, argument)
+            if os.path.isfile(name):
+                f = open(name, "rb")
+                try:
+                    digest.update(md5(f.read()).hexdigest())
+                finally:
+                    f.close()
+        digest.update(md5(inputs).hexdigest())
+        return digest.hexdigest()
+
+
+    def __Restore(self, entry, dir, outputs):
+        """Reuse the result stored in 'entry'.
+
+        'entry' -- The directory containing a stored result.
+
+        'dir' -- The directory in which the compiler would be run.
+
+        'outputs' -- The files that the compiler would create.
+
+        returns -- A tuple '(status, output)', as for
+        'Compiler.ExecuteCommand', or 'None' if there is no stored
+        result."""
+
+        try:
+            f = open(os.path.join(entry, "result"), "rb")
+        except IOError:
+            return None
+        try:
+            try:
+                status, output, count = cPickle.load(f)
+            except:
+                return None
+        finally:
+            f.close()
+        for i in range(count):
+            shutil.copy(os.path.join(entry, str(i)),
+                        os.path.join(dir, outputs[i]))
+        return (status, output)
+
+
+    def __Store(self, entry, dir, outputs, status, output):
+        """Store the result of a compilation in 'entry'.
+
+        'entry' -- The directory in which to store the result.
+
+        'dir' -- The directory in which the compiler was run.
+
+        'outputs' -- The files that the compiler was expected to
+        create.
+
+        'status' -- The exit status of the compiler.
+
+        'output' -- The output of the compiler."""
+
+        if status == 0:
+            count = len(outputs)
+            for name in outputs:
+                if not os.path.isfile(os.path.join(dir, name)):
+                    # The compiler did not create the expected files.
+                    return
+        else:
+            # A failed compilation may leave partial files behind.
+            count = 0
+        parent = os.path.dirname(entry)
+        qm.common.make_directories(parent)
+        # Fill in a temporary directory and then rename it, so that
+        # other processes never see a partial result.
+        temporary = tempfile.mkdtemp(dir = parent)
+        try:
+            for i in range(count):
+                shutil.copy(os.path.join(dir, outputs[i]),
+                            os.path.join(temporary, str(i)))
+            f = open(os.path.join(temporary, "result"), "wb")
+            try:
+                cPickle.dump((status, output, count), f,
+                             cPickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            os.rename(temporary, entry)
+        except EnvironmentError:
+            # Another process may have stored the same result.
+            shutil.rmtree(temporary, True)
+
+
+
 class SourcePosition:
     """A 'SourcePosition' indicates a location in source code.
 
@@ -476,10 +725,46 @@ class GCC(Compiler):
     by this regular expression, the error message indicates an
     internal error in the compiler."""
 
+    _combined_regexps = {}
+    """A map from classes derived from 'GCC' to tuples '(regexp,
+    prefixes)', as returned by '_GetCombinedRegexp'."""
+
     MODE_PRECOMPILE = "precompile"
     """Precompile a header file."""
 
     modes = Compiler.modes + [MODE_PRECOMPILE]
+
+    def GetCacheInputs(self, dir, command, timeout = -1):
+        """Return the preprocessed source for 'command'.
+
+        See 'Compiler.GetCacheInputs'.  The preprocessed source
+        depends on every header the compiler reads, and on the macros
+        defined on the command line.  Commands that link are not
+        cached, since they read libraries that are not named in them;
+        for those commands, this method returns 'None'."""
+
+        for argument in command[1:]:
+            if argument in ("-c", "-S", "-E"):
+                break
+        else:
+            # The command links.
+            return None
+        # Replace the compilation mode and the output file with '-E'.
+        preprocess = [command[0]]
+        arguments = iter(command[1:])
+        for argument in arguments:
+            if argument == "-o":
+                arguments.next()
+            elif argument not in ("-c", "-S", "-E"):
+                preprocess.append(argument)
+        preprocess.append("-E")
+        status, output = self.ExecuteCommand(dir, preprocess, timeout)
+        if status != 0:
+            # If the source cannot be preprocessed, do not cache the
+            # result of compiling it.
+            return None
+        return output
+
     
     def ParseOutput(self, output, ignore_regexps = ()):
         """Return the 'Diagnostic's indicated in the 'output'.
@@ -496,55 +781,91 @@ class GCC(Compiler):
 
         # Assume there were no diagnostics.
         diagnostics = []
+        # Try all of the severities at once.
+        regexp, prefixes = self._GetCombinedRegexp()
         # Create a file object containing the 'output'.
         f = StringIO.StringIO(output)
         # Reall all of the output, line by line.
         for line in f.readlines():
+            match = regexp.match(line)
+            # If it does not look like an error message, skip it.
+            if not match:
+                continue
+            # See which severity's regular expression matched.
             for severity in self._severities:
-                match = self._severity_regexps[severity].match(line)
-                # If it does not look like an error message, skip it.
-                if not match:
-                    continue
-
-                # Some error messages are ignored.
-                ignore = 0
-                for ignore_regexp in ignore_regexps:
-                    if ignore_regexp.match(match.group()):
-                        ignore = 1
-                        break
-                if ignore:
-                    continue
-
-                # An internal error is an error that indicates that
-                # the compiler crashed.
-                message = match.group('message')
-                if (severity == 'error'
-                    and self._internal_error_regexp.search(message)):
-                    severity = 'internal_error'
-
-                # If there is no line number, then we will not be
-                # able to convert it to an integer.
-                try:
-                    line_number = int(match.group('line'))
-                except:
-                    line_number = 0
+                prefix = prefixes[severity]
+                if match.group(prefix) is not None:
+                    break
+
+            # Some error messages are ignored.
+            ignore = 0
+            for ignore_regexp in ignore_regexps:
+                if ignore_regexp.match(match.group(prefix)):
+                    ignore = 1
+                    break
+            if ignore:
+                continue
+
+            # An internal error is an error that indicates that
+            # the compiler crashed.
+            message = match.group(prefix + 'message')
+            if (severity == 'error'
+                and self._internal_error_regexp.search(message)):
+                severity = 'internal_error'
+
+            # If there is no line number, then we will not be
+            # able to convert it to an integer.
+            try:
+                line_number = int(match.group(prefix + 'line'))
+            except:
+                line_number = 0
+
+            # See if there is a column number.
+            try:
+                column_number = int(match.group(prefix + 'column'))
+            except:
+                column_number = 0
+
+            source_position = SourcePosition(match.group(prefix + 'file'),
+                                             line_number,
+                                             column_number)
+            diagnostic = Diagnostic(source_position,
+                                    severity,
+                                    message)
+            diagnostics.append(diagnostic)
 
-                # See if there is a column number.
-                try:
-                    column_number = int(match.group('column'))
-                except:
-                    column_number = 0
+        return diagnostics
 
-                source_position = SourcePosition(match.group('file'),
-                                                 line_number,
-                                                 column_number)
-                diagnostic = Diagnostic(source_position,
-                                        severity,
-                                        message)
-                diagnostics.append(diagnostic)
-                break
 
-        return diagnostics
+    def _GetCombinedRegexp(self):
+        """Return a regular expression matching every severity.
+
+        returns -- A tuple '(regexp, prefixes)'.  The 'regexp' is a
+        compiled regular expression with one alternative for each of
+        the '_severity_regexps', tried in the order given by
+        '_severities', so that it matches a line just as trying each
+        of them in turn would.  The 'prefixes' map each severity to the
+        name of the group that matches when that severity's
+        alternative does; the groups of that severity's regular
+        expression are renamed by adding the same prefix."""
+
+        combined = GCC._combined_regexps.get(self.__class__)
+        if combined is None:
+            alternatives = []
+            prefixes = {}
+            flags = 0
+            for i in range(len(self._severities)):
+                severity = self._severities[i]
+                regexp = self._severity_regexps[severity]
+                prefix = "severity%d_" % i
+                prefixes[severity] = prefix
+                pattern = re.sub(r"\(\?P([<=])", r"(?P\1" + prefix,
+                                 regexp.pattern)
+                alternatives.append("(?P<%s>%s)" % (prefix, pattern))
+                flags |= regexp.flags
+            combined = (re.compile("|".join(alternatives), flags), prefixes)
+            GCC._combined_regexps[self.__class__] = combined
+        return combined
 
 
 
@@ -17,6 +17,8 @@ from   compiler import *
 from   qm.test.result import *
 from   qm.test.test import *
 import os, dircache
+import sys
+from   threading import Thread
 
 ########################################################################
 # Classes
@@ -55,6 +57,66 @@ class CompilationStep:
 
 
 
+class _CompilationJob(Thread):
+    """A '_CompilationJob' runs a compilation step in its own thread."""
+
+    def __init__(self, step, dir, command, timeout, cache):
+        """Construct a new '_CompilationJob'.
+
+        'step' -- The 'CompilationStep' to run.
+
+        'dir' -- The directory in which to run the compiler.
+
+        'command' -- The compilation command for 'step'.
+
+        'timeout' -- As for 'Compiler.ExecuteCommand'.
+
+        'cache' -- The 'CompilationCache' to use, or 'None'."""
+
+        Thread.__init__(self)
+        self.__step = step
+        self.__dir = dir
+        self.__command = command
+        self.__timeout = timeout
+        self.__cache = cache
+        self.__result = None
+        self.__exc_info = None
+
+
+    def run(self):
+
+        compiler = self.__step.compiler
+        try:
+            if self.__cache:
+                outputs = compiler.GetOutputFiles(self.__step.mode,
+                                                  self.__step.files,
+                                                  self.__step.output)
+                self.__result \
+                    = self.__cache.ExecuteCommand(compiler, self.__dir,
+                                                  self.__command, outputs,
+                                                  self.__timeout)
+            else:
+                self.__result \
+                    = compiler.ExecuteCommand(self.__dir, self.__command,
+                                              self.__timeout)
+        except:
+            self.__exc_info = sys.exc_info()
+
+
+    def GetResult(self):
+        """Wait for the compilation to finish.
+
+        returns -- A tuple '(status, output)', as for
+        'Compiler.ExecuteCommand'.  If the compilation raised an
+        exception, the exception is raised again."""
+
+        self.join()
+        if self.__exc_info:
+            raise self.__exc_info[0], self.__exc_info[1], self.__exc_info[2]
+        return self.__result
+
+
+
 class CompilerBase:
     """A 'CompilerBase' is used by compilation test and resource clases."""
 
@@ -74,6 +136,21 @@ class CompilerBase:
             return os.path.join(".", "build", self.GetId())
     
         
+    def _GetCompilationCache(self, context):
+        """Return the cache of compilation results.
+
+        'context' -- A 'Context' giving run-time parameters to the
+        test.
+
+        returns -- A 'CompilationCache' storing its results in the
+        directory given by the 'CompilerTest.compilation_cache' context
+        variable, or 'None' if that variable is not set."""
+
+        if context.has_key("CompilerTest.compilation_cache"):
+            return CompilationCache(context["CompilerTest.compilation_cache"])
+        return None
+
+
     def _MakeDirectory(self, context):
         """Create a directory in which to place generated files.
 
@@ -161,30 +238,47 @@ class CompilerTest(Test, CompilerBase):
         is_execution_required = self._IsExecutionRequired()
         # Create the temporary build directory.
         self._MakeDirectory(context)
+        directory = self._GetDirectory(context)
+        # Reuse the results of earlier compilations, if possible.
+        cache = self._GetCompilationCache(context)
+        timeout = context.get("CompilerTest.compilation_timeout", -1)
+
+        # Get the compilation commands.
+        commands = []
+        for step in steps:
+            commands.append(step.compiler.GetCompilationCommand(step.mode,
+                                                                step.files,
+                                                                step.options,
+                                                                step.ldflags,
+                                                                step.output))
+        # Steps that do not depend on one another may be run at once,
+        # using as many jobs as the test has slots.
+        waits = self._GetStepDependencies(steps)
+        jobs = []
         
         # Keep track of which compilation step we are performing so
         # that we can annotate the result appropriately.
         step_index = 1
 
         # Perform each of the compilation steps.
-        for step in steps:
-            # Get the compiler to use for this test.
-            compiler = step.compiler
+        for step, command in zip(steps, commands):
+            # Start the steps that can be run before this one
+            # finishes.  Every step before this one has finished.
+            while len(jobs) < len(steps):
+                k = len(jobs)
+                if (k >= step_index - 1 + max(self.slots, 1)
+                    or waits[k] >= step_index - 1):
+                    break
+                jobs.append(_CompilationJob(steps[k], directory,
+                                            commands[k], timeout, cache))
+                jobs[k].start()
+            # Wait for the compiler to finish.
+            (status, output) = jobs[step_index - 1].GetResult()
 
             # Compute a prefix for the result annotations.
             prefix = self._GetAnnotationPrefix() + "step_%d_" % step_index
 
-            # Get the compilation command.
-            command = compiler.GetCompilationCommand(step.mode, step.files,
-                                                     step.options,
-                                                     step.ldflags,
-                                                     step.output)
             result[prefix + "command"] = result.Quote(' '.join(command))
-            # Run the compiler.
-            timeout = context.get("CompilerTest.compilation_timeout", -1)
-            (status, output) \
-                = compiler.ExecuteCommand(self._GetDirectory(context),
-                                          command, timeout)
             # Annotate the result with the output.
             if output:
                 result[prefix + "output"] = result.Quote(output)
@@ -203,6 +297,10 @@ class CompilerTest(Test, CompilerBase):
             # is not considered a failure.
             if not result.CheckExitStatus(prefix, desc, status,
                                           step.diagnostics):
+                # Let any later steps that have been started finish
+                # before the directory is cleaned up.
+                for job in jobs[step_index:]:
+                    job.join()
                 return
 
             # If this compilation generated an executable, remember
@@ -218,6 +316,50 @@ class CompilerTest(Test, CompilerBase):
             self._RunExecutable(executable_path, context, result)
         
         
+    def _GetStepDependencies(self, steps):
+        """Return the steps that each compilation step must wait for.
+
+        'steps' -- A sequence of 'CompilationStep' objects, as returned
+        by '_GetCompilationSteps'.
+
+        returns -- A list giving, for each step, the index of the last
+        earlier step that must finish before the step can start, or -1
+        if the step can start at once.
+
+        Preprocessing, compiling, and assembling steps can run at the
+        same time as one another, unless one reads or writes a file
+        that the other writes.  Other steps, such as linking, may read
+        files that they do not name, and so run on their own."""
+
+        concurrent_modes = (Compiler.MODE_PREPROCESS,
+                            Compiler.MODE_COMPILE,
+                            Compiler.MODE_ASSEMBLE)
+        waits = []
+        # The outputs of the steps since the last step that ran on its
+        # own.
+        outputs = {}
+        barrier = -1
+        for index in range(len(steps)):
+            step = steps[index]
+            step_outputs = step.compiler.GetOutputFiles(step.mode,
+                                                        step.files,
+                                                        step.output)
+            if step.mode not in concurrent_modes or step_outputs is None:
+                # Wait for every earlier step; later steps wait for
+                # this one.
+                waits.append(index - 1)
+                barrier = index
+                outputs = {}
+                continue
+            wait = barrier
+            for name in list(step.files) + step_outputs:
+                wait = max(wait, outputs.get(name, -1))
+            waits.append(wait)
+            for name in list(step.files) + step_outputs:
+                outputs[name] = index
+        return waits
+
+
     def _GetCompiler(self, context):
         """Return the 'Compiler' to use.
 
@@ -389,10 +531,20 @@ class CompilerTest(Test, CompilerBase):
         missing_diagnostics = []
         # Diagnostics that were emitted, but should not have been.
         spurious_diagnostics = []
-        # Expected diagnostics that have been matched.
-        matched_diagnostics = []
+        # Expected diagnostics that have been matched.  The keys are
+        # the diagnostics; the values are unused.
+        matched_diagnostics = {}
         # Keep track of any errors.
         errors_occurred = 0
+        # Index the expected diagnostics by source position, so that
+        # each emitted diagnostic is compared only with those that
+        # might match it.  A derived class that matches diagnostics in
+        # some other way must compare each pair.
+        if (getattr(self._IsDiagnosticExpected, "im_func", None)
+            is CompilerTest._IsDiagnosticExpected.im_func):
+            index = self._IndexDiagnostics(diagnostics)
+        else:
+            index = None
         
         # Loop through the emitted diagnostics, trying to match each
         # with an expected diagnostic.
@@ -410,17 +562,22 @@ class CompilerTest(Test, CompilerBase):
             # one that matches the emitted diagnostic.  A single
             # emitted diagnostic might match more than one expected
             # diagnostic, so we can not break out of the loop early.
-            for expected_diagnostic in diagnostics:
+            if index is None:
+                candidates = diagnostics
+            else:
+                candidates = self._GetCandidateDiagnostics(index,
+                                                           emitted_diagnostic)
+            for expected_diagnostic in candidates:
                 if self._IsDiagnosticExpected(emitted_diagnostic,
                                               expected_diagnostic):
-                    matched_diagnostics.append(expected_diagnostic)
+                    matched_diagnostics[expected_diagnostic] = None
                     is_expected = 1
             if not is_expected:
                 spurious_diagnostics.append(emitted_diagnostic)
         # Any expected diagnostics for which there was no
         # corresponding emitted diagnostic are missing diagnostics.
         for expected_diagnostic in diagnostics:
-            if expected_diagnostic not in matched_diagnostics:
+            if not matched_diagnostics.has_key(expected_diagnostic):
                 missing_diagnostics.append(expected_diagnostic)
 
         # If there were missing or spurious diagnostics, the test failed.
@@ -489,14 +646,83 @@ class CompilerTest(Test, CompilerBase):
         if (expected.severity and emitted.severity != expected.severity):
             return 0
         # If the messages do not match, there is no match.
-        if expected.message and not re.search(expected.message,
-                                              emitted.message):
+        if (expected.message
+            and not self._GetMessageRegexp(expected.message)
+                        .search(emitted.message)):
             return 0
 
         # There's a match.
         return 1
 
 
+    def _GetMessageRegexp(self, message):
+        """Return the compiled regular expression for 'message'.
+
+        'message' -- The message of an expected 'Diagnostic', which is
+        a regular expression.
+
+        returns -- The compiled regular expression.  Each expression is
+        compiled only once, even when there are more of them than the
+        're' module caches."""
+
+        try:
+            regexps = self.__message_regexps
+        except AttributeError:
+            regexps = self.__message_regexps = {}
+        regexp = regexps.get(message)
+        if regexp is None:
+            regexp = regexps[message] = re.compile(message)
+        return regexp
+
+
+    def _IndexDiagnostics(self, diagnostics):
+        """Index the expected 'diagnostics' by source position.
+
+        'diagnostics' -- A sequence of expected 'Diagnostic's.
+
+        returns -- A map from pairs '(file, line)' to lists of the
+        expected diagnostics that can only match an emitted diagnostic
+        at that line of a file with that base name.  If 'file' is
+        'None', the diagnostic matches that line of any file.  The
+        diagnostics that do not give a line are in the list for 'None'.
+        The message of each diagnostic is compiled as well."""
+
+        index = {}
+        for expected in diagnostics:
+            position = expected.source_position
+            if position and position.line:
+                key = (position.file and os.path.basename(position.file)
+                       or None,
+                       position.line)
+            else:
+                key = None
+            index.setdefault(key, []).append(expected)
+            if expected.message:
+                self._GetMessageRegexp(expected.message)
+        return index
+
+
+    def _GetCandidateDiagnostics(self, index, emitted):
+        """Return the expected diagnostics that might match 'emitted'.
+
+        'index' -- A map returned by '_IndexDiagnostics'.
+
+        'emitted' -- A 'Diagnostic' emitted by the compiler.
+
+        returns -- A list of the expected diagnostics in 'index' that
+        might match 'emitted'."""
+
+        candidates = index.get(None, [])
+        position = emitted.source_position
+        if position and position.line:
+            candidates = candidates + index.get((None, position.line), [])
+            if position.file:
+                candidates = (candidates
+                              + index.get((os.path.basename(position.file),
+                                           position.line), []))
+        return candidates
+
+
     def _DiagnosticsToString(self, result, annotation, diagnostics):
         """Return a string representing the 'diagnostics'.
 
@@ -19,6 +19,8 @@
 
 import cgi
 from   dejagnu_test import DejaGNUTest
+import mmap
+import os
 import qm.fields
 from   qm.test.file_result_stream import FileResultStream
 from   qm.test.result import Result
@@ -184,20 +186,31 @@ class DejaGNUReader(FileResultReader):
             actual failures will be generated.""",
             default_value="false",
             ),
+        qm.fields.IntegerField(
+            name = "processes",
+            title = "Processes",
+            description=\
+            """The number of processes to use to read the file.
+
+            If greater than one, the file is divided into pieces at
+            the lines where DejaGNU starts running a new '.exp' file,
+            and the pieces are read by a pool of this many
+            processes.  This is only useful for very large files.
+            Each process opens the file itself, so the file is read
+            by a single process if it is not a regular file, such as
+            a pipe or a decompressed copy of a compressed file.""",
+            default_value=0,
+            ),
         ]
-            
-    __id_regexp = re.compile("^[^:]*:[\\s]*(?P<id>[^\\s]*)")
-    """A regular expression for determining test names.
 
-    When applied to an outcome line from DejaGNU, this regular
-    expression's 'id' field gives the name of the test, in the
-    combined mode."""
-    
-    __cause_regexp = re.compile("\\((?P<cause>.*)\\)\\s*$")
-    """A regular expression for determining failure causes.
+    _signature_regexp = re.compile("Test Run")
+
+    __running_marker = "\nRunning "
+    """The text at which the file may be divided into pieces."""
 
-    When applied to an outcome line from DejaGNU, this regular
-    expression's 'cause' field gives the cause of the failure."""
+    __piece_size = 1 << 22
+    """The approximate size, in bytes, of the pieces read by each
+    process."""
     
     def __init__(self, arguments = None, **args):
 
@@ -208,173 +221,332 @@ class DejaGNUReader(FileResultReader):
             raise FileResultReader.InvalidFile, \
                   "file is not a DejaGNU result stream"
         self.file.seek(0)
-        if self.__UseCombinedMode():
-            test_id, dejagnu_outcome, cause = self.__NextOutcome()
-            if test_id:
-                self.__next_result = Result(Result.TEST, test_id)
-                self.__UpdateResult(self.__next_result,
-                                    dejagnu_outcome,
-                                    cause)
+        # Scan the whole file at once, rather than line by line.  The
+        # file is mapped into memory, if possible, so that it need not
+        # be read into a string first.
+        try:
+            self.__buffer = mmap.mmap(self.file.fileno(), 0,
+                                      access = mmap.ACCESS_READ)
+        except (AttributeError, EnvironmentError, ValueError):
+            # The file may be a pipe, or empty.
+            self.__buffer = self.file.read()
+        path = self.__GetPath()
+        if self.processes > 1 and path is not None:
+            self.__results = self.__ReadInParallel(path)
+        else:
+            outcomes = _scan_outcomes(self.__buffer, 0, len(self.__buffer),
+                                      self.__UseCombinedMode())
+            self.__results = _build_results(outcomes,
+                                            self.__UseCombinedMode(),
+                                            self.__GenerateExpectations())
 
 
     def GetResult(self):
 
-        if self.__UseCombinedMode():
-            result = self.__next_result
-            if not result:
+        try:
+            return self.__results.next()
+        except StopIteration:
+            # There is no need to keep the file mapped any longer.
+            if isinstance(self.__buffer, mmap.mmap):
+                self.__buffer.close()
+                self.__buffer = ""
+            return None
+
+
+    def __GetPath(self):
+        """Return the path to the file being read.
+
+        returns -- The path to the regular file from which 'file' was
+        opened, or 'None' if there is no such file."""
+
+        if self.filename and self.filename != "-":
+            return self.filename
+        # The file may have been opened by the caller.
+        path = getattr(self.file, "name", None)
+        if not isinstance(path, str) or not os.path.isfile(path):
+            return None
+        try:
+            if not os.path.samestat(os.fstat(self.file.fileno()),
+                                    os.stat(path)):
                 return None
-            self.__next_result = None
-        else:
-            result = None
+        except (AttributeError, EnvironmentError):
+            return None
+        return path
+
+
+    def __ReadInParallel(self, path):
+        """Read the file using a pool of processes.
+
+        'path' -- The path to the file.
+
+        returns -- An iterator over the 'Result's in the file, in
+        order, as for '_build_results'."""
+
+        is_combined = self.__UseCombinedMode()
+        expectations = self.__GenerateExpectations()
+        # Divide the file into pieces, each starting at a line that
+        # begins with "Running".
+        size = len(self.__buffer)
+        boundaries = [0]
         while True:
-            test_id, dejagnu_outcome, cause = self.__NextOutcome()
-            # If there are no more results, stop.
-            if not test_id:
-                break
-            if self.__UseCombinedMode() and test_id != result.GetId():
-                self.__next_result = Result(Result.TEST, test_id)
-                self.__UpdateResult(self.__next_result,
-                                    dejagnu_outcome,
-                                    cause)
+            position = self.__buffer.find(self.__running_marker,
+                                          boundaries[-1] + self.__piece_size)
+            if position == -1:
                 break
-            elif not self.__UseCombinedMode():
-                result = Result(Result.TEST, test_id)
-            self.__UpdateResult(result, dejagnu_outcome, cause)
-            if not self.__UseCombinedMode():
-                break
-        return result
-
-
-    def __NextOutcome(self):
-        """The next DejaGNU outcome in the file.
-
-        returns -- A triplet ('test_id', 'outcome', 'cause').  The
-        'test_id' is the name of the test.  The 'outcome' is the
-        DejaGNU outcome (one of the 'DejaGNUTest.dejagnu_outcomes').
-        The 'cause' is a string giving the cause (if known) of
-        failure, if the test did not pass."""
-
-        # Assume that there are no more results in the file.
-        dejagnu_outcome = None
-        # Scan ahead until we find a line that gives data about the
-        # next result.
-        while self.file:
-            # Read the next line of the file.
-            line = self.file.next()
-            # Each test result is printed on a line by itself,
-            # beginning with the DejaGNU outcome.  For example:
-            #   PASS: g++.dg/compat/eh/template1 cp_compat_y_tst.o compile
-            dejagnu_outcome = None
-            for o in DejaGNUTest.dejagnu_outcomes:
-                # Ignore WARNING and ERROR; those are not really test
-                # results. 
-                if (o not in (DejaGNUTest.WARNING,
-                              DejaGNUTest.ERROR)
-                    and line.startswith(o)):
-                    o_len = len(o)
-                    if line[o_len:o_len + 2] == ": ":
-                        dejagnu_outcome = o
-                    break
-            if dejagnu_outcome:
-                break
-        # If we could not find any more result lines, then we have
-        # read all of the results in the file.
-        if not dejagnu_outcome:
-            return None, None, None
+            boundaries.append(position + 1)
+        boundaries.append(size)
+        pieces = [(path, boundaries[i], boundaries[i + 1],
+                   is_combined, expectations)
+                  for i in range(len(boundaries) - 1)]
+        try:
+            import multiprocessing
+        except ImportError:
+            # Without the multiprocessing module, which was added in
+            # Python 2.6, read the pieces in this process.
+            pool = None
+            pieces = map(_read_piece, pieces)
+        else:
+            pool = multiprocessing.Pool(self.processes)
+            pieces = pool.imap(_read_piece, pieces)
+            pool.close()
+        # In the combined mode, the outcomes for one test may be split
+        # across two pieces.  Each piece returns the outcomes for the
+        # first test in the piece separately so that they can be added
+        # to the last result from the previous piece.
+        pending = None
+        for head, results in pieces:
+            if head:
+                test_id = head[0][0]
+                if pending is None or pending.GetId() != test_id:
+                    if pending is not None:
+                        yield pending
+                    pending = Result(Result.TEST, test_id)
+                for test_id, dejagnu_outcome, cause in head:
+                    _update_result(pending, dejagnu_outcome, cause,
+                                   expectations)
+            if results:
+                if pending is not None:
+                    yield pending
+                results = [Result(Result.TEST, *r) for r in results]
+                for result in results[:-1]:
+                    yield result
+                pending = results[-1]
+        if pending is not None:
+            yield pending
+        if pool is not None:
+            # Wait for the processes to exit, rather than leaving them
+            # to be killed.
+            pool.join()
+
+
+    def __UseCombinedMode(self):
+        """Returns true in the combined mode.
+
+        returns -- True iff results should be read in the combined
+        mode."""
+
+        return self.is_combined == "true"
+
+
+    def __GenerateExpectations(self):
+        """Returns true if expected results should be generated.
+
+        returns -- True iff the results generated should reflect
+        expectations, rather than actual results."""
+
+        return self.expectations == "true"
+
+########################################################################
+# Functions
+########################################################################
+
+_outcome_regexp = re.compile(
+    "^(?P<outcome>%s): [^\\n]*"
+    % "|".join([o for o in DejaGNUTest.dejagnu_outcomes
+                # WARNING and ERROR are not really test results.
+                if o not in (DejaGNUTest.WARNING, DejaGNUTest.ERROR)]),
+    re.MULTILINE)
+"""A regular expression matching the lines that give test outcomes.
+
+Each test result is printed on a line by itself, beginning with the
+DejaGNU outcome.  For example:
+
+  PASS: g++.dg/compat/eh/template1 cp_compat_y_tst.o compile"""
+
+_id_regexp = re.compile("^[^:]*:[\\s]*(?P<id>[^\\s]*)")
+"""A regular expression for determining test names.
+
+When applied to an outcome line from DejaGNU, this regular
+expression's 'id' field gives the name of the test, in the combined
+mode."""
+
+_cause_regexp = re.compile("\\((?P<cause>.*)\\)\\s*$")
+"""A regular expression for determining failure causes.
+
+When applied to an outcome line from DejaGNU, this regular
+expression's 'cause' field gives the cause of the failure."""
+
+def _scan_outcomes(buffer, start, end, is_combined):
+    """Find the DejaGNU outcomes in part of a log file.
+
+    'buffer' -- A string, or memory-mapped file, containing the log.
+
+    'start' -- The offset in 'buffer' at which to start.  It must be
+    the start of a line.
+
+    'end' -- The offset in 'buffer' at which to stop.
+
+    'is_combined' -- True if the test names should be computed as for
+    the combined mode.
+
+    returns -- An iterator over triplets ('test_id', 'outcome',
+    'cause').  The 'test_id' is the name of the test.  The 'outcome'
+    is the DejaGNU outcome (one of the 'DejaGNUTest.dejagnu_outcomes').
+    The 'cause' is a string giving the cause (if known) of failure, if
+    the test did not pass."""
+
+    for match in _outcome_regexp.finditer(buffer, start, end):
+        line = match.group()
+        dejagnu_outcome = match.group("outcome")
         # Extract the name of the test.
-        if self.__UseCombinedMode():
-            match = self.__id_regexp.search(line)
-            test_id = match.group("id")
+        if is_combined:
+            test_id = _id_regexp.search(line).group("id")
         else:
             test_id = line[len(dejagnu_outcome) + 2:].strip()
-        # Extract the cause of faiulre.
+        # Extract the cause of failure.
         cause = None
         if "execution test" in line:
             cause = "Compiled program behaved incorrectly."
         elif dejagnu_outcome == DejaGNUTest.UNSUPPORTED:
             cause = "Test is not applicable on this platform."
-        elif self.__UseCombinedMode():
-            match = self.__cause_regexp.search(line)
+        elif is_combined:
+            match = _cause_regexp.search(line)
             if match:
                 cause = match.group("cause").capitalize()
                 if cause and cause[-1] != ".":
                     cause += "."
         else:
             cause = ""
-        return test_id, dejagnu_outcome, cause
-        
-    
-    def __UpdateResult(self, result, dejagnu_outcome, cause):
-        """Update 'result' as indicated.
-
-        'result' -- A 'Result', which may contain information from
-        previous DejaGNU tests, in the combined mode.
-
-        'dejagnu_outcome' -- The DejaGNU outcome (one of the
-        'DejaGNUTest.dejagnu_outcomes') that applies to this
-        'result'.
-
-        'cause' -- The cause of failure, if known.
-
-        The 'result' is modified to reflect the new outcome and
-        cause.  Results can only get worse, in the sense that if
-        reuslt has an outcome of 'Result.FAIL' upon entry to this
-        return, it will never have an outcome of 'Result.PASS' upon
-        return."""
-                       
-        # Translate the DejaGNU outcome into a QMTest outcome.
-        if self.__GenerateExpectations():
-            if dejagnu_outcome in (DejaGNUTest.KFAIL,
-                                   DejaGNUTest.KPASS,
-                                   DejaGNUTest.XFAIL,
-                                   DejaGNUTest.XPASS):
-                qmtest_outcome = Result.FAIL
-            elif dejagnu_outcome in (DejaGNUTest.UNSUPPORTED,
-                                     DejaGNUTest.UNRESOLVED):
-                qmtest_outcome = Result.UNTESTED
-            else:
-                qmtest_outcome = Result.PASS
-        else:
-            qmtest_outcome = DejaGNUTest.outcome_map[dejagnu_outcome]
-        # Update the QMTest result for this test, based on the
-        # DejaGNU result.
-        if qmtest_outcome == Result.ERROR:
-            result.SetOutcome(Result.ERROR)
-        elif (qmtest_outcome == Result.UNTESTED
-              and result.GetOutcome() != Result.ERROR):
-            result.SetOutcome(Result.UNTESTED)
-        elif (qmtest_outcome == Result.FAIL
-              and result.GetOutcome() not in (Result.ERROR,
-                                              Result.UNTESTED)):
-            result.SetOutcome(Result.FAIL)
-        if qmtest_outcome != Result.PASS and cause:
-            old_cause = result.GetCause()
-            if old_cause and cause in old_cause:
-                # Don't repeat the same cause multiple times.
-                pass
-            else:
-                if old_cause:
-                    old_cause += "  "
-                old_cause += cgi.escape(cause)
-                result.SetCause(old_cause)
+        yield test_id, dejagnu_outcome, cause
 
 
-    def __UseCombinedMode(self):
-        """Returns true in the combined mode.
+def _update_result(result, dejagnu_outcome, cause, expectations):
+    """Update 'result' as indicated.
 
-        returns -- True iff results should be read in the combined
-        mode."""
+    'result' -- A 'Result', which may contain information from
+    previous DejaGNU tests, in the combined mode.
 
-        return self.is_combined == "true"
+    'dejagnu_outcome' -- The DejaGNU outcome (one of the
+    'DejaGNUTest.dejagnu_outcomes') that applies to this 'result'.
 
+    'cause' -- The cause of failure, if known.
 
-    def __GenerateExpectations(self):
-        """Returns true if expected results should be generated.
+    'expectations' -- True if the outcome should reflect the expected
+    outcome, rather than the actual one.
 
-        returns -- True iff the results generated should reflect
-        expectations, rather than actual results."""
+    The 'result' is modified to reflect the new outcome and cause.
+    Results can only get worse, in the sense that if reuslt has an
+    outcome of 'Result.FAIL' upon entry to this return, it will never
+    have an outcome of 'Result.PASS' upon return."""
 
-        return self.expectations == "true"
+    # Translate the DejaGNU outcome into a QMTest outcome.
+    if expectations:
+        if dejagnu_outcome in (DejaGNUTest.KFAIL,
+                               DejaGNUTest.KPASS,
+                               DejaGNUTest.XFAIL,
+                               DejaGNUTest.XPASS):
+            qmtest_outcome = Result.FAIL
+        elif dejagnu_outcome in (DejaGNUTest.UNSUPPORTED,
+                                 DejaGNUTest.UNRESOLVED):
+            qmtest_outcome = Result.UNTESTED
+        else:
+            qmtest_outcome = Result.PASS
+    else:
+        qmtest_outcome = DejaGNUTest.outcome_map[dejagnu_outcome]
+    # Update the QMTest result for this test, based on the DejaGNU
+    # result.
+    if qmtest_outcome == Result.ERROR:
+        result.SetOutcome(Result.ERROR)
+    elif (qmtest_outcome == Result.UNTESTED
+          and result.GetOutcome() != Result.ERROR):
+        result.SetOutcome(Result.UNTESTED)
+    elif (qmtest_outcome == Result.FAIL
+          and result.GetOutcome() not in (Result.ERROR,
+                                          Result.UNTESTED)):
+        result.SetOutcome(Result.FAIL)
+    if qmtest_outcome != Result.PASS and cause:
+        old_cause = result.GetCause()
+        if old_cause and cause in old_cause:
+            # Don't repeat the same cause multiple times.
+            pass
+        else:
+            if old_cause:
+                old_cause += "  "
+            old_cause += cgi.escape(cause)
+            result.SetCause(old_cause)
+
+
+def _build_results(outcomes, is_combined, expectations):
+    """Build the 'Result's for a sequence of DejaGNU outcomes.
+
+    'outcomes' -- An iterable of outcomes, as for '_scan_outcomes'.
+
+    'is_combined' -- True if consecutive outcomes for the same test
+    should be combined into a single 'Result'.
+
+    'expectations' -- As for '_update_result'.
+
+    returns -- An iterator over the 'Result's."""
+
+    result = None
+    for test_id, dejagnu_outcome, cause in outcomes:
+        if not is_combined or result is None or result.GetId() != test_id:
+            if result is not None:
+                yield result
+            result = Result(Result.TEST, test_id)
+        _update_result(result, dejagnu_outcome, cause, expectations)
+    if result is not None:
+        yield result
+
+
+def _read_piece(piece):
+    """Read the 'Result's in a piece of a log file.
+
+    'piece' -- A tuple '(filename, start, end, is_combined,
+    expectations)'.  The outcomes are read from the part of the file
+    named 'filename' between 'start' and 'end'.
+
+    returns -- A pair '(head, results)'.  In the combined mode, the
+    'head' is the list of outcomes for the first test in the piece, as
+    for '_scan_outcomes'; otherwise, it is empty.  The 'results' is a
+    list of triples '(test_id, outcome, annotations)' giving the
+    'Result's for the remaining outcomes, as for '_build_results'.
+    Passing the triples back to the parent process is much cheaper
+    than passing the 'Result's themselves.
+
+    This function is run in the processes created by
+    'DejaGNUReader'."""
+
+    filename, start, end, is_combined, expectations = piece
+    f = open(filename, "rb")
+    try:
+        buffer = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        try:
+            outcomes = list(_scan_outcomes(buffer, start, end, is_combined))
+        finally:
+            buffer.close()
+    finally:
+        f.close()
+    head = []
+    if is_combined:
+        for outcome in outcomes:
+            if outcome[0] != outcomes[0][0]:
+                break
+            head.append(outcome)
+    results = [(r.GetId(), r.GetOutcome(), dict(r.items()))
+               for r in _build_results(outcomes[len(head):], is_combined,
+                                       expectations)]
+    return head, results
 
 ########################################################################
 # Miscellaneous
@@ -24,6 +24,7 @@ from   qm.common import QMException
 from   qm.executable import RedirectedExecutable
 from   qm.test.test import Test
 from   qm.test.result import Result
+import re
 
 ########################################################################
 # Classes
@@ -78,6 +79,27 @@ class DejaGNUTest(Test, DejaGNUBase):
     executable_timeout = 300
     """The number of seconds a program is permitted to run on the target."""
 
+    __tcl_quoted_regexp = re.compile(r'{([^{}\\]*)}|"([^"$[\\]*)"')
+    """A regular expression matching a simple quoted Tcl string.
+
+    A simple quoted string is either a brace-quoted string that
+    contains no braces or backslashes, or a double-quoted string that
+    contains no substitutions or backslashes.  The contents of the
+    string are in the first or second group, respectively."""
+
+    __tcl_word_regexp \
+        = re.compile(r'(?:[^ \t$[\\"{}]|%s)+'
+                     % __tcl_quoted_regexp.pattern.replace("(", "(?:"))
+    """A regular expression matching a simple Tcl word.
+
+    A simple word contains no substitutions or backslashes, except in
+    simple quoted strings."""
+
+    __tcl_simple_regexp \
+        = re.compile(r"[ \t]*(?:(?:%s)(?:[ \t]+|\Z))*\Z"
+                     % __tcl_word_regexp.pattern)
+    """A regular expression matching a string of simple Tcl words."""
+
     RESULT_PREFIX = "DejaGNUTest.result_"
     """The prefix for DejaGNU result annotations.
 
@@ -297,6 +319,12 @@ class DejaGNUTest(Test, DejaGNUBase):
         1994 by Addison-Wesley Publishing Company, Inc. for details
         about the syntax of Tcl."""
 
+        # Most strings contain only simple words, which can be split
+        # without examining each character in turn.
+        if self.__tcl_simple_regexp.match(s):
+            return [self.__tcl_quoted_regexp.sub(_unquote_tcl_string, w)
+                    for w in self.__tcl_word_regexp.findall(s)]
+
         # There are no words yet.
         words = []
         # There is no current word.
@@ -455,3 +483,16 @@ class DejaGNUTest(Test, DejaGNUBase):
             words.append(word)
 
         return words
+
+########################################################################
+# Functions
+########################################################################
+
+def _unquote_tcl_string(match):
+    """Return the contents of a quoted Tcl string.
+
+    'match' -- A match of 'DejaGNUTest.__tcl_quoted_regexp'.
+
+    returns -- The contents of the string."""
+
+    return match.group(1) or match.group(2) or ""
@@ -17,9 +17,12 @@
 # Imports
 ########################################################################
 
+import cPickle
 from   dejagnu_test import DejaGNUTest
 import fnmatch
 import os
+import qm.common
+from   qm.common import md5
 from   qm.test.result import Result
 from   qm.fields import BooleanField
 import re
@@ -126,7 +129,6 @@ class DGTest(DejaGNUTest):
         self._excess_errors_expected = False
         self._final_commands = []
         # Iterate through the test looking for embedded commands.
-        line_num = 0
         if not path:
             path = self._GetSourcePath()
         root = self.GetDatabase().GetRoot()
@@ -135,14 +137,10 @@ class DGTest(DejaGNUTest):
         else:
             # We prepend "./" for output compatibility with DejaGNU.
             self._name = os.path.join(".", os.path.basename(path))
-        for l in open(path).xreadlines():
-            line_num += 1
-            m = self.__dg_command_regexp.search(l)
-            if m:
-                f = getattr(self, "_DG" + m.group(1).replace("-", "_"))
-                args = self._ParseTclWords(m.group(2),
-                                           { "srcdir" : root })
-                f(line_num, args, context)
+        for line_num, command, args in self.__GetCommands(path, root,
+                                                          context):
+            f = getattr(self, "_DG" + command.replace("-", "_"))
+            f(line_num, list(args), context)
 
         # If this test does not need to be run on this target, stop.
         if self._selected == 0:
@@ -171,6 +169,55 @@ class DGTest(DejaGNUTest):
             except:
                 pass
 
+
+    def __GetCommands(self, path, root, context):
+        """Return the commands embedded in a test file.
+
+        'path' -- The path to the test file.
+
+        'root' -- The root of the test database, which is the value
+        of the Tcl 'srcdir' variable.
+
+        'context' -- The 'Context' in which this test is running.
+
+        returns -- A list of triples '(line_num, command, args)'.  The
+        'command' is the name of the command, without the 'dg-'
+        prefix, and 'args' is the list of its arguments.
+
+        The commands do not depend on the target, so they are found
+        only once for each version of the file.  If the
+        'DGTest.command_cache' context variable is set, it names a
+        directory in which the commands are kept across test runs."""
+
+        key = (path, root)
+        info = os.stat(path)
+        stamp = (info.st_mtime, info.st_size)
+        entry = _commands.get(key)
+        if entry is not None and entry[0] == stamp:
+            return entry[1]
+        cache_path = None
+        commands = None
+        if context.has_key("DGTest.command_cache"):
+            name = md5(repr(key)).hexdigest()
+            cache_path = os.path.join(context["DGTest.command_cache"],
+                                      name[:2], name)
+            commands = _load_commands(cache_path, key, stamp)
+        if commands is None:
+            commands = []
+            line_num = 0
+            for l in open(path).xreadlines():
+                line_num += 1
+                m = self.__dg_command_regexp.search(l)
+                if m:
+                    args = self._ParseTclWords(m.group(2),
+                                               { "srcdir" : root })
+                    commands.append((line_num, m.group(1), args))
+            if cache_path is not None:
+                _store_commands(cache_path, key, stamp, commands)
+        _commands[key] = (stamp, commands)
+        return commands
+
+
     def _RunDGToolPortion(self, path, tool_flags, context, result):
         """Perform the tool-running portions of a DG test.
 
@@ -524,3 +571,68 @@ class DGTest(DejaGNUTest):
             else:
                 return "P"
         
+
+########################################################################
+# Variables
+########################################################################
+
+_commands = {}
+"""A map from '(path, root)' pairs to the commands in test files.
+
+Each value is a pair '(stamp, commands)'.  The 'stamp' is a pair
+giving the modification time and size of the file when the
+'commands' were found."""
+
+########################################################################
+# Functions
+########################################################################
+
+def _load_commands(path, key, stamp):
+    """Load commands stored by '_store_commands'.
+
+    'path' -- The path to the file containing the commands.
+
+    'key' -- The '(path, root)' pair for the test file.
+
+    'stamp' -- The modification time and size of the test file.
+
+    returns -- The list of commands, or 'None' if the file does not
+    exist or does not match 'key' and 'stamp'."""
+
+    try:
+        f = open(path, "rb")
+    except IOError:
+        return None
+    try:
+        try:
+            stored_key, stored_stamp, commands = cPickle.load(f)
+        except:
+            # A damaged file is treated as if it were not present.
+            return None
+    finally:
+        f.close()
+    if stored_key != key or stored_stamp != stamp:
+        return None
+    return commands
+
+
+def _store_commands(path, key, stamp, commands):
+    """Store commands for later use by '_load_commands'.
+
+    'path' -- The path to the file in which to store the commands.
+
+    'key' -- The '(path, root)' pair for the test file.
+
+    'stamp' -- The modification time and size of the test file.
+
+    'commands' -- The list of commands in the test file.
+
+    Failures are ignored; the commands will simply be found again the
+    next time they are needed."""
+
+    try:
+        qm.common.write_file_atomically(
+            path, lambda f: cPickle.dump((key, stamp, commands), f,
+                                         cPickle.HIGHEST_PROTOCOL))
+    except EnvironmentError:
+        pass
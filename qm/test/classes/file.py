@@ -85,6 +85,8 @@ class FileContentsTest(Test):
     pattern matches replaced with the corresponding substitutions,
     before the comparison is performed."""
 
+    idempotent = 1
+
     arguments = [
         qm.fields.TextField(
             name="path_property",
@@ -17,7 +17,9 @@
 
 import types
 import cPickle
+import os
 import struct
+import qm.common
 import qm.fields
 from   qm.test.file_result_stream import FileResultStream
 from   qm.test.file_result_reader import FileResultReader
@@ -113,6 +115,17 @@ class PickleResultStream(FileResultStream):
             """,
             default_value = 1,
         ),
+        qm.fields.BooleanField(
+            name = "append",
+            description = """True if results should be added to the file.
+
+            If true, and the file already contains results, the new
+            results and annotations are added after the existing ones.
+            Anything after the last complete result or annotation, such
+            as a result that was being written when QMTest was killed,
+            is discarded.""",
+            default_value = "false",
+        ),
     ]
 
     _is_binary_file = 1
@@ -126,6 +139,12 @@ class PickleResultStream(FileResultStream):
         # We haven't processed any `Result's yet.
         self.__processed = 0
 
+        if self.append == "true":
+            self.file.seek(0, 2)
+            if self.file.tell() > 0:
+                # Continue the existing file.
+                self.__last_annotation = self.__FindEnd()
+                return
         # Write out version number.
         self.__pickler.dump(self._format_version)
         # We have no previous annotations.
@@ -134,6 +153,62 @@ class PickleResultStream(FileResultStream):
         self._WriteAnnotationPtr()
 
 
+    def _GetFileMode(self):
+
+        if (self.append == "true" and self.filename
+            and os.path.exists(self.filename)):
+            return "r+b"
+        return super(PickleResultStream, self)._GetFileMode()
+
+
+    def __FindEnd(self):
+        """Prepare to add results to the end of the file.
+
+        returns -- The address of the last annotation pointer in the
+        file.
+
+        The file is truncated after the last complete result or
+        annotation, and the file position is left at the end of the
+        file."""
+
+        self.file.seek(0)
+        unpickler = cPickle.Unpickler(self.file)
+        try:
+            version = unpickler.load()
+        except (EOFError, cPickle.UnpicklingError):
+            version = None
+        if version != self._format_version:
+            raise qm.common.QMException, \
+                  "cannot append to results in this format"
+        last_annotation = self.file.tell()
+        self.file.seek(_int_size, 1)
+        end = self.file.tell()
+        while 1:
+            try:
+                thing = unpickler.load()
+                if thing is _annotation_sentinel:
+                    # An annotation starts a new pickle, after its
+                    # pointer.
+                    address = self.file.tell()
+                    if len(self.file.read(_int_size)) != _int_size:
+                        break
+                    unpickler = cPickle.Unpickler(self.file)
+                    unpickler.load()
+                    last_annotation = address
+            except Exception:
+                # A partially written pickle may cause almost any
+                # exception.
+                break
+            end = self.file.tell()
+        # The last pointer may refer to an annotation that was not
+        # completely written.
+        self.file.seek(last_annotation)
+        self.file.write(struct.pack(_int_format, 0))
+        self.file.truncate(end)
+        self.file.seek(end)
+        return last_annotation
+
+
     def _ResetPickler(self):
 
         self.__pickler = cPickle.Pickler(self.file, self.protocol_version)
@@ -224,12 +299,16 @@ class PickleResultReader(FileResultReader):
         while addr:
             # Go the the address.
             self.file.seek(addr)
-            # First four bytes are the next address.
-            addr = self._ReadAddress()
-            # Then we restart the pickle stream...
-            self._ResetUnpickler()
-            # ...and read in the annotation here.
-            annotation_tuple = self.__unpickler.load()
+            try:
+                # First four bytes are the next address.
+                addr = self._ReadAddress()
+                # Then we restart the pickle stream...
+                self._ResetUnpickler()
+                # ...and read in the annotation here.
+                annotation_tuple = self.__unpickler.load()
+            except (EOFError, struct.error, cPickle.UnpicklingError):
+                # QMTest was stopped while writing this annotation.
+                break
             kind = annotation_tuple[0]
             if kind == "annotation":
                 (key, value) = annotation_tuple[1:]
@@ -260,6 +339,13 @@ class PickleResultReader(FileResultReader):
                 # Instead, the unpickler raises UnpicklingError when it
                 # tries to unpickle the empty string.
                 return None
+            except:
+                # A result that was only partly written, because
+                # QMTest was stopped, may cause almost any exception.
+                # Other problems are reported.
+                if self.file.read(1):
+                    raise
+                return None
             else:
                 if thing is _annotation_sentinel:
                     # We're looking for results, but this is an annotation,
@@ -268,7 +354,12 @@ class PickleResultReader(FileResultReader):
                     self.file.seek(_int_size, 1)
                     self._ResetUnpickler()
                     # ...and the annotation itself.
-                    self.__unpickler.noload()
+                    try:
+                        self.__unpickler.noload()
+                    except (EOFError, cPickle.UnpicklingError):
+                        # QMTest was stopped while writing this
+                        # annotation.
+                        return None
                     # Now loop.
                 else:
                     # We actually got a 'Result'.
@@ -18,6 +18,8 @@
 import cPickle
 import os
 import qm.executable
+import signal
+from   qm.temporary_directory import TemporaryDirectory
 import qm.test.cmdline
 from   qm.test.target import *
 
@@ -57,6 +59,20 @@ class ProcessTarget(Target):
             A string giving the file name of the 'qmtest' executable
             program.  This path is used to invoke QMTest.""",
             default_value=""),
+        qm.fields.BooleanField(
+            name="shared_resources",
+            title="Shared Resources",
+            description="""True if resources should be shared by processes.
+
+            If false, each process sets up the resources needed by the
+            tests it runs, so a resource may be set up once in every
+            process.  If true, each resource is set up only once, by
+            QMTest itself, and the context properties it provides are
+            passed to all of the processes.  The resource is cleaned
+            up when the target stops, after all of the processes have
+            exited.  Use this option only if the resources can be
+            used from all of the processes.""",
+            default_value="false"),
         ]
 
     class QMTestExecutable(qm.executable.Executable):
@@ -103,6 +119,28 @@ class ProcessTarget(Target):
         return self.__idle_children
 
 
+    def GetCapacity(self):
+        """Return the number of slots available on this target.
+
+        returns -- The number of child processes, each of which runs
+        one test at a time."""
+
+        return self.processes
+
+
+    def HasResource(self, resource_name):
+        """Return true if a resource has been set up on this target.
+
+        'resource_name' -- A string naming a resource.
+
+        returns -- True if the resource has been set up, either by
+        this target itself or in at least one of the child
+        processes."""
+
+        return (Target.HasResource(self, resource_name)
+                or self.__child_resources.has_key(resource_name))
+
+
     def Start(self, response_queue, engine=None):
         """Start the target.
         
@@ -120,6 +158,22 @@ class ProcessTarget(Target):
         self.__idle_children = []
         self.__busy_children = []
         self.__children_by_fd = {}
+        # A map from child process IDs to the names of the tests they
+        # are running.
+        self.__tests_by_child = {}
+        self.__engine = engine
+        # A map from child process IDs to maps whose keys are the
+        # names of the resources set up in that child.
+        self.__resources_by_child = {}
+        # A map whose keys are the names of the resources set up in
+        # any child.
+        self.__child_resources = {}
+        # Shared resources are set up in this process, and need a
+        # temporary directory of their own.
+        if self.shared_resources == "true":
+            self.__temporary_directory = TemporaryDirectory()
+        else:
+            self.__temporary_directory = None
         
         # Determine the test database path to use.
         database_path = self.database_path
@@ -137,29 +191,36 @@ class ProcessTarget(Target):
             if not qmtest_path:
                 qmtest_path = "/usr/local/bin/qmtest"
         # Construct the command we want to invoke.
-        arg_list = (self._GetInterpreter() +
-                    [ qmtest_path, '-D', database_path, "remote" ])
+        self.__arg_list = (self._GetInterpreter() +
+                           [ qmtest_path, '-D', database_path, "remote" ])
 
         # Create the subprocesses.
         for x in xrange(self.processes):
-            # Create two pipes: one to write commands to the remote
-            # QMTest, and one to read responses.
-            e = ProcessTarget.QMTestExecutable()
-            child_pid = e.Spawn(arg_list)
-            
-            # Close the read end of the command pipe.
-            os.close(e.command_pipe[0])
-            # And the write end of the response pipe.
-            os.close(e.response_pipe[1])
-
-            # Remember the child.
-            child = (child_pid,
-                     os.fdopen(e.response_pipe[0], "r"),
-                     os.fdopen(e.command_pipe[1], "w", 0))
-            self.__children.append(child)
-            self.__idle_children.append(child)
-            self.__children_by_fd[e.response_pipe[0]] = child
-            engine.AddInputHandler(e.response_pipe[0], self.__ReadResults)
+            self.__SpawnChild()
+
+
+    def __SpawnChild(self):
+        """Create a new child process, ready to run tests."""
+
+        # Create two pipes: one to write commands to the remote
+        # QMTest, and one to read responses.
+        e = ProcessTarget.QMTestExecutable()
+        child_pid = e.Spawn(self.__arg_list)
+
+        # Close the read end of the command pipe.
+        os.close(e.command_pipe[0])
+        # And the write end of the response pipe.
+        os.close(e.response_pipe[1])
+
+        # Remember the child.
+        child = (child_pid,
+                 os.fdopen(e.response_pipe[0], "r"),
+                 os.fdopen(e.command_pipe[1], "w", 0))
+        self.__children.append(child)
+        self.__idle_children.append(child)
+        self.__resources_by_child[child_pid] = {}
+        self.__children_by_fd[e.response_pipe[0]] = child
+        self.__engine.AddInputHandler(e.response_pipe[0], self.__ReadResults)
 
 
     def Stop(self):
@@ -192,12 +253,35 @@ class ProcessTarget(Target):
 
         'context' -- The 'Context' in which to run the test."""
 
-        # Use the child process at the head of the list.
-        child = self.__idle_children.pop(0)
+        # Set up shared resources before handing the test to a child.
+        if self.shared_resources == "true":
+            shared = self.__SetUpSharedResources(descriptor, context)
+            if shared is None:
+                return
+        else:
+            shared = {}
+            
+        # Prefer a child process in which the resources needed by the
+        # test have already been set up.  Otherwise, use the child
+        # process at the head of the list.
+        child = self.__idle_children[0]
+        resources = descriptor.GetResources()
+        if resources:
+            for c in self.__idle_children:
+                child_resources = self.__resources_by_child[c[0]]
+                for resource in resources:
+                    if not child_resources.has_key(resource):
+                        break
+                else:
+                    child = c
+                    break
+        self.__idle_children.remove(child)
         self.__busy_children.append(child)
+        self.__tests_by_child[child[0]] = descriptor.GetId()
         # Write the test to the file.
         try:
-            cPickle.dump(("RunTest", descriptor.GetId(), context),
+            cPickle.dump(("RunTest", descriptor.GetId(), context,
+                          shared),
                          child[2])
         except:
             # We could not write to the child.  (One situation in
@@ -206,9 +290,98 @@ class ProcessTarget(Target):
             result = Result(Result.TEST, descriptor.GetId())
             result.NoteException()
             self._RecordResult(result)
+            self.__busy_children.remove(child)
             self.__idle_children.append(child)
             
 
+    def CancelTest(self, test_id):
+        """Stop running the test given by 'test_id'.
+
+        'test_id' -- The name of a test that was given to 'RunTest'.
+
+        The child process running the test is killed, and a new child
+        process is created to take its place."""
+
+        for child in self.__busy_children:
+            if self.__tests_by_child.get(child[0]) == test_id:
+                break
+        else:
+            return
+        self.__busy_children.remove(child)
+        del self.__tests_by_child[child[0]]
+        fd = child[1].fileno()
+        del self.__children_by_fd[fd]
+        if self.__engine:
+            self.__engine.RemoveInputHandler(fd)
+        try:
+            os.kill(child[0], signal.SIGKILL)
+        except OSError:
+            pass
+        child[1].close()
+        child[2].close()
+        os.waitpid(child[0], 0)
+        self.__children.remove(child)
+        # Forget the resources that were set up in the child.
+        del self.__resources_by_child[child[0]]
+        self.__child_resources = {}
+        for resources in self.__resources_by_child.values():
+            self.__child_resources.update(resources)
+        # Replace the child, so that the target does not lose
+        # capacity.
+        self.__SpawnChild()
+        
+
+    def _GetTemporaryDirectory(self):
+        """Return the temporary directory for resources set up here.
+
+        returns -- The path to a directory used by the resources that
+        are set up in this process, rather than in a child.  The
+        directory is created the first time it is needed."""
+
+        if self.__temporary_directory is None:
+            self.__temporary_directory = TemporaryDirectory()
+        return self.__temporary_directory.GetPath()
+
+
+    def __SetUpSharedResources(self, descriptor, context):
+        """Set up the resources needed by 'descriptor' in this process.
+
+        'descriptor' -- The 'TestDescriptor' for the test that is
+        about to be run.
+
+        'context' -- The 'Context' in which the test will be run.
+
+        returns -- A map from resource names to the context properties
+        provided by those resources, or 'None' if one of the
+        resources could not be set up.  In the latter case, an
+        'UNTESTED' result has been recorded for the test."""
+
+        resources = {}
+        if not descriptor.GetResources():
+            return resources
+        
+        # Augment the context just as 'Target.RunTest' would.
+        context = Context(context)
+        context[context.TARGET_CONTEXT_PROPERTY] = self.GetName()
+        context[context.TMPDIR_CONTEXT_PROPERTY] \
+            = self._GetTemporaryDirectory()
+        context[context.DB_PATH_CONTEXT_PROPERTY] \
+            = descriptor.GetDatabase().GetPath()
+        for resource in descriptor.GetResources():
+            (r, outcome, properties) \
+                = self._SetUpResource(resource, context)
+            if outcome != Result.PASS:
+                result = Result(Result.TEST, descriptor.GetId())
+                result.SetOutcome(Result.UNTESTED)
+                result[Result.CAUSE] = qm.message("failed resource")
+                result[Result.RESOURCE] = resource
+                self._RecordResult(result)
+                return None
+            resources[resource] = properties
+
+        return resources
+
+
     def _GetInterpreter(self):
         """Return the interpreter to use.
 
@@ -230,8 +403,16 @@ class ProcessTarget(Target):
             results = cPickle.load(child[1])
             idle = None
             for result in results:
+                # Remember which resources have been set up in this
+                # child.
+                if result.GetKind() == Result.RESOURCE_SETUP:
+                    self.__resources_by_child[child[0]][result.GetId()] \
+                        = None
+                    self.__child_resources[result.GetId()] = None
                 self._RecordResult(result)
                 if not idle and result.GetKind() == Result.TEST:
+                    if self.__tests_by_child.has_key(child[0]):
+                        del self.__tests_by_child[child[0]]
                     self.__idle_children.append(child)
                     self.__busy_children.remove(child)
                     idle = 1
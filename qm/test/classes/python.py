@@ -19,7 +19,12 @@
 # imports
 ########################################################################
 
+import imp
+import marshal
+import os
 import qm
+import qm.common
+from   qm.common import md5
 import qm.fields
 import qm.test.base
 from   qm.test.result import *
@@ -84,7 +89,8 @@ class ExecTest(Test):
         global_namespace, local_namespace = make_namespaces(context)
         # Execute the source code.
         try:
-            exec self.source in global_namespace, local_namespace
+            code = compile_source(self.source, "exec", context)
+            exec code in global_namespace, local_namespace
         except:
             # The source raised an unhandled exception, so the test
             # fails
@@ -95,8 +101,8 @@ class ExecTest(Test):
             if self.expression is not None:
                 # Yes; evaluate it.
                 try:
-                    value = eval(self.expression,
-                                 global_namespace, local_namespace)
+                    code = compile_source(self.expression, "eval", context)
+                    value = eval(code, global_namespace, local_namespace)
                 except:
                     # Oops, an exception while evaluating the
                     # expression.  The test fails.
@@ -150,15 +156,18 @@ class BaseExceptionTest(Test):
 
         # Adjust the exception argument.
         if string.strip(self.exception_argument) != "":
-            self.exception_argument = eval(self.exception_argument, {}, {})
+            code = compile_source(self.exception_argument, "eval", context)
+            self.exception_argument = eval(code, {}, {})
             self.has_exception_argument = 1
         else:
             self.has_exception_argument = 0
             
         global_namespace, local_namespace = make_namespaces(context)
         try:
-            # Execute the test code.
-            exec self.source in global_namespace, local_namespace
+            # Execute the test code.  Compiling it is part of the test,
+            # since the test may expect a 'SyntaxError'.
+            code = compile_source(self.source, "exec", context)
+            exec code in global_namespace, local_namespace
         except:
             exc_info = sys.exc_info()
             # Check the exception argument.
@@ -307,10 +316,100 @@ class StringExceptionTest(BaseExceptionTest):
         
 
 
+########################################################################
+# variables
+########################################################################
+
+_code_objects = {}
+"""A map from '(mode, source)' pairs to compiled code objects.
+
+Tests that are run in the same process share the code compiled by
+'compile_source'."""
+
 ########################################################################
 # functions
 ########################################################################
 
+def compile_source(source, mode, context = None):
+    """Compile Python source code, reusing earlier compilations.
+
+    'source' -- A string containing the Python source code.
+
+    'mode' -- Either "exec", if 'source' contains statements, or
+    "eval", if it is an expression.
+
+    'context' -- The test context, or 'None'.  If the
+    'python.code_cache' context variable is set, it names a directory
+    in which compiled code is kept across test runs, in the same way
+    that Python keeps '.pyc' files.
+
+    returns -- A code object for 'source', which can be passed to
+    'exec' or 'eval'.  Raises 'SyntaxError' if 'source' is not valid
+    Python code."""
+
+    key = (mode, source)
+    code = _code_objects.get(key)
+    if code is None:
+        path = None
+        if context is not None and context.has_key("python.code_cache"):
+            name = md5(repr(key)).hexdigest()
+            path = os.path.join(context["python.code_cache"],
+                                name[:2], name + ".pyc")
+            code = _load_code(path)
+        if code is None:
+            code = compile(source, "<string>", mode)
+            if path is not None:
+                _store_code(path, code)
+        _code_objects[key] = code
+    return code
+
+
+def _load_code(path):
+    """Load a code object stored by '_store_code'.
+
+    'path' -- The path to the file containing the code.
+
+    returns -- The code object, or 'None' if the file does not exist,
+    or was not written by this version of Python."""
+
+    try:
+        f = open(path, "rb")
+        try:
+            data = f.read()
+        finally:
+            f.close()
+    except IOError:
+        return None
+    magic = imp.get_magic()
+    if data[:len(magic)] != magic:
+        return None
+    try:
+        return marshal.loads(data[len(magic):])
+    except (EOFError, ValueError, TypeError):
+        # A damaged file is treated as if it were not present.
+        return None
+
+
+def _store_code(path, code):
+    """Store a code object for later use by '_load_code'.
+
+    'path' -- The path to the file in which to store the code.
+
+    'code' -- The code object.
+
+    Failures are ignored; the code will simply be compiled again the
+    next time it is needed."""
+
+    def write(f):
+        f.write(imp.get_magic())
+        marshal.dump(code, f)
+    try:
+        qm.common.write_file_atomically(path, write)
+    except EnvironmentError:
+        pass
+
+
+
 def make_namespaces(context):
     """Construct namespaces for eval/exec of Python test code.
 
@@ -0,0 +1,625 @@
+########################################################################
+#
+# File:   socket_target.py
+# Author: agent
+# Date:   2026-10-19
+#
+# Contents:
+#   SocketTarget, SocketWorker
+#
+# Copyright (c) 2026 by CodeSourcery, LLC.  All rights reserved.
+#
+# For license terms see the file COPYING.
+#
+########################################################################
+
+########################################################################
+# Imports
+########################################################################
+
+import cPickle
+import errno
+import os
+import qm.executable
+import qm.test.base
+import qm.test.cmdline
+from   qm.test.target import *
+import Queue
+import select
+import socket
+import struct
+from   threading import Lock, Thread
+import time
+
+########################################################################
+# Functions
+########################################################################
+
+def _send_message(sock, message):
+    """Send 'message' over 'sock'.
+
+    'sock' -- A connected socket.
+
+    'message' -- Any object that can be pickled."""
+
+    data = cPickle.dumps(message, cPickle.HIGHEST_PROTOCOL)
+    sock.sendall(struct.pack("!I", len(data)) + data)
+
+########################################################################
+# Classes
+########################################################################
+
+class _MessageReader(object):
+    """A '_MessageReader' collects the messages arriving on a socket.
+
+    Each message is a pickle, preceded by its length."""
+
+    def __init__(self, sock):
+        """Construct a new '_MessageReader'.
+
+        'sock' -- The socket from which messages will be read."""
+
+        self.__socket = sock
+        self.__buffer = ""
+
+
+    def Read(self):
+        """Read the data available on the socket.
+
+        returns -- A list of the complete messages received, or 'None'
+        if the connection has been closed.  This method should only be
+        called when the socket is readable."""
+
+        try:
+            data = self.__socket.recv(65536)
+        except socket.error:
+            return None
+        if not data:
+            return None
+        self.__buffer += data
+        messages = []
+        while len(self.__buffer) >= 4:
+            length = struct.unpack("!I", self.__buffer[:4])[0]
+            if len(self.__buffer) < 4 + length:
+                break
+            messages.append(cPickle.loads(self.__buffer[4:4 + length]))
+            self.__buffer = self.__buffer[4 + length:]
+        return messages
+
+
+
+class SocketTarget(Target):
+    """A 'SocketTarget' runs tests on workers that connect over TCP.
+
+    A worker is started with 'qmtest worker --connect HOST:PORT'.  It
+    registers the number of tests it can run at once, and then asks
+    for tests whenever it has free slots.  Results are sent back as
+    soon as they are available.  Workers that have nothing else to
+    send send heartbeats; if a worker disconnects, or stops sending
+    heartbeats, the tests it was running are given to other
+    workers.
+
+    The messages exchanged with workers are pickles, so workers
+    must only be run on trusted networks."""
+
+    arguments = [
+        qm.fields.TextField(
+            name="address",
+            title="Address",
+            description="""The address on which to listen for workers.
+
+            Use the empty string to accept workers on all of the
+            network interfaces of this computer.  By default, only
+            workers on this computer can connect.""",
+            default_value="127.0.0.1"),
+        qm.fields.IntegerField(
+            name="port",
+            title="Port",
+            description="""The port on which to listen for workers.
+
+            If zero, any free port is used.  That is useful only if
+            all of the workers are started by the target itself.""",
+            default_value=0),
+        qm.fields.IntegerField(
+            name="local_workers",
+            title="Local Workers",
+            description="""The number of workers to start on this computer.
+
+            These workers are started when the target starts, and
+            connect to it automatically.""",
+            default_value=0),
+        qm.fields.IntegerField(
+            name="worker_threads",
+            title="Worker Threads",
+            description="""The number of tests each local worker runs at once.""",
+            default_value=1),
+        qm.fields.IntegerField(
+            name="heartbeat",
+            title="Heartbeat Interval",
+            description="""The number of seconds between heartbeats.
+
+            A worker from which nothing has been heard for three
+            heartbeat intervals is assumed to have been lost.""",
+            default_value=5),
+        qm.fields.IntegerField(
+            name="worker_timeout",
+            title="Worker Timeout",
+            description="""The number of seconds to wait for a worker.
+
+            If tests are waiting to be run and no worker has been
+            connected for this many seconds, the tests are reported
+            as errors.""",
+            default_value=60),
+        qm.fields.TextField(
+            name="database_path",
+            title="Database Path",
+            description="""The path to the test database.
+
+            A string giving the directory containing the test
+            database, used by local workers.  If this value is the
+            empty string, QMTest uses the path provided on the command
+            line.""",
+            default_value=""),
+        qm.fields.TextField(
+            name="qmtest",
+            title="QMTest Path",
+            description="""The path to the QMTest executable.
+
+            A string giving the file name of the 'qmtest' executable
+            program.  This path is used to start local workers.""",
+            default_value=""),
+        ]
+
+    __ATTEMPTS = 2
+    """The number of workers that may be lost while running a test.
+
+    A test that has been running on this many lost workers is
+    reported as an error, rather than being given to another
+    worker."""
+
+    class __Worker(object):
+        """A '__Worker' records the state of a connected worker."""
+
+        def __init__(self, sock, address):
+
+            self.socket = sock
+            self.address = address
+            self.reader = _MessageReader(sock)
+            # The number of tests the worker can run at once.  This is
+            # zero until the worker has registered.
+            self.capacity = 0
+            # The number of tests the worker has asked for.
+            self.wanted = 0
+            # A map from the IDs of the tests the worker is running to
+            # the contexts in which they are run.
+            self.tests = {}
+            self.last_seen = time.time()
+
+
+
+    def IsIdle(self):
+        """Return true if the target is idle.
+
+        returns -- True if the target is idle.  If the target is idle,
+        additional tasks may be assigned to it."""
+
+        self.__lock.acquire()
+        try:
+            running = len(self.__pending)
+            for worker in self.__workers:
+                running += len(worker.tests)
+            return running < self.__GetCapacity()
+        finally:
+            self.__lock.release()
+
+
+    def GetCapacity(self):
+
+        self.__lock.acquire()
+        try:
+            return self.__GetCapacity()
+        finally:
+            self.__lock.release()
+
+
+    def Start(self, response_queue, engine=None):
+        """Start the target.
+
+        'response_queue' -- The 'Queue' in which the results of test
+        executions are placed.
+
+        'engine' -- The 'ExecutionEngine' that is starting the target,
+        or 'None' if this target is being started without an
+        'ExecutionEngine'."""
+
+        Target.Start(self, response_queue, engine)
+
+        self.__lock = Lock()
+        # The connected workers.
+        self.__workers = []
+        # A list of pairs '(test_id, context)' for tests that are
+        # waiting for a worker.
+        self.__pending = []
+        # A map from test IDs to the number of workers lost while
+        # running them.
+        self.__attempts = {}
+        self.__last_worker_time = time.time()
+        self.__stopping = 0
+
+        self.__listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.__listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.__listener.bind((self.address, self.port))
+        self.__listener.listen(16)
+        address, port = self.__listener.getsockname()
+        self._Trace("Listening for workers on port %d." % port)
+
+        self.__thread = Thread(target = self.__Serve)
+        self.__thread.setDaemon(1)
+        self.__thread.start()
+
+        # Start the local workers.
+        self.__children = []
+        if self.local_workers > 0:
+            database_path = self.database_path
+            if not database_path:
+                database_path = self.GetDatabase().GetPath()
+            qmtest_path = self.qmtest
+            if not qmtest_path:
+                qmtest_path \
+                    = qm.test.cmdline.get_qmtest().GetExecutablePath()
+                if not qmtest_path:
+                    qmtest_path = "/usr/local/bin/qmtest"
+            arg_list = [ qmtest_path, "-D", database_path, "worker",
+                         "--connect", "127.0.0.1:%d" % port,
+                         "-j", str(self.worker_threads) ]
+            for x in xrange(self.local_workers):
+                self.__children.append(
+                    qm.executable.Executable().Spawn(arg_list))
+
+
+    def Stop(self):
+        """Stop the target.
+
+        postconditions -- The target may no longer be used."""
+
+        self.__stopping = 1
+        self.__thread.join()
+        for worker in self.__workers:
+            try:
+                _send_message(worker.socket, ("Stop",))
+            except socket.error:
+                pass
+            worker.socket.close()
+        self.__listener.close()
+        for child in self.__children:
+            os.waitpid(child, 0)
+
+        Target.Stop(self)
+
+
+    def RunTest(self, descriptor, context):
+        """Run the test given by 'descriptor'.
+
+        'descriptor' -- The 'TestDescriptor' for the test.
+
+        'context' -- The 'Context' in which to run the test."""
+
+        self.__lock.acquire()
+        try:
+            self.__pending.append((descriptor.GetId(), context))
+            self.__Dispatch()
+        finally:
+            self.__lock.release()
+
+
+    def CancelTest(self, test_id):
+        """Stop running the test given by 'test_id', if possible.
+
+        'test_id' -- The name of a test that was given to 'RunTest'.
+
+        A test that has not yet been given to a worker is discarded.
+        A test that is already running cannot be stopped."""
+
+        self.__lock.acquire()
+        try:
+            self.__pending = [p for p in self.__pending
+                              if p[0] != test_id]
+        finally:
+            self.__lock.release()
+
+
+    def _Trace(self, message):
+        """Write a trace 'message'.
+
+        'message' -- A string to be output as a trace message."""
+
+        if __debug__:
+            tracer = qm.test.cmdline.get_qmtest().GetTracer()
+            tracer.Write(message, "socket_target")
+
+
+    def __GetCapacity(self):
+        """Return the number of tests the workers can run at once.
+
+        returns -- The total capacity of the connected workers, or one
+        if there are none.  The lock must be held."""
+
+        capacity = 0
+        for worker in self.__workers:
+            capacity += worker.capacity
+        return max(capacity, 1)
+
+
+    def __Serve(self):
+        """Accept workers and read their messages.
+
+        This method runs in a separate thread until the target is
+        stopped."""
+
+        interval = max(self.heartbeat, 1)
+        while not self.__stopping:
+            sockets = [self.__listener]
+            sockets.extend([w.socket for w in self.__workers])
+            try:
+                readable = select.select(sockets, [], [],
+                                         min(interval, 0.5))[0]
+            except select.error, e:
+                if e[0] == errno.EINTR:
+                    continue
+                raise
+            self.__lock.acquire()
+            try:
+                for sock in readable:
+                    if sock is self.__listener:
+                        connection, address = sock.accept()
+                        connection.setsockopt(socket.IPPROTO_TCP,
+                                              socket.TCP_NODELAY, 1)
+                        self._Trace("Worker connected from %s:%d."
+                                    % address)
+                        self.__workers.append(self.__Worker(connection,
+                                                            address))
+                        continue
+                    for worker in self.__workers:
+                        if worker.socket is sock:
+                            break
+                    else:
+                        # The worker has already been lost.
+                        continue
+                    messages = worker.reader.Read()
+                    if messages is None:
+                        self.__LoseWorker(worker)
+                        continue
+                    worker.last_seen = time.time()
+                    for message in messages:
+                        self.__HandleMessage(worker, message)
+                # Forget workers that have stopped sending heartbeats.
+                now = time.time()
+                for worker in self.__workers[:]:
+                    if now - worker.last_seen > 3 * interval:
+                        self.__LoseWorker(worker)
+                self.__CheckForWorkers(now)
+                self.__Dispatch()
+            finally:
+                self.__lock.release()
+
+
+    def __HandleMessage(self, worker, message):
+        """Handle a 'message' from 'worker'.
+
+        The lock must be held."""
+
+        kind = message[0]
+        if kind == "Register":
+            # The worker will run up to 'capacity' tests at once, and
+            # is ready for that many now.
+            worker.capacity = worker.wanted = message[1]
+            self._Trace("Worker %s can run %d tests."
+                        % (message[2], worker.capacity))
+            _send_message(worker.socket, ("Welcome", self.heartbeat))
+        elif kind == "Results":
+            for result in message[1]:
+                if (result.GetKind() == Result.TEST
+                    and worker.tests.has_key(result.GetId())):
+                    del worker.tests[result.GetId()]
+                self._RecordResult(result)
+            # The worker has finished some tests, and is ready for
+            # more.
+            worker.wanted += message[2]
+
+
+    def __LoseWorker(self, worker):
+        """Forget 'worker', and give its tests to other workers.
+
+        The lock must be held."""
+
+        self._Trace("Lost worker at %s:%d." % worker.address)
+        self.__workers.remove(worker)
+        worker.socket.close()
+        requeue = []
+        for test_id, context in worker.tests.items():
+            attempts = self.__attempts.get(test_id, 0) + 1
+            self.__attempts[test_id] = attempts
+            if attempts < self.__ATTEMPTS:
+                requeue.append((test_id, context))
+            else:
+                result = Result(Result.TEST, test_id)
+                result.SetOutcome(Result.ERROR,
+                                  "Lost the worker running the test.")
+                self._RecordResult(result)
+        # Tests that were already running come first.
+        self.__pending[0:0] = requeue
+
+
+    def __CheckForWorkers(self, now):
+        """Report waiting tests as errors if there are no workers.
+
+        'now' -- The current time.
+
+        The lock must be held."""
+
+        if self.__workers:
+            self.__last_worker_time = now
+            return
+        if (not self.__pending
+            or now - self.__last_worker_time < self.worker_timeout):
+            return
+        for test_id, context in self.__pending:
+            result = Result(Result.TEST, test_id)
+            result.SetOutcome(Result.ERROR, "No worker was available.")
+            self._RecordResult(result)
+        self.__pending = []
+
+
+    def __Dispatch(self):
+        """Give waiting tests to workers that have asked for them.
+
+        The lock must be held."""
+
+        for worker in self.__workers[:]:
+            if not self.__pending:
+                break
+            if worker.wanted <= 0:
+                continue
+            batch = self.__pending[:worker.wanted]
+            del self.__pending[:worker.wanted]
+            worker.wanted -= len(batch)
+            for test_id, context in batch:
+                worker.tests[test_id] = context
+            try:
+                _send_message(worker.socket, ("RunTests", batch))
+            except socket.error:
+                self.__LoseWorker(worker)
+
+
+
+class SocketWorker(object):
+    """A 'SocketWorker' runs tests on behalf of a 'SocketTarget'."""
+
+    def __init__(self, database, host, port, threads):
+        """Construct a new 'SocketWorker'.
+
+        'database' -- The 'Database' containing the tests.
+
+        'host' -- The name of the computer running the 'SocketTarget'.
+
+        'port' -- The port on which the 'SocketTarget' is listening.
+
+        'threads' -- The number of tests to run at once."""
+
+        self.__database = database
+        self.__host = host
+        self.__port = port
+        self.__threads = threads
+
+
+    def Run(self):
+        """Run tests until the 'SocketTarget' stops."""
+
+        target_class \
+            = qm.test.base.get_extension_class("thread_target.ThreadTarget",
+                                               "target", self.__database)
+        target = target_class(self.__database,
+                              { "name" : "worker",
+                                "threads" : self.__threads })
+        # The response queue also receives 'None' when the connection
+        # to the 'SocketTarget' is closed.
+        self.__queue = Queue.Queue(0)
+        target.Start(self.__queue)
+
+        self.__socket = socket.create_connection((self.__host,
+                                                  self.__port))
+        self.__socket.setsockopt(socket.IPPROTO_TCP,
+                                 socket.TCP_NODELAY, 1)
+        _send_message(self.__socket,
+                      ("Register", self.__threads, socket.gethostname()))
+        reader = Thread(target = self.__Read, args = (target,))
+        reader.setDaemon(1)
+        reader.start()
+
+        # Send results as they arrive, and a heartbeat when there is
+        # nothing else to send.
+        interval = 5
+        while 1:
+            try:
+                result = self.__queue.get(timeout = interval)
+            except Queue.Empty:
+                _send_message(self.__socket, ("Heartbeat",))
+                continue
+            if isinstance(result, tuple):
+                # The 'SocketTarget' has told us how often to send
+                # heartbeats.
+                interval = max(result[1], 1)
+                continue
+            if result is None:
+                break
+            results = [result]
+            while 1:
+                try:
+                    result = self.__queue.get(0)
+                except Queue.Empty:
+                    break
+                if result is None:
+                    self.__queue.put(None)
+                    break
+                results.append(result)
+            finished = len([r for r in results
+                            if r.GetKind() == Result.TEST])
+            try:
+                _send_message(self.__socket,
+                              ("Results", results, finished))
+            except socket.error:
+                break
+
+        target.Stop()
+        self.__socket.close()
+        return 0
+
+
+    def __Read(self, target):
+        """Read requests from the 'SocketTarget'.
+
+        'target' -- The 'Target' on which to run the tests.
+
+        This method runs in a separate thread."""
+
+        reader = _MessageReader(self.__socket)
+        while 1:
+            messages = reader.Read()
+            if messages is None:
+                break
+            for message in messages:
+                if message[0] == "RunTests":
+                    for test_id, context in message[1]:
+                        self.__RunTest(target, test_id, context)
+                elif message[0] == "Welcome":
+                    self.__queue.put(message)
+                elif message[0] == "Stop":
+                    self.__queue.put(None)
+                    return
+        self.__queue.put(None)
+
+
+    def __RunTest(self, target, test_id, context):
+        """Run the test 'test_id' on 'target'.
+
+        'target' -- The 'Target' on which to run the test.
+
+        'test_id' -- The name of the test.
+
+        'context' -- The 'Context' in which to run the test."""
+
+        try:
+            descriptor = self.__database.GetTest(test_id)
+        except:
+            result = Result(Result.TEST, test_id)
+            result.NoteException(cause = "Could not load the test.")
+            self.__queue.put(result)
+            return
+        target.RunTest(descriptor, context)
+
+########################################################################
+# Local Variables:
+# mode: python
+# indent-tabs-mode: nil
+# fill-column: 72
+# End:
@@ -15,12 +15,38 @@
 # Imports
 #######################################################################
 
+import atexit
 from   qm.host import Host
 import os
 import os.path
-from   qm.fields import TextField, SetField
+from   qm.executable import Executable, Filter, RedirectedExecutable
+from   qm.fields import BooleanField, TextField, SetField
 import qm.common
+import shutil
+import signal
+from   StringIO import StringIO
 import sys
+import tarfile
+import tempfile
+import threading
+import time
+
+########################################################################
+# Variables
+#######################################################################
+
+_masters = {}
+"""The master connections shared by 'SSHHost' instances.
+
+Each key is a tuple giving the remote shell program, its arguments, the
+host name, and the user name.  Each value is a tuple '(owner, pid,
+directory)' giving the process that started the master connection, the
+process ID of the master connection, and the directory containing its
+control socket, or 'None' if the master connection could not be
+started."""
+
+_masters_lock = threading.Lock()
+"""The lock that protects '_masters'."""
 
 ########################################################################
 # Classes
@@ -70,7 +96,21 @@ class SSHHost(Host):
         If not empty, the user name that should be used when
         connecting to the remote host."""
         )
-    
+
+    multiplex = BooleanField(
+        default_value = "false",
+        description = """True if commands should share one connection.
+
+        If true, a single connection to the remote host is opened the
+        first time it is needed, and all subsequent commands and file
+        copies use that connection instead of logging in again.  The
+        remote shell program must support the OpenSSH 'ControlMaster'
+        and 'ControlPath' options."""
+        )
+
+    __MASTER_TIMEOUT = 30
+    """The number of seconds to wait for a master connection."""
+
     def Run(self, path, arguments, environment = None, timeout = -1,
             relative = False):
 
@@ -92,6 +132,9 @@ class SSHHost(Host):
 
         if remote_file is None:
             remote_file = os.path.basename(local_file)
+        uploads = [(local_file, remote_file)]
+        if not self._GetStaleUploads(uploads):
+            return
         if self.nfs_dir:
             remote_file = os.path.join(self.nfs_dir, remote_file)
             super(SSHHost, self).UploadFile(local_file, remote_file)
@@ -102,11 +145,9 @@ class SSHHost(Host):
                                                remote_file)
             executable = self.Executable()
             status = executable.Run(command)
-            if ((sys.platform != "win32"
-                 and (not os.WIFEXITED(status)
-                      or os.WEXITSTATUS(status) != 0))
-                or (sys.platform == "win32" and status != 0)):
+            if not self.__Succeeded(status):
                 raise qm.common.QMException("could not upload file")
+        self._RecordUploads(uploads)
         
 
     def DownloadFile(self, remote_file, local_file = None):
@@ -125,6 +166,94 @@ class SSHHost(Host):
             executable.Run(command)
 
 
+    def UploadFiles(self, local_files, remote_dir = None):
+        """Copy each of the 'local_files' to the remote machine.
+
+        'local_files' -- A sequence of names of files on the local
+        machine.
+
+        'remote_dir' -- As for 'Host.UploadFiles'.  The directory must
+        already exist.
+
+        Unless 'nfs_dir' is set, the files are sent as a single "tar"
+        archive over one connection made with the remote shell
+        program, rather than by running the remote copy program once
+        for each file.  The "tar" program must be available on the
+        remote host.  Files that the 'upload_cache' shows are already
+        present are not sent."""
+
+        if self.nfs_dir:
+            super(SSHHost, self).UploadFiles(local_files, remote_dir)
+            return
+        uploads = []
+        for local_file in local_files:
+            remote_file = os.path.basename(local_file)
+            if remote_dir is not None:
+                remote_file = os.path.join(remote_dir, remote_file)
+            uploads.append((local_file, remote_file))
+        uploads = self._GetStaleUploads(uploads)
+        if not uploads:
+            return
+        # Send all of the files to the remote host in a single "tar"
+        # archive, rather than running "scp" once for each file.
+        archive = StringIO()
+        tar = tarfile.open(mode = "w", fileobj = archive,
+                           dereference = True)
+        for local_file, remote_file in uploads:
+            tar.add(local_file, os.path.basename(local_file))
+        tar.close()
+        path, arguments = self._FormSSHCommandLine(
+            "cd", [self.__GetRemoteDirectory(remote_dir),
+                   "&&", "tar", "xf", "-"])
+        executable = Filter(archive.getvalue())
+        status = executable.Run([path] + arguments)
+        if not self.__Succeeded(status):
+            raise qm.common.QMException("could not upload files")
+        self._RecordUploads(uploads)
+
+
+    def DownloadFiles(self, remote_files, local_dir = None):
+        """Copy each of the 'remote_files' to the local machine.
+
+        'remote_files' -- A sequence of names of files on the remote
+        machine, relative to the default directory.
+
+        'local_dir' -- As for 'Host.DownloadFiles'.
+
+        Unless 'nfs_dir' is set, the remote host sends all of the
+        files as a single "tar" archive over one connection made with
+        the remote shell program.  The "tar" program must be available
+        on the remote host."""
+
+        if self.nfs_dir:
+            super(SSHHost, self).DownloadFiles(remote_files, local_dir)
+            return
+        # Have the remote host send all of the files in a single "tar"
+        # archive.  The standard error stream is kept separate so
+        # that it does not corrupt the archive.
+        path, arguments = self._FormSSHCommandLine(
+            "cd", [self.__GetRemoteDirectory(None),
+                   "&&", "tar", "cf", "-"] + list(remote_files))
+        executable = RedirectedExecutable()
+        status = executable.Run([path] + arguments)
+        if not self.__Succeeded(status):
+            raise qm.common.QMException("could not download files")
+        if local_dir is None:
+            local_dir = os.curdir
+        tar = tarfile.open(mode = "r", fileobj = StringIO(executable.stdout))
+        for member in tar.getmembers():
+            if not member.isfile():
+                continue
+            local_file = os.path.join(local_dir,
+                                      os.path.basename(member.name))
+            f = open(local_file, "wb")
+            try:
+                shutil.copyfileobj(tar.extractfile(member), f)
+            finally:
+                f.close()
+        tar.close()
+
+
     def DeleteFile(self, remote_file):
 
         if self.default_dir:
@@ -132,6 +261,15 @@ class SSHHost(Host):
         return self.Run("rm", [remote_file])
 
         
+    def _GetUploadIdentity(self):
+
+        host_name = self.host_name
+        if self.user_name:
+            host_name = self.user_name + "@" + host_name
+        return "%s:%s:%s" % (super(SSHHost, self)._GetUploadIdentity(),
+                             host_name, self.default_dir)
+
+
     def _FormSSHCommandLine(self, path, arguments, environment = None):
         """Form the 'ssh' command line.
 
@@ -146,7 +284,8 @@ class SSHHost(Host):
         to run on the local machine that will execute the remote
         command."""
 
-        command = self.ssh_args + [self.host_name]
+        command = (self._GetControlArguments(False)
+                   + self.ssh_args + [self.host_name])
         if self.user_name:
             command += ["-l", self.user_name]
         if environment is not None:
@@ -177,7 +316,8 @@ class SSHHost(Host):
         remote_file = self.host_name + ":" + remote_file
         if self.user_name:
             remote_file = self.user_name + "@" + remote_file
-        command = [self.scp_program] + self.scp_args
+        command = ([self.scp_program] + self._GetControlArguments(True)
+                   + self.scp_args)
         if upload:
             command += [local_file, remote_file]
         else:
@@ -186,6 +326,100 @@ class SSHHost(Host):
         return command    
 
 
+    def _GetControlArguments(self, copy):
+        """Return the arguments needed to use the shared connection.
+
+        'copy' -- True iff the arguments are for the remote copy
+        program, rather than the remote shell program.
+
+        returns -- A list of arguments that make the remote shell or
+        remote copy program use the master connection to the remote
+        host.  The list is empty if 'multiplex' is false or the master
+        connection could not be started."""
+
+        if self.multiplex != "true":
+            return []
+        key = (self.ssh_program, tuple(self.ssh_args),
+               self.host_name, self.user_name)
+        # Hold the lock while starting the master connection so that
+        # other threads wait for it, rather than starting their own.
+        _masters_lock.acquire()
+        try:
+            if not _masters.has_key(key):
+                _masters[key] = self.__StartMaster()
+            master = _masters[key]
+        finally:
+            _masters_lock.release()
+        if master is None:
+            return []
+        arguments = ["-o", "ControlPath=" + os.path.join(master[2],
+                                                         "control")]
+        if not copy:
+            arguments += ["-o", "ControlMaster=no"]
+        return arguments
+
+
+    def __StartMaster(self):
+        """Start a master connection to the remote host.
+
+        returns -- A tuple '(owner, pid, directory)', as stored in
+        '_masters', or 'None' if the master connection could not be
+        started."""
+
+        directory = tempfile.mkdtemp(prefix = "qmtest-ssh-")
+        control_path = os.path.join(directory, "control")
+        command = ([self.ssh_program] + self.ssh_args
+                   + ["-M", "-N", "-n", "-o", "ControlPath=" + control_path,
+                      self.host_name])
+        if self.user_name:
+            command += ["-l", self.user_name]
+        pid = Executable().Spawn(command)
+        # Wait for the master connection to create its control socket.
+        deadline = time.time() + self.__MASTER_TIMEOUT
+        while not os.path.exists(control_path):
+            if os.waitpid(pid, os.WNOHANG)[0] == pid:
+                break
+            if time.time() > deadline:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+                break
+            time.sleep(0.1)
+        else:
+            return (os.getpid(), pid, directory)
+        # The master connection failed; connect separately for each
+        # command instead.
+        shutil.rmtree(directory, True)
+        return None
+
+
+    def __GetRemoteDirectory(self, remote_dir):
+        """Return the path to a directory on the remote host.
+
+        'remote_dir' -- A path relative to the default directory, or
+        'None'.
+
+        returns -- The path to 'remote_dir' on the remote host, or to
+        the default directory if 'remote_dir' is 'None'."""
+
+        directory = self.default_dir or os.curdir
+        if remote_dir is not None:
+            directory = os.path.join(directory, remote_dir)
+        return directory
+
+
+    def __Succeeded(self, status):
+        """Return true iff 'status' indicates success.
+
+        'status' -- The exit status of a program run on the local
+        machine.
+
+        returns -- True iff the program exited successfully."""
+
+        if sys.platform == "win32":
+            return status == 0
+        return os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+
+
 
 class RSHHost(SSHHost):
     """An 'RSHHost' is an 'SSHHost' that uses 'rsh' instead of 'ssh'.
@@ -205,12 +439,39 @@ class RSHHost(SSHHost):
         description = """The path to the remote copy program."""
         )
 
-    def Run(self, path, arguments, environment = None, timeout = -1):
+    def Run(self, path, arguments, environment = None, timeout = -1,
+            relative = False):
 
         status, output = \
                 super(RSHHost, self).Run(path, arguments,
-                                         environment, timeout)
+                                         environment, timeout, relative)
         # The exit status of 'rsh' is not the exit status of the
         # remote program.  The exit status of the remote program is
         # unavailable. 
         return (None, output)
+
+########################################################################
+# Functions
+#######################################################################
+
+def _stop_masters():
+    """Stop the master connections started by this process."""
+
+    for master in _masters.values():
+        if master is None:
+            continue
+        owner, pid, directory = master
+        # A child process inherits '_masters', but the connections
+        # belong to its parent.
+        if owner != os.getpid():
+            continue
+        try:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+        except OSError:
+            pass
+        shutil.rmtree(directory, True)
+    _masters.clear()
+
+
+atexit.register(_stop_masters)
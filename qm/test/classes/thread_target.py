@@ -21,6 +21,7 @@ from   qm.temporary_directory import TemporaryDirectory
 from   qm.test.base import *
 import qm.test.cmdline
 from   qm.test.command_thread import *
+from   qm.test.concurrency import ConcurrencyController
 from   qm.test.target import *
 import Queue
 from   threading import *
@@ -75,6 +76,18 @@ class ThreadTarget(Target):
             value to find the number that results in the fastest
             execution.""",
             default_value=1),
+        qm.fields.BooleanField(
+            name="adaptive",
+            title="Adaptive Concurrency",
+            description="""True if the number of threads should vary.
+
+            If true, the number of tests run at once is chosen
+            automatically.  It starts at the number of processors
+            and is adjusted during the run based on the system load
+            and on the CPU utilization of the tests.  In that case,
+            the 'threads' argument gives the minimum number of tests
+            that will be run at once.""",
+            default_value="false"),
         ]
     
     def __init__(self, database, properties):
@@ -91,9 +104,6 @@ class ThreadTarget(Target):
 
         # Create a lock to guard accesses to __ready_threads.
         self.__ready_threads_lock = Lock()
-        # Create a condition variable to guard accesses to the
-        # available resources table.
-        self.__resources_condition = Condition()
         
 
     def IsIdle(self):
@@ -107,8 +117,20 @@ class ThreadTarget(Target):
         # __ready_threads.)
         self.__ready_threads_lock.acquire()
         
-        # This target is idle if there are any ready threads.
-        if self.__ready_threads:
+        # If the concurrency controller wants to run more tests at
+        # once than there are threads, create more threads.
+        if self.__controller:
+            limit = self.__controller.GetLimit()
+            while len(self.__threads) < limit:
+                thread = self.__StartThread()
+                self.__ready_threads.append(thread)
+        else:
+            limit = len(self.__threads)
+
+        # This target is idle if there are any ready threads, and
+        # running another test would not exceed the limit.
+        busy = len(self.__threads) - len(self.__ready_threads)
+        if self.__ready_threads and busy < limit:
             idle=1
         else:
             idle=0
@@ -119,6 +141,19 @@ class ThreadTarget(Target):
         return idle
 
 
+    def GetCapacity(self):
+        """Return the number of slots available on this target.
+
+        returns -- The number of threads that may run tests at once.
+        If the 'adaptive' property is true, the number is chosen by
+        the concurrency controller, and may change as the test run
+        proceeds."""
+
+        if self.__controller:
+            return self.__controller.GetLimit()
+        return self.threads
+
+
     def Start(self, response_queue, engine=None):
         """Start the target.
         
@@ -130,16 +165,21 @@ class ThreadTarget(Target):
         'ExecutionEngine'."""
 
         Target.Start(self, response_queue, engine)
+
+        # If the number of threads is adaptive, let a controller
+        # decide how many to use.
+        if self.adaptive == "true":
+            self.__controller \
+                = ConcurrencyController(minimum = self.threads)
+            count = self.__controller.GetLimit()
+        else:
+            self.__controller = None
+            count = self.threads
         
         # Build the threads.
         self.__threads = []
-        for i in xrange(0, self.threads):
-            # Create the new thread.
-            thread = LocalThread(self)
-            # Start the thread.
-            thread.start()
-            # Remember the thread.
-            self.__threads.append(thread)
+        for i in xrange(0, count):
+            self.__StartThread()
 
         # Initially, all threads are ready.
         self.__ready_threads = self.__threads[:]
@@ -150,15 +190,17 @@ class ThreadTarget(Target):
 
         postconditions -- The target may no longer be used."""
 
-        Target.Stop(self)
-        
         # Send each thread a "quit" command.
         for thread in self.__threads:
             thread.Stop()
-        # Now wait for each thread process to finish.
+        # Now wait for each thread process to finish.  The results of
+        # the tests that were still running are recorded before the
+        # resources they use are cleaned up.
         for thread in self.__threads:
             thread.join()
 
+        Target.Stop(self)
+
 
     def RunTest(self, descriptor, context):
         """Run the test given by 'descriptor'.
@@ -207,64 +249,15 @@ class ThreadTarget(Target):
         # If this is a test result, then this thread has finished all
         # of its work.
         if result.GetKind() == Result.TEST:
+            # Let the controller know how much of the machine this
+            # test used.
+            if self.__controller:
+                self.__controller.NoteResult(result)
             self._NoteIdleThread()
         # Pass the result back to the execution engine.
         Target._RecordResult(self, result)
         
             
-    def _BeginResourceSetUp(self, resource_name):
-        """Begin setting up the indicated resource.
-
-        'resource_name' -- A string naming a resource.
-
-        returns -- If the resource has already been set up, returns a
-        tuple '(outcome, map)'.  The 'outcome' indicates the outcome
-        that resulted when the resource was set up; the 'map' is a map
-        from strings to strings indicating properties added by this
-        resource.  Otherwise, returns 'None', but marks the resource
-        as in the process of being set up; it is the caller's
-        responsibility to finish setting it up by calling
-        '_FinishResourceSetUp'."""
-
-        # Acquire the lock.
-        self.__resources_condition.acquire()
-        try:
-            # Loop until either we are assigned to set up the resource
-            # or until some other thread has finished setting it up.
-            while 1:
-                rop = Target._BeginResourceSetUp(self, resource_name)
-                # If this is the first thread to call _BeginResourceSetUp
-                # for this thread will set up the resource.
-                if not rop:
-                    return rop
-                # If this resource has already been set up, we do not
-                # need to do anything more.
-                if rop[1]:
-                    return rop
-                # Otherwise, some other thread is in the process of
-                # setting up this resource so we just wait for it to
-                # finish its job.
-                self.__resources_condition.wait()
-        finally:
-            # Release the lock.
-            self.__resources_condition.release()
-                
-
-    def _FinishResourceSetUp(self, resource, result, properties):
-
-        # Acquire the lock.
-        self.__resources_condition.acquire()
-        # Record the fact that the resource is set up.
-        rop = Target._FinishResourceSetUp(self, resource, result, properties)
-        # Tell all the other threads that the resource has been set
-        # up.
-        self.__resources_condition.notifyAll()
-        # Release the lock.
-        self.__resources_condition.release()
-
-        return rop
-
-        
     def _NoteIdleThread(self):
         """Note that the current thread.
 
@@ -286,6 +279,21 @@ class ThreadTarget(Target):
             self.__ready_threads_lock.release()
 
 
+    def __StartThread(self):
+        """Create and start a new thread.
+
+        returns -- The new 'LocalThread'.  The thread is added to the
+        list of threads, but not to the list of ready threads."""
+
+        # Create the new thread.
+        thread = LocalThread(self)
+        # Start the thread.
+        thread.start()
+        # Remember the thread.
+        self.__threads.append(thread)
+        return thread
+
+
     def _Trace(self, message):
         """Write a trace 'message'.
 
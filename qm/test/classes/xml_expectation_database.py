@@ -34,6 +34,10 @@ class XMLExpectationDatabase(ExpectationDatabase):
 
     file_name = TextField()
 
+    __special_regexp = re.compile(r"[.^$*+?{}\[\]\\|()]")
+    """A regular expression matching the characters that are special
+    in regular expressions."""
+
 
     def __init__(self, **args):
 
@@ -51,21 +55,101 @@ class XMLExpectationDatabase(ExpectationDatabase):
             description = e.getElementsByTagName('description')
             if description: description = get_dom_text(description[0])
             self._expectations.append((test_id, outcome, filters, description))
+        # The parameters of the test run do not change, so the rules
+        # that do not apply to it can be discarded now.  The other
+        # rules are indexed by the characters that a test id must
+        # start with to match them, so that most rules need not be
+        # tried for each test.
+        parameters = self.testrun_parameters or {}
+        index = {}
+        number = 0
+        for rule_id, rule_outcome, rule_annotations, rule_description \
+                in self._expectations:
+            number += 1
+            match = True
+            for name, value in rule_annotations.iteritems():
+                if (name not in parameters
+                    or not re.match(value, parameters[name])):
+                    match = False
+            if not match:
+                continue
+            prefix, wildcards = self.__GetPrefix(rule_id)
+            if self.__special_regexp.search(rule_id):
+                regexp = re.compile(rule_id)
+            else:
+                # The rule matches exactly those test ids that start
+                # with the rule id.
+                regexp = None
+            positions = tuple([i for i in range(len(prefix))
+                               if i not in wildcards])
+            key = "".join([prefix[i] for i in positions])
+            index.setdefault((len(prefix), positions), {}) \
+                 .setdefault(key, []) \
+                 .append((number, regexp, rule_outcome, rule_description))
+        self._rule_index = index.items()
+        # A map from test ids to the 'Result's returned by 'Lookup'.
+        self._results = {}
 
 
     def Lookup(self, test_id):
 
-        
-        outcome, description = Result.PASS, ''
-        for rule_id, rule_outcome, rule_annotations, rule_description in self._expectations:
-            if re.match(rule_id, test_id):
-                match = True
-                for a in rule_annotations.iteritems():
-                    if (a[0] not in self.testrun_parameters or
-                        not re.match(a[1], self.testrun_parameters[a[0]])):
-                        match = False
-                if match:
+        result = self._results.get(test_id)
+        if result is None:
+            candidates = []
+            for (length, positions), rules in self._rule_index:
+                if length <= len(test_id):
+                    key = "".join([test_id[i] for i in positions])
+                    candidates.extend(rules.get(key, ()))
+            # Later rules override earlier ones, so try them first.
+            candidates.sort()
+            candidates.reverse()
+            outcome, description = Result.PASS, ''
+            for number, regexp, rule_outcome, rule_description in candidates:
+                if regexp is None or regexp.match(test_id):
                     outcome = rule_outcome
                     description = rule_description
-        return Result(Result.TEST, test_id, outcome,
-                      annotations={'description':description})
+                    break
+            result = Result(Result.TEST, test_id, outcome,
+                            annotations={'description':description})
+            self._results[test_id] = result
+        return result
+
+
+    def __GetPrefix(self, rule_id):
+        """Return the characters that a test id must start with.
+
+        'rule_id' -- The regular expression that test ids must match
+        for a rule to apply.
+
+        returns -- A pair '(prefix, wildcards)'.  Every test id matched
+        by 'rule_id' starts with 'prefix', except at the indices in
+        'wildcards', where any character may appear."""
+
+        prefix = ""
+        wildcards = []
+        # Alternatives, and flags (which apply to the whole regular
+        # expression), are too complicated to analyze.
+        if "|" in rule_id or "(?" in rule_id:
+            return prefix, wildcards
+        i = 0
+        while i < len(rule_id):
+            c = rule_id[i]
+            if c == "\\" and i + 1 < len(rule_id):
+                # An escaped punctuation character stands for itself.
+                c = rule_id[i + 1]
+                if c.isalnum() or c == "_":
+                    break
+                i += 1
+            elif c == ".":
+                wildcards.append(len(prefix))
+            elif c in "*?{":
+                # The preceding character need not be present.
+                if wildcards and wildcards[-1] == len(prefix) - 1:
+                    wildcards.pop()
+                prefix = prefix[:-1]
+                break
+            elif self.__special_regexp.match(c):
+                break
+            prefix += c
+            i += 1
+        return prefix, wildcards
@@ -19,6 +19,7 @@ import qm.xmlutil
 from   qm.test.file_result_reader import FileResultReader
 from   qm.test.result import Result
 from   qm.test.file_result_stream import FileResultStream
+import re
 
 ########################################################################
 # classes
@@ -84,6 +85,8 @@ class XMLResultReader(FileResultReader):
 
     To write such a file, see 'XMLResultStream'."""
 
+    _signature_regexp = re.compile(r"<\?xml")
+
     def __init__(self, arguments = None, **args):
 
         super(XMLResultReader, self).__init__(arguments, **args)
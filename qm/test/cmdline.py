@@ -27,15 +27,19 @@ import qm.platform
 from   qm.extension import get_extension_class_name, get_class_description
 from   qm.test import test
 from   qm.test.result import Result
+from   qm.test.result_cache import ResultCache
 from   qm.test.context import *
 from   qm.test.execution_engine import *
 from   qm.test.result_stream import ResultStream
 from   qm.test.runnable import Runnable
 from   qm.test.suite import Suite
 from   qm.test.report import ReportGenerator
+import qm.test.changes
+import qm.test.sharding
 from   qm.test.classes.dir_run_database import *
 from   qm.test.expectation_database import ExpectationDatabase
 from   qm.test.classes.previous_testrun import PreviousTestRun
+import qm.test.classes.socket_target
 from   qm.trace import *
 from   qm.test.web.web import QMTestServer
 import qm.structured_text
@@ -243,7 +247,7 @@ class QMTest:
         "j",
         "concurrency",
         "COUNT",
-        "Execute tests in COUNT concurrent threads."
+        "Execute tests in COUNT concurrent threads (or 'auto')."
         )
 
     targets_option_spec = (
@@ -253,6 +257,69 @@ class QMTest:
         "Use FILE as the target specification file."
         )
 
+    plan_option_spec = (
+        None,
+        "plan",
+        None,
+        "Order the tests by their prerequisites before running them."
+        )
+
+    speculate_option_spec = (
+        None,
+        "speculate",
+        None,
+        "Run side-effect free tests before their prerequisites complete."
+        )
+
+    backup_option_spec = (
+        None,
+        "backup-stragglers",
+        None,
+        "Run copies of slow tests on idle targets at the end of the run."
+        )
+
+    connect_option_spec = (
+        None,
+        "connect",
+        "HOST:PORT",
+        "Connect to the target listening on PORT on HOST."
+        )
+
+    shard_option_spec = (
+        None,
+        "shard",
+        "I/N",
+        "Run only the tests in shard I of N."
+        )
+
+    shard_history_option_spec = (
+        None,
+        "shard-history",
+        "FILE",
+        "Balance the shards using the test times in results FILE."
+        )
+
+    resume_option_spec = (
+        None,
+        "resume",
+        "FILE",
+        "Resume the interrupted test run whose results are in FILE."
+        )
+
+    changed_since_option_spec = (
+        None,
+        "changed-since",
+        "FILE_OR_TIME",
+        "Run only the tests whose source files have changed."
+        )
+
+    no_cache_option_spec = (
+        None,
+        "no-cache",
+        None,
+        "Run every test, even if its result is in the result cache."
+        )
+
     random_option_spec = (
         None,
         "random",
@@ -368,7 +435,7 @@ class QMTest:
     
     # Groups of options that should not be used together.
     conflicting_option_specs = (
-        ( output_option_spec, no_output_option_spec ),
+        ( output_option_spec, no_output_option_spec, resume_option_spec ),
         ( concurrent_option_spec, targets_option_spec ),
         ( extension_output_option_spec, extension_id_option_spec ),
         ( expectations_option_spec, outcomes_option_spec ),
@@ -510,6 +577,25 @@ resource classes, etc.  The parameter to '--kind' can be one of """  + \
          ),
          ),
          
+        ("merge",
+         "Combine the results of several test runs.",
+         "FILE ...",
+         """
+Reads two or more results files, such as those written by the shards
+of a test run started with '--shard', and writes a single results file
+containing all of their results.  Annotations that are the same in all
+of the files are copied; the run start and end times cover all of the
+runs.
+
+The merged results are written to "results.qmr".  Use the '--output'
+option to specify a different output file.
+         """,
+         (
+           help_option_spec,
+           output_option_spec,
+         ),
+         ),
+         
         ("register",
          "Register an extension class.",
          "KIND CLASS",
@@ -572,23 +658,49 @@ Valid formats are %s.
          """ % _make_comma_separated_string(summary_formats, "and"),
          (
            annotation_option_spec,
+           backup_option_spec,
+           changed_since_option_spec,
            concurrent_option_spec,
            context_file_spec,
            context_option_spec,
            format_option_spec,
            help_option_spec,
+           no_cache_option_spec,
            no_output_option_spec,
            outcomes_option_spec,
            expectations_option_spec,
            output_option_spec,
+           plan_option_spec,
            random_option_spec,
            rerun_option_spec,
            result_stream_spec,
+           resume_option_spec,
            seed_option_spec,
+           shard_option_spec,
+           shard_history_option_spec,
+           speculate_option_spec,
            targets_option_spec,
            )
          ),
 
+        ("worker",
+         "Run tests for a socket target.",
+         "",
+         """
+Connects to a SocketTarget and runs the tests it sends.  Use the
+'--connect' option to give the host and port on which the target is
+listening, and the '--concurrency' option to give the number of tests
+to run at once.  The worker exits when the target stops.
+
+The worker must have access to a copy of the test database.
+         """,
+         (
+           concurrent_option_spec,
+           connect_option_spec,
+           help_option_spec,
+         )
+         ),
+
         ("summarize",
          "Summarize results from a test run.",
          "[FILE [ ID ... ]]",
@@ -786,11 +898,13 @@ Valid formats are %s.
             "extensions" : self.__ExecuteExtensions,
             "gui" : self.__ExecuteServer,
             "ls" : self.__ExecuteList,
+            "merge" : self.__ExecuteMerge,
             "register" : self.__ExecuteRegister,
             "remote" : self.__ExecuteRemote,
             "run" : self.__ExecuteRun,
             "report" : self.__ExecuteReport,
             "summarize": self.__ExecuteSummarize,
+            "worker" : self.__ExecuteWorker,
             }[self.__command]
 
         return method()
@@ -881,6 +995,10 @@ Valid formats are %s.
                 if concurrency is None:
                     # No concurrency specified.  Run single-threaded.
                     concurrency = 1
+                elif concurrency == "auto":
+                    # The number of threads will be chosen while the
+                    # tests run.
+                    pass
                 else:
                     # Convert the concurrency to an integer.
                     try:
@@ -893,7 +1011,10 @@ Valid formats are %s.
                 arguments = {}
                 arguments["name"] = "local"
                 arguments["group"] = "local"
-                if concurrency > 1:
+                if concurrency == "auto":
+                    class_name = "thread_target.ThreadTarget"
+                    arguments["adaptive"] = "true"
+                elif concurrency > 1:
                     class_name = "thread_target.ThreadTarget"
                     arguments["threads"] = concurrency
                 else:
@@ -1539,6 +1660,68 @@ Valid formats are %s.
         return any_unexpected_outcomes
         
 
+    def __ExecuteMerge(self):
+        """Execute a 'merge' command."""
+
+        if not self.__arguments:
+            raise qm.cmdline.CommandError, \
+                  qm.error("no results file specified")
+
+        database = self.GetDatabaseIfAvailable()
+        readers = []
+        for path in self.__arguments:
+            try:
+                readers.append(base.load_results(path, database))
+            except Exception, exception:
+                raise QMException, \
+                      qm.error("invalid results file",
+                               path=path,
+                               problem=str(exception))
+
+        # Work out the annotations for the merged run.
+        annotations = {}
+        conflicts = {}
+        for reader in readers:
+            for name, value in reader.GetAnnotations().items():
+                if not annotations.has_key(name):
+                    annotations[name] = value
+                elif annotations[name] != value:
+                    conflicts[name] = None
+        # The merged run started when the first run started, and ended
+        # when the last run ended.  ISO 8601 times sort correctly as
+        # strings.
+        for name, choose in (("qmtest.run.start_time", min),
+                             ("qmtest.run.end_time", max)):
+            if conflicts.has_key(name):
+                del conflicts[name]
+                annotations[name] = choose([r.GetAnnotations()[name]
+                                            for r in readers
+                                            if r.GetAnnotations()
+                                               .has_key(name)])
+        # Other annotations are kept only if every run agrees.
+        for name in conflicts.keys() + ["qmtest.run.shard"]:
+            if annotations.has_key(name):
+                del annotations[name]
+
+        output = self.GetCommandOption("output", self.results_file_name)
+        stream = self.GetFileResultStreamClass()({ "filename" : output })
+        for name, value in annotations.items():
+            stream.WriteAnnotation(name, value)
+        # Each test should have been run in only one of the runs; if
+        # not, the first result is used.
+        seen = {}
+        for reader in readers:
+            for result in reader:
+                if result.GetKind() == Result.TEST:
+                    if seen.has_key(result.GetId()):
+                        continue
+                    seen[result.GetId()] = None
+                stream.WriteResult(result)
+        stream.Summarize()
+
+        return 0
+        
+
     def __ExecuteRemote(self):
         """Execute the 'remote' command."""
 
@@ -1569,7 +1752,12 @@ Valid formats are %s.
                 break
 
             # Decompose command.
-            method, id, context = command
+            method, id, context = command[:3]
+            # Note any resources that have already been set up by the
+            # master.
+            if len(command) > 3:
+                for name, properties in command[3].items():
+                    target.NoteSharedResource(name, properties)
             # Get the descriptor.
             descriptor = database.GetTest(id)
             # Run it.
@@ -1594,6 +1782,41 @@ Valid formats are %s.
         return 0
 
 
+    def __ExecuteWorker(self):
+        """Execute the 'worker' command."""
+
+        database = self.GetDatabase()
+
+        connect = self.GetCommandOption("connect")
+        if not connect:
+            self.__WriteCommandHelp("worker")
+            return 2
+        try:
+            host, port = connect.rsplit(":", 1)
+            port = int(port)
+        except ValueError:
+            raise qm.cmdline.CommandError, \
+                  qm.error("invalid worker address", address=connect)
+
+        concurrency = self.GetCommandOption("concurrency")
+        if concurrency is None:
+            concurrency = 1
+        elif concurrency == "auto":
+            concurrency = qm.platform.get_cpu_count()
+        else:
+            try:
+                concurrency = int(concurrency)
+            except ValueError:
+                raise qm.cmdline.CommandError, \
+                      qm.error("concurrency not integer",
+                               value=concurrency)
+
+        worker = qm.test.classes.socket_target.SocketWorker(database,
+                                                            host, port,
+                                                            concurrency)
+        return worker.Run()
+
+
     def __ExecuteReport(self):
         """Execute a 'report' command."""
 
@@ -1656,6 +1879,31 @@ Valid formats are %s.
         # Handle the --annotate options.
         annotations = self.__GetAnnotateOptions()
 
+        # Handle the --shard option.
+        shard = self.GetCommandOption("shard")
+        if shard:
+            try:
+                index, count = qm.test.sharding.parse_shard(shard)
+            except ValueError:
+                raise qm.cmdline.CommandError, \
+                      qm.error("invalid shard", shard=shard)
+            history = self.GetCommandOption("shard-history")
+            if history:
+                try:
+                    durations = qm.test.sharding.load_durations(
+                        base.load_results(history, database))
+                except Exception, exception:
+                    raise QMException, \
+                          qm.error("invalid results file",
+                                   path=history,
+                                   problem=str(exception))
+            else:
+                durations = None
+            test_ids = qm.test.sharding.select_shard(database, test_ids,
+                                                     index, count,
+                                                     durations)
+            annotations["qmtest.run.shard"] = "%d/%d" % (index, count)
+
         # Load expectations.
         expectations = (self.GetCommandOption('expectations') or
                         self.GetCommandOption('outcomes'))
@@ -1665,14 +1913,92 @@ Valid formats are %s.
         # Filter the set of tests to be run, eliminating any that should
         # be skipped.
         test_ids = self.__FilterTestsToRun(test_ids, expectations)
+
+        # Handle the --changed-since option.
+        changed_since = self.GetCommandOption("changed-since")
+        reused = {}
+        if changed_since:
+            if os.path.exists(changed_since):
+                try:
+                    since, previous = qm.test.changes.load_previous_run(
+                        base.load_results(changed_since, database))
+                except Exception, exception:
+                    raise QMException, \
+                          qm.error("invalid results file",
+                                   path=changed_since,
+                                   problem=str(exception))
+                if since is None:
+                    since = os.path.getmtime(changed_since)
+            else:
+                try:
+                    since = qm.test.changes.parse_time(changed_since)
+                except ValueError:
+                    raise qm.cmdline.CommandError, \
+                          qm.error("invalid changed since",
+                                   since=changed_since)
+                previous = None
+            selected = qm.test.changes.select_changed(database, test_ids,
+                                                      since, previous,
+                                                      expectations)
+            # The tests that are not run again are reported with their
+            # results from the earlier test run.
+            if previous is not None:
+                chosen = {}
+                for test_id in selected:
+                    chosen[test_id] = None
+                for test_id in test_ids:
+                    if (not chosen.has_key(test_id)
+                        and previous.has_key(test_id)):
+                        reused[test_id] = previous[test_id]
+            test_ids = selected
+
+        # Handle the --resume option.  Tests that already have results
+        # in the file are not run again.
+        resume_file_name = self.GetCommandOption("resume")
+        completed = {}
+        if resume_file_name and os.path.exists(resume_file_name):
+            try:
+                outcomes = base.load_outcomes(resume_file_name, database)
+            except Exception, exception:
+                raise QMException, \
+                      qm.error("invalid results file",
+                               path=resume_file_name,
+                               problem=str(exception))
+            for test_id in test_ids + reused.keys():
+                if outcomes.has_key(test_id):
+                    completed[test_id] = outcomes[test_id]
+            test_ids = [t for t in test_ids if not completed.has_key(t)]
+            for test_id in completed.keys():
+                if reused.has_key(test_id):
+                    del reused[test_id]
+            # The interrupted test run may have been marked as aborted.
+            annotations["qmtest.run.aborted"] = "false"
         
         # Figure out which targets to use.
         targets = self.GetTargets()
         # Compute the context in which the tests will be run.
         context = self.MakeContext()
 
+        # Use the result cache, if there is one.
+        result_cache = None
+        if (context.has_key("qmtest.result_cache")
+            and not self.HasCommandOption("no-cache")):
+            cache_limits = []
+            for key, default in (("qmtest.result_cache_max_age", 30),
+                                 ("qmtest.result_cache_max_size", 100)):
+                try:
+                    cache_limits.append(float(context.get(key, default)))
+                except ValueError:
+                    raise ContextException(key,
+                                           "invalid number context var")
+            result_cache = ResultCache(context["qmtest.result_cache"],
+                                       database, context)
+
         # Handle the --output option.
-        if self.HasCommandOption("no-output"):
+        if resume_file_name:
+            # Add the results to the file being resumed.
+            result_file_name = resume_file_name
+        elif self.HasCommandOption("no-output"):
             # User specified no output.
             result_file_name = None
         else:
@@ -1685,7 +2011,9 @@ Valid formats are %s.
         # written.
         result_streams = self.__CreateResultStreams(result_file_name,
                                                     annotations,
-                                                    expectations)
+                                                    expectations,
+                                                    resume_file_name
+                                                    is not None)
 
         if self.HasCommandOption("random"):
             # Randomize the order of the tests.
@@ -1696,9 +2024,25 @@ Valid formats are %s.
         # Run the tests.
         engine = ExecutionEngine(database, test_ids, context, targets,
                                  result_streams,
-                                 expectations)
-        if engine.Run():
-            return 1
+                                 expectations,
+                                 self.HasCommandOption("plan"),
+                                 self.HasCommandOption("speculate"),
+                                 self.HasCommandOption("backup-stragglers"),
+                                 completed,
+                                 result_cache,
+                                 resume_file_name is not None,
+                                 reused)
+        try:
+            if engine.Run():
+                return 1
+        finally:
+            if result_cache is not None:
+                # Remove results older than the maximum age, given in
+                # days, and keep the cache within its maximum size,
+                # given in megabytes.
+                max_age, max_size = cache_limits
+                result_cache.Evict(max_age * 24 * 60 * 60,
+                                   max_size * 1024 * 1024)
 
         return 0
                                                     
@@ -1879,7 +2223,8 @@ Valid formats are %s.
                            kind = kind)
 
                        
-    def __CreateResultStreams(self, output_file, annotations, expectations):
+    def __CreateResultStreams(self, output_file, annotations, expectations,
+                              append = False):
         """Return the result streams to use.
 
         'output_file' -- If not 'None', the name of a file to which
@@ -1888,6 +2233,9 @@ Valid formats are %s.
         'annotations' -- A dictionary with annotations for this test run.
 
         'expectations' -- An ExpectationDatabase.
+
+        'append' -- If true, results are added to those already in
+        'output_file'.
         
         returns -- A list of 'ResultStream' objects, as indicated by the
         user."""
@@ -1927,8 +2275,10 @@ Valid formats are %s.
         # If there is an output file, create a standard results file on
         # that file.
         if output_file is not None:
-            rs = (self.GetFileResultStreamClass()
-                  ({ "filename" : output_file}))
+            args = { "filename" : output_file }
+            if append:
+                args["append"] = "true"
+            rs = self.GetFileResultStreamClass()(args)
             result_streams.append(rs)
 
         for name, value in annotations.iteritems():
@@ -0,0 +1,180 @@
+########################################################################
+#
+# File:   concurrency.py
+# Author: agent
+# Date:   2026-10-19
+#
+# Contents:
+#   QMTest ConcurrencyController class.
+#
+# Copyright (c) 2026 by CodeSourcery, LLC.  All rights reserved.
+#
+# For license terms see the file COPYING.
+#
+########################################################################
+
+########################################################################
+# Imports
+########################################################################
+
+import qm.platform
+from   qm.test.result import Result
+from   threading import Lock
+import time
+
+########################################################################
+# Classes
+########################################################################
+
+class ConcurrencyController(object):
+    """A 'ConcurrencyController' decides how many tests to run at once.
+
+    The controller starts by allowing one test per processor.  As
+    results arrive, it estimates the fraction of a processor that a
+    typical test keeps busy, using the resource usage annotations
+    recorded by the 'Target'.  Suites whose tests spend most of their
+    time waiting for I/O are allowed to run more tests than there are
+    processors; suites whose tests are CPU-bound are held to the
+    number of processors.
+
+    The controller also watches the system run queue and load
+    average.  If the machine is oversubscribed -- because the tests
+    themselves start parallel jobs, or because something else is
+    running -- the limit is lowered.
+
+    The limit moves by at most one step per adjustment interval so
+    that transient spikes do not cause the pool size to oscillate.
+
+    A 'ConcurrencyController' may be used from multiple threads."""
+
+    __weight = 0.25
+    """The weight given to each new sample of CPU utilization."""
+
+    def __init__(self, minimum = 1, maximum = None, processors = None,
+                 interval = 1.0):
+        """Construct a new 'ConcurrencyController'.
+
+        'minimum' -- The smallest number of tests that will ever be
+        run at once.
+
+        'maximum' -- The largest number of tests that will ever be
+        run at once.  If 'None', four times the number of processors
+        is used.
+
+        'processors' -- The number of processors available.  If
+        'None', the number of processors on this computer is used.
+
+        'interval' -- The minimum number of seconds between
+        adjustments of the limit."""
+
+        if processors is None:
+            processors = qm.platform.get_cpu_count()
+        self.__processors = max(1, processors)
+        self.__minimum = max(1, minimum)
+        if maximum is None:
+            maximum = 4 * self.__processors
+        self.__maximum = max(self.__minimum, maximum)
+        self.__interval = interval
+
+        self.__limit = self.__Clamp(self.__processors)
+        # No tests have completed, so nothing is known about their
+        # utilization.
+        self.__utilization = None
+        self.__last_adjustment = time.time()
+        self.__lock = Lock()
+
+
+    def GetLimit(self):
+        """Return the number of tests that should be run at once.
+
+        returns -- A positive integer."""
+
+        return self.__limit
+
+
+    def GetUtilization(self):
+        """Return the estimated CPU utilization of a typical test.
+
+        returns -- A floating-point number giving the fraction of a
+        processor used by a typical test, or 'None' if no estimate is
+        yet available."""
+
+        return self.__utilization
+
+
+    def NoteResult(self, result):
+        """Update the controller with the 'result' of a test.
+
+        'result' -- A 'Result' for a test that has just completed.
+
+        returns -- The new limit."""
+
+        utilization = self.__GetUtilization(result)
+        self.__lock.acquire()
+        try:
+            if utilization is not None:
+                if self.__utilization is None:
+                    self.__utilization = utilization
+                else:
+                    self.__utilization += (self.__weight
+                                           * (utilization
+                                              - self.__utilization))
+            now = time.time()
+            if now - self.__last_adjustment >= self.__interval:
+                self.__last_adjustment = now
+                self.__Adjust()
+            return self.__limit
+        finally:
+            self.__lock.release()
+
+
+    def __Adjust(self):
+        """Move the limit one step towards the ideal value."""
+
+        processors = self.__processors
+        # Work out how many tests would keep all of the processors
+        # busy without oversubscribing them.
+        if self.__utilization is None:
+            ideal = self.__limit
+        else:
+            floor = float(processors) / self.__maximum
+            ideal = int(round(processors / max(self.__utilization, floor)))
+
+        # If the system is already oversubscribed, do not add more
+        # work, whatever the utilization estimate says.
+        running = qm.platform.get_run_queue_length()
+        load = qm.platform.get_load_average()
+        if running is not None and running > processors:
+            ideal = min(ideal, self.__limit - 1)
+        elif load is not None and load > 1.5 * processors:
+            ideal = min(ideal, self.__limit - 1)
+
+        if ideal > self.__limit:
+            self.__limit = self.__Clamp(self.__limit + 1)
+        elif ideal < self.__limit:
+            self.__limit = self.__Clamp(self.__limit - 1)
+
+
+    def __Clamp(self, limit):
+        """Return 'limit', restricted to the permitted range."""
+
+        return min(max(limit, self.__minimum), self.__maximum)
+
+
+    def __GetUtilization(self, result):
+        """Return the CPU utilization of the test that produced 'result'.
+
+        returns -- The fraction of a processor used by the test, or
+        'None' if the 'result' does not contain enough information."""
+
+        try:
+            elapsed = float(result[Result.ELAPSED_TIME])
+            cpu = (float(result[Result.USER_TIME])
+                   + float(result[Result.SYSTEM_TIME]))
+        except (KeyError, ValueError):
+            return None
+        if elapsed <= 0:
+            return None
+        # A test that runs parallel jobs may use more than one
+        # processor.
+        return min(cpu / elapsed, float(self.__processors))
@@ -169,6 +169,27 @@ class ItemDescriptor:
         resource that must be available to this item."""
 
         return self.GetArguments().get(Runnable.RESOURCE_FIELD_ID, [])
+
+
+    def GetLocks(self):
+        """Return the locks held while this item runs.
+
+        returns -- A sequence of pairs '(name, limit)'.  The 'name' is
+        the name of the lock.  The 'limit' is the number of items that
+        may hold a shared lock at once, or zero if the lock is
+        exclusive."""
+
+        locks = []
+        for lock in self.GetArguments().get(Runnable.LOCK_FIELD_ID, []):
+            name, limit = lock, 0
+            if ":" in lock:
+                prefix, suffix = lock.rsplit(":", 1)
+                try:
+                    name, limit = prefix, max(int(suffix), 1)
+                except ValueError:
+                    pass
+            locks.append((name, limit))
+        return locks
         
     # Helper functions.
 
@@ -260,6 +281,17 @@ class TestDescriptor(ItemDescriptor):
         on targets in that group."""
 
         return self.GetArguments().get("target_group", ".*")
+
+
+    def GetSlots(self):
+        """Returns the number of target slots used by this test.
+
+        returns -- A positive integer."""
+
+        try:
+            return max(1, int(self.GetArguments().get("slots", 1)))
+        except ValueError:
+            return 1
     
         
     def Run(self, context, result):
@@ -764,6 +796,23 @@ class Database(qm.extension.Extension):
 
         return self.GetIds(self.TEST, directory, scan_subdirs)
 
+
+    def GetTestSourceFiles(self, test_id):
+        """Return the files from which the test named 'test_id' is made.
+
+        'test_id' -- A label naming the test.
+
+        returns -- A list of the paths to the files that determine the
+        outcome of the test, such that the test need not be run again
+        unless one of them changes, or 'None' if the files are not
+        known.  'qmtest run --changed-since' uses this list to select
+        the tests to run.
+
+        This method returns 'None'.  Derived classes may override
+        this method."""
+
+        return None
+
     # Methods that deal with suites.
 
     def GetSuite(self, suite_id):
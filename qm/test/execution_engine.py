@@ -17,10 +17,12 @@
 # Imports
 ########################################################################
 
+import heapq
 import os
 import qm.common
 import qm.queue
 from   qm.test.base import *
+from   qm.test.changes import SourceDigests
 import qm.test.cmdline
 import qm.test.database
 from   qm.test.expectation_database import ExpectationDatabase
@@ -53,7 +55,28 @@ class ExecutionEngine:
     The shedule is determined dynamically as the tests are executed
     based on which targets are idle and which are not.  Therefore, the
     testing load should be reasonably well balanced, even across a
-    heterogeneous network of testing machines."""
+    heterogeneous network of testing machines.
+
+    Where possible, a test that requires resources is run on a target
+    on which those resources have already been set up.
+
+    If planning is requested, the complete graph of prerequisites is
+    built before any tests are run.  Tests that lie at the start of
+    long chains of dependent tests are then run first, so that the
+    chains do not delay the end of the run.
+
+    If speculation is requested, a target that would otherwise be idle
+    may run a test whose prerequisites are still running, provided
+    that the test has no side effects.  The result of such a test is
+    not reported until its prerequisites have completed.  If one of
+    them has an unexpected outcome, the result is discarded and the
+    test is reported as 'UNTESTED', just as if it had not been run.
+
+    If backups are requested, then once every test has been started,
+    idle targets are given second copies of the tests that have been
+    running the longest.  The first result received for a test is
+    reported; the other is ignored.  This prevents a single slow
+    target from delaying the end of the run."""
 
 
     class __TestStatus(object):
@@ -179,6 +202,13 @@ class ExecutionEngine:
     __TARGET_BUSY = "BUSY"
     __TARGET_STARVING = "STARVING"
 
+    # A test whose resources are already set up on some other target
+    # may be set aside for that target, rather than setting up the
+    # resources again.  This is the number of tests that may be set
+    # aside for any one target before it is better to set the
+    # resources up elsewhere.
+    __AFFINITY_QUEUE_DEPTH = 2
+
 
     def __init__(self,
                  database,
@@ -186,7 +216,14 @@ class ExecutionEngine:
                  context,
                  targets,
                  result_streams = None,
-                 expectations = None):
+                 expectations = None,
+                 plan = 0,
+                 speculate = 0,
+                 backup = 0,
+                 completed = None,
+                 result_cache = None,
+                 resumable = 0,
+                 reused = None):
         """Set up a test run.
 
         'database' -- The 'Database' containing the tests that will be
@@ -203,7 +240,42 @@ class ExecutionEngine:
         'result_streams' -- A sequence of 'ResultStream' objects.  Each
         stream will be provided with results as they are available.
 
-        'expectations' -- If not 'None', an ExpectationDatabase object."""
+        'expectations' -- If not 'None', an ExpectationDatabase object.
+
+        'plan' -- If true, the prerequisites of all of the tests are
+        examined before any tests are run, and tests are run in order
+        of the length of the chains of tests that depend on them.
+
+        'speculate' -- If true, tests whose classes have no side
+        effects may be run before their prerequisites complete.
+
+        'backup' -- If true, tests that are still running when there
+        are no more tests to start may be run again on idle targets.
+        Only tests whose classes are idempotent are run again.
+
+        'completed' -- If not 'None', a map from the IDs of tests that
+        were run by an earlier, interrupted, test run to their
+        outcomes.  These tests are not run again, but their outcomes
+        are used to decide whether the tests that depend on them can
+        be run.  The IDs must not also appear in 'test_ids'.
+
+        'result_cache' -- If not 'None', a 'ResultCache'.  Tests whose
+        fingerprints match passing results in the cache are not run;
+        the cached results are reported instead.  The results of tests
+        that pass are added to the cache.
+
+        'resumable' -- If true, the test run can be resumed if it is
+        interrupted, so the results of tests that were still running
+        when it was interrupted are discarded; those tests are run
+        again when the test run is resumed.  Otherwise, those results
+        are reported, with the 'Result.INTERRUPTED' annotation.
+
+        'reused' -- If not 'None', a map from the IDs of tests that
+        need not be run again to their 'Result's from an earlier test
+        run.  These results are reported, with the 'Result.CACHED'
+        annotation, and their outcomes are used to decide whether the
+        tests that depend on them can be run.  The IDs must not also
+        appear in 'test_ids'."""
 
         self.__database = database
         self.__test_ids = test_ids
@@ -217,6 +289,19 @@ class ExecutionEngine:
             self.__expectations = expectations
         else:
             self.__expectations = ExpectationDatabase(test_database = database)
+        self.__plan = plan
+        self.__speculate = speculate
+        self.__backup = backup
+        if completed is not None:
+            self.__completed = completed
+        else:
+            self.__completed = {}
+        self.__result_cache = result_cache
+        self.__resumable = resumable
+        if reused is not None:
+            self.__reused = reused
+        else:
+            self.__reused = {}
 
         # There are no input handlers.
         self.__input_handlers = {}
@@ -230,6 +315,8 @@ class ExecutionEngine:
         
         # Termination has not yet been requested.
         self.__terminated = 0
+        # The test loop has not been aborted.
+        self.__aborted = 0
         
 
     def RequestTermination(self):
@@ -276,6 +363,7 @@ class ExecutionEngine:
             except:
                 self._Trace("Test loop exited with exception: %s"
                             % str(sys.exc_info()))
+                self.__aborted = 1
                 for rs in self.__result_streams:
                     rs.WriteAnnotation("qmtest.run.aborted", "true")
                 raise
@@ -315,6 +403,15 @@ class ExecutionEngine:
         self.__input_handlers[fd] = function
         
 
+    def RemoveInputHandler(self, fd):
+        """Stop monitoring a file descriptor.
+
+        'fd' -- A file descriptor previously passed to
+        'AddInputHandler'."""
+
+        del self.__input_handlers[fd]
+
+
     def _RunTests(self):
 
         num_tests = len(self.__test_ids)
@@ -329,6 +426,16 @@ class ExecutionEngine:
         self.__statuses = {}
         for id in self.__test_ids:
             self.__statuses[id] = self.__TestStatus()
+        # Tests run by an earlier test run have already finished.
+        for id, outcome in self.__completed.iteritems():
+            status = self.__TestStatus()
+            status.outcome = outcome
+            self.__statuses[id] = status
+        # So have the tests whose earlier results are reused.
+        for id, result in self.__reused.iteritems():
+            status = self.__TestStatus()
+            status.outcome = result.GetOutcome()
+            self.__statuses[id] = status
 
         # A stack of tests.  If a test has prerequisites, the
         # prerequisites will appear nearer to the top of the stack.
@@ -357,6 +464,80 @@ class ExecutionEngine:
         # A map from target patterns to lists of test descriptors ready
         # to run.
         self.__target_pattern_queues = {}
+        # A map from targets to lists of test descriptors that have
+        # been set aside for them because their resources are already
+        # set up there.
+        self.__affinity_queues = {}
+        for target in self.__targets:
+            self.__affinity_queues[target] = []
+        # A map from test IDs to the lengths of the longest chains of
+        # tests that depend on them.  Tests with higher priorities are
+        # run first.
+        self.__priorities = {}
+        # The number of tests added to the target pattern queues.
+        self.__num_tests_queued = 0
+        # A map from test IDs to descriptors that have already been
+        # loaded, but whose tests have not yet started.
+        self.__descriptors = {}
+        # A map from the IDs of tests that are waiting for their
+        # prerequisites to complete to their descriptors.
+        self.__waiting_tests = {}
+        # A map from the IDs of the tests that have been given to
+        # targets, and whose results have not been received, to tuples
+        # '(start_time, descriptor, target)'.  Tests run speculatively
+        # are not included.
+        self.__tests_in_progress = {}
+        # A map from the IDs of tests that have been given to a second
+        # target to the list of targets running them.
+        self.__backups = {}
+        # A map from the IDs of tests to the number of results for
+        # those tests that will be ignored if they arrive.
+        self.__abandoned = {}
+        # A map from the IDs of tests that have been run speculatively
+        # to '__Speculation' objects.
+        self.__speculations = {}
+        # A map from targets to the number of slots used by the tests
+        # running on them.
+        self.__slots_in_use = {}
+        for target in self.__targets:
+            self.__slots_in_use[target] = 0
+        # A map from test IDs to lists of pairs '(target, slots)'
+        # giving the slots used by the running copies of the test.
+        self.__claimed_slots = {}
+        # A map from targets to tests that are waiting for enough slots
+        # on those targets to become free.
+        self.__reserved_tests = {}
+        # A map from lock names to pairs '(exclusive, count)'.  The
+        # 'exclusive' flag is true if the lock is held exclusively;
+        # 'count' is the number of running tests that hold it.
+        self.__lock_holders = {}
+        # A map from the IDs of running tests to the locks they hold.
+        self.__held_locks = {}
+        # A map from resource names to the locks needed by those
+        # resources.
+        self.__resource_locks = {}
+        # A list of descriptors for ready tests that are waiting for
+        # locks held by running tests.
+        self.__blocked_tests = []
+        # A map from the IDs of tests that have been started to their
+        # fingerprints, if their results are to be added to the
+        # result cache.
+        self.__fingerprints = {}
+        # A map from the IDs of tests that have been started to the
+        # digests of their source files.
+        self.__source_digests = {}
+        self.__digests = SourceDigests()
+        # A map whose keys are the IDs of the tests that are
+        # prerequisites of other tests.  The values are unused.
+        self.__prerequisites = {}
+        if self.__result_cache is not None:
+            self.__FindPrerequisites()
+
+        if self.__plan:
+            self.__Plan()
+
+        for id in self.__reused.keys():
+            self.__ReportReusedResult(id)
         
         while self.__num_tests_started < num_tests:
             # If the user interrupted QMTest, stop executing tests.
@@ -399,6 +580,9 @@ class ExecutionEngine:
         # have wait for them all to finish.
         self._Trace("Waiting for remaining tests to finish.")
         while self.__running:
+            # Give idle targets copies of the slowest tests.
+            if self.__backup:
+                self.__StartBackups()
             self.__CheckForResponse(wait=1)
 
 
@@ -412,30 +596,605 @@ class ExecutionEngine:
 
         self._Trace("Looking for a test for target %s" % target.GetName())
 
-        # See if there is already a ready-to-run test for this target.
-        for pattern in self.__patterns.get(target.GetGroup(), []):
-            tests = self.__target_pattern_queues.get(pattern, [])
-            if tests:
-                descriptor = tests.pop()
-                break
-        else:
-            # There was no ready-to-run test queued, so try to find one
-            # another one.
-            descriptor = self.__FindRunnableTest(target)
+        # A test that is waiting for slots on this target comes first.
+        descriptor = self.__reserved_tests.get(target)
+        if descriptor is not None:
+            if (not self.__HasCapacity(target, descriptor)
+                or not self.__CanLock(descriptor, 0)):
+                # Let the tests already running finish.
+                return 0
+            del self.__reserved_tests[target]
+        while descriptor is None:
+            descriptor = self.__GetNextTest(target)
             if descriptor is None:
-                # There really are no more tests ready to run.
+                break
+            self.__NoteSourceDigest(descriptor.GetId())
+            if self.__ReplayResult(descriptor):
+                # The test need not be run; look for another.
+                descriptor = None
+                continue
+            if not self.__CanLock(descriptor):
+                # Set the test aside until the locks are released,
+                # and look for another test.
+                self._Trace("%s is waiting for a lock"
+                            % descriptor.GetId())
+                self.__blocked_tests.append(descriptor)
+                descriptor = None
+                continue
+            if self.__HasCapacity(target, descriptor):
+                break
+            # The test needs more slots than are free.  Give it to
+            # another target that has enough, if there is one.
+            other = self.__FindTargetWithCapacity(target, descriptor)
+            if other is None:
+                # Otherwise, run no more tests on this target until
+                # enough slots are free.  If smaller tests were run
+                # instead, the test might never be run.
+                self._Trace("Reserving %s on %s"
+                            % (descriptor.GetId(), target.GetName()))
+                self.__reserved_tests[target] = descriptor
                 return 0
+            self.__SetAside(other, descriptor)
+            descriptor = None
+        if descriptor is None and self.__speculate:
+            # Rather than sit idle, run a test whose prerequisites
+            # have not yet completed.
+            descriptor = self.__FindSpeculativeTest(target)
+            if descriptor is not None:
+                self.__RunSpeculativeTest(target, descriptor)
+                return 1
+        if descriptor is None:
+            # There really are no more tests ready to run.
+            return 0
                 
         target_name = target.GetName()
         test_id = descriptor.GetId()
+        # The descriptor will not be needed again.
+        if self.__descriptors.has_key(test_id):
+            del self.__descriptors[test_id]
         self._Trace("Running %s on %s" % (test_id, target_name))
         assert self.__statuses[test_id].GetState() == self.__TestStatus.READY
         self.__num_tests_started += 1
         self.__running += 1
+        self.__tests_in_progress[test_id] \
+            = (time.time(), descriptor, target)
+        self.__ClaimSlots(target, descriptor)
+        self.__AcquireLocks(descriptor)
+        target.RunTest(descriptor, self.__context)
+        return 1
+
+
+    def __GetNextTest(self, target):
+        """Return the next test to run on 'target'.
+
+        'target' -- The 'Target' on which the test will run.
+
+        returns -- The 'TestDescriptor' for a ready test, or 'None' if
+        there is no such test.  Tests that were waiting for locks
+        that are now free come first, followed by tests that were set
+        aside for 'target'."""
+
+        for index in xrange(len(self.__blocked_tests)):
+            descriptor = self.__blocked_tests[index]
+            if (target.IsInGroup(descriptor.GetTargetGroup())
+                and self.__CanLock(descriptor, index)):
+                del self.__blocked_tests[index]
+                return descriptor
+        # Tests that were set aside for this target come first.
+        affinity_queue = self.__affinity_queues[target]
+        if affinity_queue:
+            return affinity_queue.pop(0)
+        set_aside = None
+        descriptor = self.__GetReadyTest(target)
+        if descriptor is not None:
+            # If the resources needed by the test are already set
+            # up on another target, let that target run it.
+            other = self.__FindAffineTarget(target, descriptor)
+            if other is None:
+                return descriptor
+            self.__SetAside(other, descriptor)
+            set_aside = descriptor
+            # Set at most one test aside, so that the remaining tests
+            # are still run in the order in which they were planned.
+            descriptor = self.__GetReadyTest(target)
+            if descriptor is not None:
+                return descriptor
+        # Rather than sit idle, take a test that was set aside for
+        # another target -- but not the one just set aside, which
+        # would defeat the purpose of setting it aside.
+        return self.__StealAffineTest(target, set_aside)
+
+
+    def __SetAside(self, target, descriptor):
+        """Set 'descriptor' aside to be run on 'target'.
+
+        'target' -- The 'Target' that will run the test.
+
+        'descriptor' -- The 'TestDescriptor' for a ready test."""
+
+        self._Trace("Setting %s aside for %s"
+                    % (descriptor.GetId(), target.GetName()))
+        self.__affinity_queues[target].append(descriptor)
+        if self.__target_state[target] == self.__TARGET_STARVING:
+            self.__target_state[target] = self.__TARGET_IDLE
+            self.__has_idle_targets = 1
+
+
+    def __GetSlots(self, target, descriptor):
+        """Return the number of slots 'descriptor' will use on 'target'.
+
+        'target' -- A 'Target'.
+
+        'descriptor' -- A 'TestDescriptor'.
+
+        returns -- The number of slots requested by the test, or the
+        number of slots on 'target', whichever is smaller.  A test that
+        needs more slots than the target has is run on its own."""
+
+        return min(descriptor.GetSlots(), target.GetCapacity())
+
+
+    def __HasCapacity(self, target, descriptor):
+        """Return true if 'descriptor' fits in the free slots on 'target'.
+
+        'target' -- A 'Target'.
+
+        'descriptor' -- A 'TestDescriptor'."""
+
+        return (self.__slots_in_use[target]
+                + self.__GetSlots(target, descriptor)
+                <= target.GetCapacity())
+
+
+    def __FindTargetWithCapacity(self, target, descriptor):
+        """Return another target on which 'descriptor' could run now.
+
+        'target' -- The 'Target' that does not have enough free slots.
+
+        'descriptor' -- The 'TestDescriptor' for the test.
+
+        returns -- A 'Target' that is not busy, is not waiting to run
+        a test of its own, and has enough free slots, or 'None' if
+        there is no such target."""
+
+        pattern = descriptor.GetTargetGroup()
+        for other in self.__targets:
+            if (other is not target
+                and self.__target_state[other] != self.__TARGET_BUSY
+                and not self.__reserved_tests.has_key(other)
+                and other.IsInGroup(pattern)
+                and self.__HasCapacity(other, descriptor)):
+                return other
+        return None
+
+
+    def __ClaimSlots(self, target, descriptor):
+        """Note that 'descriptor' is about to be run on 'target'.
+
+        'target' -- The 'Target' that will run the test.
+
+        'descriptor' -- The 'TestDescriptor' for the test."""
+
+        slots = self.__GetSlots(target, descriptor)
+        self.__slots_in_use[target] += slots
+        self.__claimed_slots.setdefault(descriptor.GetId(), []) \
+            .append((target, slots))
+
+
+    def __ReleaseSlots(self, test_id, target):
+        """Note that 'test_id' is no longer running on 'target'.
+
+        'test_id' -- The name of a test.
+
+        'target' -- The 'Target' that was running the test."""
+
+        claims = self.__claimed_slots.get(test_id)
+        if not claims:
+            return
+        for claim in claims:
+            if claim[0] is target:
+                claims.remove(claim)
+                self.__slots_in_use[target] -= claim[1]
+                break
+        if not claims:
+            del self.__claimed_slots[test_id]
+
+
+    def __GetLocks(self, descriptor):
+        """Return the locks needed to run 'descriptor'.
+
+        'descriptor' -- A 'TestDescriptor' or 'ResourceDescriptor'.
+
+        returns -- A map from lock names to limits, as for
+        'ItemDescriptor.GetLocks'.  The locks needed by the resources
+        that the item uses, directly or indirectly, are included.  If
+        the same lock is needed more than once, the most restrictive
+        limit is used.  Resources that cannot be loaded need no locks."""
+
+        locks = {}
+        requests = list(descriptor.GetLocks())
+        for resource in descriptor.GetResources():
+            if not self.__resource_locks.has_key(resource):
+                # Guard against resources that depend on themselves.
+                self.__resource_locks[resource] = {}
+                try:
+                    d = self.__database.GetResource(resource)
+                except:
+                    # The resource is treated as needing no locks; the
+                    # error is reported when it is set up.
+                    continue
+                self.__resource_locks[resource] = self.__GetLocks(d)
+            requests.extend(self.__resource_locks[resource].items())
+        for name, limit in requests:
+            if locks.has_key(name):
+                old = locks[name]
+                if not old or not limit:
+                    limit = 0
+                else:
+                    limit = min(old, limit)
+            locks[name] = limit
+        return locks
+
+
+    def __CanLock(self, descriptor, ahead = None):
+        """Return true if the locks needed by 'descriptor' are free.
+
+        'descriptor' -- A 'TestDescriptor'.
+
+        'ahead' -- The number of blocked tests that are ahead of
+        'descriptor', or 'None' if all of them are.
+
+        A lock that a blocked test ahead of 'descriptor' needs
+        exclusively is not shared with 'descriptor', so that the
+        blocked test runs once the tests already holding the lock
+        finish."""
+
+        blocked = self.__blocked_tests[:ahead]
+        for name, limit in self.__GetLocks(descriptor).items():
+            if limit:
+                for d in blocked:
+                    locks = self.__GetLocks(d)
+                    if locks.has_key(name) and not locks[name]:
+                        return 0
+            holders = self.__lock_holders.get(name)
+            if holders is None:
+                continue
+            exclusive, count = holders
+            if exclusive or not limit or count >= limit:
+                return 0
+        return 1
+
+
+    def __AcquireLocks(self, descriptor):
+        """Note that 'descriptor' holds its locks.
+
+        'descriptor' -- The 'TestDescriptor' for a test that is about
+        to be run.  The locks it needs must be free."""
+
+        locks = self.__GetLocks(descriptor)
+        if not locks:
+            return
+        for name, limit in locks.items():
+            exclusive, count = self.__lock_holders.get(name, (0, 0))
+            self.__lock_holders[name] = (exclusive or not limit, count + 1)
+        self.__held_locks[descriptor.GetId()] = locks
+
+
+    def __ReleaseLocks(self, test_id):
+        """Release the locks held by 'test_id'.
+
+        'test_id' -- The name of a test that is no longer running."""
+
+        locks = self.__held_locks.pop(test_id, None)
+        if not locks:
+            return
+        for name in locks:
+            exclusive, count = self.__lock_holders[name]
+            if count == 1:
+                del self.__lock_holders[name]
+            else:
+                self.__lock_holders[name] = (exclusive, count - 1)
+        # Tests that were waiting for the locks may now be able to
+        # run.
+        for target in self.__targets:
+            if self.__target_state[target] == self.__TARGET_STARVING:
+                self.__target_state[target] = self.__TARGET_IDLE
+                self.__has_idle_targets = 1
+
+
+    def __StartBackups(self):
+        """Run copies of the longest-running tests on idle targets."""
+
+        for target in self.__targets:
+            if self.__target_state[target] == self.__TARGET_BUSY:
+                continue
+            if not target.IsIdle():
+                continue
+            descriptor = self.__FindStraggler(target)
+            if descriptor is None:
+                continue
+            test_id = descriptor.GetId()
+            self._Trace("Running backup of %s on %s"
+                        % (test_id, target.GetName()))
+            original = self.__tests_in_progress[test_id][2]
+            self.__backups[test_id] = [original, target]
+            self.__running += 1
+            self.__ClaimSlots(target, descriptor)
+            target.RunTest(descriptor, self.__context)
+            if target.IsIdle():
+                self.__target_state[target] = self.__TARGET_IDLE
+            else:
+                self.__target_state[target] = self.__TARGET_BUSY
+            
+
+    def __FindStraggler(self, target):
+        """Return the running test that most needs a backup.
+
+        'target' -- The 'Target' on which the backup would be run.
+
+        returns -- The 'TestDescriptor' for the test that has been
+        running for the longest time, and can be run on 'target', or
+        'None' if there is no such test.  Tests that already have a
+        backup, tests already running on 'target', tests that hold
+        locks, and tests whose classes are not idempotent, are not
+        considered."""
+
+        straggler = None
+        for test_id, (start_time, descriptor, t) \
+                in self.__tests_in_progress.items():
+            # A second copy on the same target would be no faster.
+            if self.__backups.has_key(test_id) or t is target:
+                continue
+            if straggler is not None and start_time >= straggler[0]:
+                continue
+            if not target.IsInGroup(descriptor.GetTargetGroup()):
+                continue
+            if not self.__HasCapacity(target, descriptor):
+                continue
+            # A second copy of a test would hold its locks twice.
+            if self.__GetLocks(descriptor):
+                continue
+            try:
+                if not descriptor.GetClass().idempotent:
+                    continue
+            except:
+                continue
+            straggler = (start_time, descriptor)
+
+        if straggler is None:
+            return None
+        return straggler[1]
+        
+
+    class __Speculation(object):
+        """A '__Speculation' records a test run speculatively.
+
+        The 'descriptor' slot is the 'TestDescriptor' for the test.
+
+        The 'result' slot is the 'Result' of the test, if it has been
+        received, but not yet reported.  Otherwise, it is 'None'.
+
+        The 'state' slot is 'PENDING' until all of the prerequisites
+        of the test have completed.  It then becomes 'CONFIRMED' if
+        the prerequisites had the expected outcomes, and 'DISCARDED'
+        otherwise."""
+
+        __slots__ = "descriptor", "result", "state"
+
+        PENDING = "PENDING"
+        CONFIRMED = "CONFIRMED"
+        DISCARDED = "DISCARDED"
+
+        def __init__(self, descriptor):
+
+            self.descriptor = descriptor
+            self.result = None
+            self.state = self.PENDING
+
+
+    def __FindSpeculativeTest(self, target):
+        """Return a test that can be run speculatively on 'target'.
+
+        'target' -- The 'Target' on which the test will run.
+
+        returns -- The 'TestDescriptor' for a test that is waiting for
+        its prerequisites, or 'None' if there is no suitable test.  A
+        test is suitable only if its class has no side effects and
+        all of the prerequisites it is waiting for are running."""
+
+        for test_id, descriptor in self.__waiting_tests.items():
+            status = self.__statuses[test_id]
+            if status.HasBeenReady():
+                # This test is no longer waiting.
+                del self.__waiting_tests[test_id]
+                continue
+            if not target.IsInGroup(descriptor.GetTargetGroup()):
+                continue
+            if (not self.__HasCapacity(target, descriptor)
+                or not self.__CanLock(descriptor)):
+                continue
+            try:
+                if not descriptor.GetClass().side_effect_free:
+                    continue
+            except:
+                continue
+            for p in descriptor.GetPrerequisites():
+                if (self.__statuses.has_key(p)
+                    and not self.__statuses[p].IsFinished()
+                    and not self.__tests_in_progress.has_key(p)):
+                    break
+            else:
+                del self.__waiting_tests[test_id]
+                return descriptor
+
+        return None
+
+
+    def __RunSpeculativeTest(self, target, descriptor):
+        """Run a test before its prerequisites have completed.
+
+        'target' -- The 'Target' on which the test should be run.
+
+        'descriptor' -- The 'TestDescriptor' for the test."""
+
+        test_id = descriptor.GetId()
+        self._Trace("Running %s speculatively on %s"
+                    % (test_id, target.GetName()))
+        self.__statuses[test_id].NoteReady()
+        self.__speculations[test_id] = self.__Speculation(descriptor)
+        self.__NoteSourceDigest(test_id)
+        # The test is not counted as started until its prerequisites
+        # have completed.
+        self.__running += 1
+        self.__ClaimSlots(target, descriptor)
+        self.__AcquireLocks(descriptor)
         target.RunTest(descriptor, self.__context)
+
+
+    def __CheckSpeculation(self, test_id):
+        """Check a speculative test after one of its prerequisites completes.
+
+        'test_id' -- The name of a test that has been run
+        speculatively."""
+
+        speculation = self.__speculations[test_id]
+        if speculation.state != speculation.PENDING:
+            return
+        # Remove the speculation while checking the prerequisites so
+        # that an 'UNTESTED' result for the test is recorded as usual.
+        del self.__speculations[test_id]
+        prereqs = self.__GetPendingPrerequisites(speculation.descriptor)
+        if prereqs:
+            # Some of the prerequisites are still running.
+            self.__speculations[test_id] = speculation
+            return
+        if prereqs is None:
+            # A prerequisite had an unexpected outcome, so an
+            # 'UNTESTED' result has been recorded.
+            self._Trace("Discarding speculative result for %s" % test_id)
+            speculation.state = speculation.DISCARDED
+        else:
+            self._Trace("Confirmed speculative result for %s" % test_id)
+            self.__num_tests_started += 1
+            speculation.state = speculation.CONFIRMED
+        if speculation.result is None:
+            # Wait for the result to arrive.
+            self.__speculations[test_id] = speculation
+        elif speculation.state == speculation.CONFIRMED:
+            self.__AddResult(speculation.result)
+
+
+    def __NoteSpeculativeResult(self, result):
+        """Note the 'result' of a test that was run speculatively.
+
+        'result' -- The 'Result' for a test run speculatively.
+
+        returns -- True if the 'result' should be reported now."""
+
+        test_id = result.GetId()
+        speculation = self.__speculations[test_id]
+        if speculation.state == speculation.PENDING:
+            # Hold on to the result until the prerequisites complete.
+            speculation.result = result
+            return 0
+        del self.__speculations[test_id]
+        return speculation.state == speculation.CONFIRMED
+
+
+    def __GetReadyTest(self, target):
+        """Return a test that is ready to run on 'target'.
+
+        'target' -- The 'Target' on which the test will run.
+
+        returns -- The 'TestDescriptor' for a ready test, or 'None' if
+        no test could be found that will run on 'target'."""
+
+        # See if there is already a ready-to-run test for this target.
+        # If there are tests in more than one queue, take the test
+        # that should be run first.
+        best = None
+        for pattern in self.__patterns.get(target.GetGroup(), []):
+            tests = self.__target_pattern_queues.get(pattern)
+            if tests and (best is None or tests[0] < best[0]):
+                best = tests
+        if best is not None:
+            return heapq.heappop(best)[1]
+        # There was no ready-to-run test queued, so try to find
+        # another one.
+        return self.__FindRunnableTest(target)
+
+
+    def __FindAffineTarget(self, target, descriptor):
+        """Return a better target on which to run 'descriptor'.
+
+        'target' -- The 'Target' that is about to run the test.
+
+        'descriptor' -- The 'TestDescriptor' for the test.
+
+        returns -- Another 'Target' on which all of the resources
+        required by the test have already been set up, or 'None' if
+        the test should be run on 'target'.  If 'target' already has
+        the resources, or if the other targets already have enough
+        tests set aside for them, 'None' is returned."""
+
+        resources = descriptor.GetResources()
+        if not resources or self.__HasResources(target, resources):
+            return None
+        pattern = descriptor.GetTargetGroup()
+        for other in self.__targets:
+            if (other is not target
+                and (len(self.__affinity_queues[other])
+                     < self.__AFFINITY_QUEUE_DEPTH)
+                and other.IsInGroup(pattern)
+                and self.__HasResources(other, resources)):
+                return other
+        return None
+
+
+    def __HasResources(self, target, resources):
+        """Return true if 'resources' are all set up on 'target'.
+
+        'target' -- A 'Target'.
+
+        'resources' -- A sequence of resource names."""
+
+        for resource in resources:
+            if not target.HasResource(resource):
+                return 0
         return 1
 
 
+    def __StealAffineTest(self, target, exclude = None):
+        """Return a test that was set aside for another target.
+
+        'target' -- The 'Target' that will run the test.
+
+        'exclude' -- If not 'None', a 'TestDescriptor' that must not be
+        taken.
+
+        returns -- A 'TestDescriptor' taken from the longest queue of
+        tests set aside for other targets that 'target' can run, or
+        'None' if there is no such test.  Tests are only taken from
+        targets that are busy; an idle target will soon run the tests
+        set aside for it."""
+
+        longest = None
+        for other, queue in self.__affinity_queues.items():
+            if (other is target
+                or self.__target_state[other] != self.__TARGET_BUSY):
+                continue
+            for index in xrange(len(queue) - 1, -1, -1):
+                if (queue[index] is not exclude
+                    and target.IsInGroup(queue[index].GetTargetGroup())):
+                    if longest is None or len(queue) > len(longest[0]):
+                        longest = (queue, index)
+                    break
+        if longest is None:
+            return None
+        queue, index = longest
+        return queue.pop(index)
+
+
     def __FindRunnableTest(self, target):
         """Return a test that is ready to run.
 
@@ -517,6 +1276,7 @@ class ExecutionEngine:
                 if prereqs:
                     for p in prereqs:
                         self.__statuses[p].NoteDependant(test_id)
+                    self.__waiting_tests[test_id] = descriptor
                     # Keep looking for a runnable test.                        
                     continue
 
@@ -601,8 +1361,206 @@ class ExecutionEngine:
                                      "No target matching %s." % pattern)
             return
 
+        # The queue is a heap.  The tests with the highest priority
+        # are run first.  When planning, tests with the same priority
+        # are run in the order in which they were queued; otherwise,
+        # the most recently queued test is run first.
+        self.__num_tests_queued += 1
+        if self.__plan:
+            order = self.__num_tests_queued
+        else:
+            order = -self.__num_tests_queued
+        key = (-self.__priorities.get(test_id, 0), order)
         queue = self.__target_pattern_queues.setdefault(pattern, [])
-        queue.append(descriptor)
+        heapq.heappush(queue, (key, descriptor))
+
+
+    def __Plan(self):
+        """Examine the prerequisites of all of the tests to be run.
+
+        Loads the descriptors for all of the tests, records 'UNTESTED'
+        results for tests that cannot be run because of missing or
+        cyclic prerequisites, computes the priority of each test, and
+        queues the tests that are ready to run.  The remaining tests
+        are run as their prerequisites complete."""
+
+        self._Trace("Planning test run.")
+        
+        # Load all of the descriptors, and find the prerequisites of
+        # each test.
+        prerequisites = {}
+        for test_id in self.__test_ids:
+            self.__statuses[test_id].NoteQueued()
+            descriptor = self.__GetTestDescriptor(test_id)
+            if not descriptor:
+                continue
+            for p in descriptor.GetPrerequisites():
+                if not self.__database.HasTest(p):
+                    self.__AddUntestedResult(
+                        test_id,
+                        qm.message("prerequisite not in database",
+                                   prerequisite = p)
+                        )
+                    break
+            else:
+                self.__descriptors[test_id] = descriptor
+                # Ignore prerequisites that are not going to be run at
+                # all.
+                prerequisites[test_id] \
+                    = filter(self.__statuses.has_key,
+                             descriptor.GetPrerequisites().keys())
+
+        # Tests that cannot be loaded have already been given results.
+        for test_id, prereqs in prerequisites.items():
+            prerequisites[test_id] \
+                = filter(prerequisites.has_key, prereqs)
+
+        # Break each dependency cycle by marking one of its tests
+        # UNTESTED, just as when the tests are examined one at a
+        # time.  The other tests in the cycle may then be able to run.
+        # Only the tests in the cycles need to be examined again.
+        position = {}
+        for i in xrange(len(self.__test_ids)):
+            position[self.__test_ids[i]] = i
+        graph = prerequisites
+        while graph:
+            remaining = {}
+            for component in self.__FindCycles(graph):
+                # Choose the test that would have been examined first.
+                test_id = min(component, key = position.get)
+                self._Trace("Cycle detected (%s)" % (test_id,))
+                del prerequisites[test_id]
+                del self.__descriptors[test_id]
+                self.__AddUntestedResult(test_id,
+                                         qm.message("dependency cycle"))
+                for t in component:
+                    if t != test_id:
+                        remaining[t] = None
+            for test_id, prereqs in prerequisites.items():
+                prerequisites[test_id] \
+                    = filter(prerequisites.has_key, prereqs)
+            graph = {}
+            for test_id in remaining.keys():
+                graph[test_id] = filter(remaining.has_key,
+                                        prerequisites[test_id])
+
+        # Compute the priorities.
+        self.__priorities = self.__ComputePriorities(prerequisites)
+
+        # Queue the tests that are ready to run, and arrange to be
+        # notified when the prerequisites of the others complete.
+        for test_id in self.__test_ids:
+            descriptor = self.__descriptors.get(test_id)
+            if descriptor is None:
+                continue
+            prereqs = self.__GetPendingPrerequisites(descriptor)
+            if prereqs is None:
+                continue
+            if prereqs:
+                for p in prereqs:
+                    self.__statuses[p].NoteDependant(test_id)
+                self.__waiting_tests[test_id] = descriptor
+            else:
+                self.__AddToTargetPatternQueue(descriptor)
+
+        # All of the tests have been handled; there is no need to look
+        # for any more.
+        self.__tests_iterator = iter(())
+
+
+    def __FindCycles(self, prerequisites):
+        """Find the cycles in a graph of tests.
+
+        'prerequisites' -- A map from test IDs to lists of the IDs of
+        their prerequisites.
+
+        returns -- A list of the strongly connected components of the
+        graph that contain cycles.  Each component is a list of test
+        IDs.  Every prerequisite must itself be a key in
+        'prerequisites'.
+
+        This method uses Tarjan's algorithm, which takes time
+        proportional to the size of the graph."""
+
+        index = {}
+        lowlink = {}
+        stack = []
+        on_stack = {}
+        cycles = []
+        for root in prerequisites.keys():
+            if index.has_key(root):
+                continue
+            # Each element of 'work' is a node, together with an
+            # iterator over the prerequisites not yet visited.
+            index[root] = lowlink[root] = len(index)
+            stack.append(root)
+            on_stack[root] = None
+            work = [(root, iter(prerequisites[root]))]
+            while work:
+                node, prereqs = work[-1]
+                for p in prereqs:
+                    if not index.has_key(p):
+                        index[p] = lowlink[p] = len(index)
+                        stack.append(p)
+                        on_stack[p] = None
+                        work.append((p, iter(prerequisites[p])))
+                        break
+                    elif on_stack.has_key(p):
+                        lowlink[node] = min(lowlink[node], index[p])
+                else:
+                    # All of the prerequisites have been visited.
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        lowlink[parent] = min(lowlink[parent],
+                                              lowlink[node])
+                    if lowlink[node] == index[node]:
+                        component = []
+                        while 1:
+                            n = stack.pop()
+                            del on_stack[n]
+                            component.append(n)
+                            if n == node:
+                                break
+                        if (len(component) > 1
+                            or node in prerequisites[node]):
+                            cycles.append(component)
+        return cycles
+
+
+    def __ComputePriorities(self, prerequisites):
+        """Compute the priorities of the tests in an acyclic graph.
+
+        'prerequisites' -- A map from test IDs to lists of the IDs of
+        their prerequisites.  The graph must not contain cycles.
+
+        returns -- A map from test IDs to priorities.  The priority of
+        a test is the number of tests in the longest chain of tests
+        that depend on it, including the test itself."""
+
+        dependants = {}
+        counts = {}
+        for test_id, prereqs in prerequisites.items():
+            counts[test_id] = len(prereqs)
+            for p in prereqs:
+                dependants.setdefault(p, []).append(test_id)
+        # Order the tests so that every test comes after its
+        # prerequisites.
+        order = filter(lambda t: not counts[t], prerequisites.keys())
+        for test_id in order:
+            for d in dependants.get(test_id, ()):
+                counts[d] -= 1
+                if not counts[d]:
+                    order.append(d)
+        # Work backwards from the tests on which nothing depends.
+        priorities = {}
+        order.reverse()
+        for test_id in order:
+            priority = 0
+            for d in dependants.get(test_id, ()):
+                priority = max(priority, priorities[d])
+            priorities[test_id] = priority + 1
+        return priorities
 
 
     def __GetPendingPrerequisites(self, descriptor):
@@ -680,6 +1638,40 @@ class ExecutionEngine:
             
         # Only tests have expectations or scheduling dependencies.
         if result.GetKind() == Result.TEST:
+            if target:
+                # A result with no target was made up here, rather
+                # than reported by a target.  A test that is still
+                # running, such as a discarded speculative test, keeps
+                # its slots and locks until its own result arrives.
+                self.__ReleaseSlots(id, target)
+                self.__ReleaseLocks(id)
+            if self.__tests_in_progress.has_key(id):
+                del self.__tests_in_progress[id]
+            # Only the first of the results for a test that was run
+            # twice is reported.
+            if self.__abandoned.has_key(id):
+                self._Trace("Ignoring second result for %s." % id)
+                return
+            if self.__backups.has_key(id):
+                # Stop waiting for the other copy of the test.
+                for t in self.__backups[id]:
+                    if t is not target:
+                        self.__ReleaseSlots(id, t)
+                        self.__running -= 1
+                        self.__abandoned[id] = self.__abandoned.get(id, 0) + 1
+                        t.CancelTest(id)
+                del self.__backups[id]
+            # The results of speculative tests are held back until the
+            # prerequisites have completed.
+            if (self.__speculations.has_key(id)
+                and not self.__NoteSpeculativeResult(result)):
+                # The target that ran the test may be able to run
+                # another.
+                for t in self.__targets:
+                    if self.__target_state[t] == self.__TARGET_STARVING:
+                        self.__target_state[t] = self.__TARGET_IDLE
+                return
+            
             # Record the outcome for this test.
             test_status = self.__statuses[id]
             test_status.outcome = result.GetOutcome()
@@ -688,7 +1680,9 @@ class ExecutionEngine:
             # may now be ready to execute.
             if test_status.dependants:
                 for dependant in test_status.dependants:
-                    if not self.__statuses[dependant].HasBeenReady():
+                    if self.__speculations.has_key(dependant):
+                        self.__CheckSpeculation(dependant)
+                    elif not self.__statuses[dependant].HasBeenReady():
                         descriptor = self.__GetTestDescriptor(dependant)
                         if not descriptor:
                             continue
@@ -714,6 +1708,34 @@ class ExecutionEngine:
                 if self.__target_state[t] == self.__TARGET_STARVING:
                     self.__target_state[t] = self.__TARGET_IDLE
             
+        # Record the state of the source files when the test started,
+        # for use by 'qmtest run --changed-since'.
+        if (result.GetKind() == Result.TEST
+            and self.__source_digests.has_key(id)):
+            result[Result.SOURCE_DIGEST] = self.__source_digests.pop(id)
+
+        # Add the results of tests that passed to the result cache.
+        if result.GetKind() == Result.TEST:
+            fingerprint = self.__fingerprints.pop(id, None)
+            if (fingerprint is not None
+                and result.GetOutcome() == Result.PASS):
+                try:
+                    self.__result_cache.Store(fingerprint, result)
+                except EnvironmentError:
+                    # A cache that cannot be written is no reason to
+                    # stop the test run.
+                    self._Trace("Could not cache result for %s." % id)
+
+        # Tests that were still running when the test loop was aborted
+        # have probably been interrupted.  If the test run can be
+        # resumed, their results are not reported, so that they are
+        # run again.
+        if self.__aborted and result.GetKind() == Result.TEST:
+            if self.__resumable:
+                self._Trace("Discarding result for %s." % id)
+                return
+            result[Result.INTERRUPTED] = "true"
+
         # Output a trace message.
         self._Trace("Writing result for %s to streams." % id)
 
@@ -738,9 +1760,19 @@ class ExecutionEngine:
                 # Output a trace message.
                 self._Trace("Got %s result for %s from queue."
                              % (result.GetKind(), result.GetId()))
+                # Results for abandoned copies of tests are not
+                # counted; the engine has already stopped waiting for
+                # them.
+                id = result.GetId()
+                abandoned = (result.GetKind() == Result.TEST
+                             and self.__abandoned.has_key(id))
                 # Record the result.
                 self.__AddResult(result)
-                if result.GetKind() == Result.TEST:
+                if abandoned:
+                    self.__abandoned[id] -= 1
+                    if not self.__abandoned[id]:
+                        del self.__abandoned[id]
+                elif result.GetKind() == Result.TEST:
                     assert self.__running > 0
                     self.__running -= 1
                 # Output a trace message.
@@ -767,6 +1799,95 @@ class ExecutionEngine:
                 continue
 
 
+    def __FindPrerequisites(self):
+        """Note the tests that are prerequisites of other tests.
+
+        The results of these tests are never taken from the result
+        cache, as the tests that depend on them may rely on their side
+        effects."""
+
+        for test_id in self.__test_ids:
+            try:
+                descriptor = self.__database.GetTest(test_id)
+            except:
+                # The error is reported when the test is run.
+                continue
+            for prerequisite in descriptor.GetPrerequisites():
+                self.__prerequisites[prerequisite] = None
+
+
+    def __NoteSourceDigest(self, test_id):
+        """Remember the digest of the source files of a test.
+
+        'test_id' -- The name of a test that is being started.
+
+        If the database knows the source files of the test, their
+        digest is added to the result of the test."""
+
+        try:
+            files = self.__database.GetTestSourceFiles(test_id)
+        except qm.test.database.NoSuchTestError:
+            # The error is reported when the test is run.
+            return
+        if files is not None:
+            self.__source_digests[test_id] = self.__digests.GetDigest(files)
+
+
+    def __ReplayResult(self, descriptor):
+        """Report the cached result of a test, if there is one.
+
+        'descriptor' -- The 'TestDescriptor' for a test that is ready
+        to run.
+
+        returns -- True iff a cached result was reported, in which case
+        the test need not be run."""
+
+        if self.__result_cache is None:
+            return 0
+        test_id = descriptor.GetId()
+        try:
+            fingerprint = self.__result_cache.GetFingerprint(descriptor)
+        except:
+            # If the fingerprint cannot be computed, run the test; any
+            # problem with it will be reported then.
+            self._Trace("Could not compute fingerprint for %s." % test_id)
+            return 0
+        if not self.__prerequisites.has_key(test_id):
+            cached = self.__result_cache.Lookup(fingerprint)
+            if cached is not None and cached.GetOutcome() == Result.PASS:
+                self._Trace("Using cached result for %s." % test_id)
+                if self.__descriptors.has_key(test_id):
+                    del self.__descriptors[test_id]
+                annotations = {}
+                for key, value in cached.items():
+                    if key != Result.TARGET:
+                        annotations[key] = value
+                annotations[Result.CACHED] = "true"
+                self.__num_tests_started += 1
+                self.__AddResult(Result(Result.TEST, test_id, Result.PASS,
+                                        annotations))
+                return 1
+        self.__fingerprints[test_id] = fingerprint
+        return 0
+
+
+    def __ReportReusedResult(self, test_id):
+        """Report the result of a test from an earlier test run.
+
+        'test_id' -- The ID of a test whose result is in the 'reused'
+        map given to the constructor."""
+
+        self._Trace("Reusing earlier result for %s." % test_id)
+        earlier = self.__reused[test_id]
+        annotations = {}
+        for key, value in earlier.items():
+            if key != Result.TARGET:
+                annotations[key] = value
+        annotations[Result.CACHED] = "true"
+        self.__AddResult(Result(Result.TEST, test_id, earlier.GetOutcome(),
+                                annotations))
+
+
     def __AddUntestedResult(self, test_name, cause, annotations={},
                             exc_info = None):
         """Add a 'Result' indicating that 'test_name' was not run.
@@ -805,6 +1926,9 @@ class ExecutionEngine:
         If the database cannot load the descriptor, an 'UNTESTED' result
         is recorded for 'test_id'."""
 
+        descriptor = self.__descriptors.get(test_id)
+        if descriptor is not None:
+            return descriptor
         try:
             return self.__database.GetTest(test_id)
         except:
@@ -848,7 +1972,13 @@ class ExecutionEngine:
         # Write them.
         for rs in self.__result_streams:
             rs.WriteAllAnnotations(self.__context)
-            rs.WriteAnnotation("qmtest.run.start_time", start_time_str)
+            # A resumed test run keeps the start time of the test run
+            # that was interrupted.
+            if self.__completed:
+                rs.WriteAnnotation("qmtest.run.resume_time",
+                                   start_time_str)
+            else:
+                rs.WriteAnnotation("qmtest.run.start_time", start_time_str)
             if username is not None:
                 rs.WriteAnnotation("qmtest.run.username", username)
             if userid is not None:
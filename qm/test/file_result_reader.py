@@ -64,6 +64,16 @@ class FileResultReader(ResultReader):
     """If true, results are stored in a binary format.
 
     This flag can be overridden by derived classes."""
+
+    _signature_regexp = None
+    """A regular expression matching the start of the files read.
+
+    If not 'None', 'load_results' uses this reader only for files
+    whose first few kilobytes match this regular expression.  If
+    'None', this reader is tried for any file, but only after the
+    readers whose regular expressions match.
+
+    This value can be overridden by derived classes."""
     
     def __init__(self, arguments = None, **args):
         """Construct a new 'FileResultReader'.
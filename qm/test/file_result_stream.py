@@ -61,16 +61,24 @@ class FileResultStream(ResultStream):
             if self.filename and self.filename != "-":
                 # Open the file in unbuffered mode so that results will be
                 # written out immediately.
-                if self._is_binary_file:
-                    mode = "wb"
-                else:
-                    mode = "w"
-                self.file = open(self.filename, mode, 0)
+                self.file = open(self.filename, self._GetFileMode(), 0)
                 # Child processes do not need to write to the results
                 # file.
                 qm.common.close_file_on_exec(self.file)
             else:
                 self.file = sys.stdout
+
+
+    def _GetFileMode(self):
+        """Return the mode in which to open the file.
+
+        returns -- The mode to pass to 'open' when opening the file
+        named by the 'filename' argument.  Derived classes may override
+        this method, for example to add to an existing file."""
+
+        if self._is_binary_file:
+            return "wb"
+        return "w"
             
 
         
@@ -79,6 +79,27 @@ class Result:
     execution, a representation of the traceback indicating where
     the exception was thrown.
 
+    'Result.ELAPSED_TIME' -- The wall-clock time, in seconds, taken
+    to run the test.
+
+    'Result.USER_TIME', 'Result.SYSTEM_TIME' -- The user and system
+    CPU time, in seconds, consumed by all of the child processes
+    created by the test.
+
+    'Result.MAX_RSS' -- The largest resident set size, in kilobytes,
+    of any child process created by the test.
+
+    'Result.BLOCKS_IN', 'Result.BLOCKS_OUT' -- The number of file
+    system blocks read and written by the child processes created
+    by the test.
+
+    The resource usage annotations are only present if the test
+    created child processes on a system that supports 'wait4'.
+
+    'Result.INTERRUPTED' -- Present, with the value "true", if the
+    test was still running when the test run was interrupted.  The
+    outcome of such a test may not be meaningful.
+
     A 'Result' object has methods that allow it to act as a dictionary
     from annotation names to annotation values.  You can directly add
     an annotation to a 'Result' by writing code of the form
@@ -110,6 +131,15 @@ class Result:
     START_TIME = "qmtest.start_time"
     END_TIME = "qmtest.end_time"
     TIMEOUT_DETAIL = "qmtest.timeout_detail"
+    ELAPSED_TIME = "qmtest.elapsed_time"
+    USER_TIME = "qmtest.user_time"
+    SYSTEM_TIME = "qmtest.system_time"
+    MAX_RSS = "qmtest.max_rss"
+    BLOCKS_IN = "qmtest.blocks_in"
+    BLOCKS_OUT = "qmtest.blocks_out"
+    CACHED = "qmtest.cached"
+    SOURCE_DIGEST = "qmtest.source_digest"
+    INTERRUPTED = "qmtest.interrupted"
     
     # Other class variables.
 
@@ -0,0 +1,305 @@
+########################################################################
+#
+# File:   result_cache.py
+# Author: agent
+# Date:   2026-10-19
+#
+# Contents:
+#   ResultCache
+#
+# Copyright (c) 2026 by CodeSourcery, LLC.  All rights reserved.
+#
+# For license terms see the file COPYING.
+#
+########################################################################
+
+########################################################################
+# Imports
+########################################################################
+
+import cPickle
+import inspect
+import os
+from   qm.attachment import Attachment
+import qm.common
+from   qm.common import md5
+import sys
+import time
+
+########################################################################
+# Classes
+########################################################################
+
+class ResultCache(object):
+    """A 'ResultCache' stores the results of tests that passed.
+
+    Each result is stored under a fingerprint of everything that could
+    affect the outcome of the test: the test class and its arguments,
+    the contents of its attachments, the source code of the test
+    class, the context, and the fingerprints of the resources it uses.
+    A test whose fingerprint matches a stored result has not changed
+    since that result was recorded, and need not be run again.
+
+    Results are stored in a directory, one file per result, so the
+    same cache can be used by several test runs at once."""
+
+    def __init__(self, directory, database, context):
+        """Construct a new 'ResultCache'.
+
+        'directory' -- The directory in which to store results.  It
+        is created if it does not exist.
+
+        'database' -- The 'Database' containing the tests.
+
+        'context' -- The 'Context' in which the tests are run."""
+
+        self.__directory = directory
+        self.__database = database
+        # The context variables used by QMTest itself vary from run to
+        # run and from test to test, so they are not included.
+        variables = [(k, v) for k, v in context.items()
+                     if not k.startswith("qmtest.")]
+        variables.sort()
+        digest = md5()
+        self.__UpdateValue(digest, variables)
+        self.__context = digest.hexdigest()
+        # A map from classes to digests of their source code.
+        self.__sources = {}
+        # A map from resource IDs to their fingerprints.
+        self.__resources = {}
+
+
+    def GetFingerprint(self, descriptor):
+        """Return the fingerprint of a test.
+
+        'descriptor' -- The 'TestDescriptor' for the test.
+
+        returns -- A string identifying the test and everything it
+        depends upon.  Raises an exception if some part of the test,
+        such as one of its resources, cannot be loaded."""
+
+        digest = md5()
+        digest.update("test\0")
+        self.__UpdateItem(digest, descriptor)
+        return digest.hexdigest()
+
+
+    def Lookup(self, fingerprint):
+        """Return the result stored for 'fingerprint'.
+
+        'fingerprint' -- A fingerprint returned by 'GetFingerprint'.
+
+        returns -- The 'Result' stored for 'fingerprint', or 'None' if
+        there is no such result."""
+
+        path = self.__GetPath(fingerprint)
+        try:
+            f = open(path, "rb")
+        except IOError:
+            return None
+        try:
+            try:
+                result = cPickle.load(f)
+            except:
+                # A damaged entry is treated as if it were not present.
+                return None
+        finally:
+            f.close()
+        # Note that the result has been used, so that it will be
+        # evicted after results that have not.
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return result
+
+
+    def Store(self, fingerprint, result):
+        """Store 'result' under 'fingerprint'.
+
+        'fingerprint' -- A fingerprint returned by 'GetFingerprint'.
+
+        'result' -- The 'Result' of running the test."""
+
+        # Other test runs never see a partial result.
+        qm.common.write_file_atomically(
+            self.__GetPath(fingerprint),
+            lambda f: cPickle.dump(result, f, cPickle.HIGHEST_PROTOCOL))
+
+
+    def Evict(self, max_age, max_size):
+        """Remove old results from the cache.
+
+        'max_age' -- The number of seconds after which a result that
+        has not been used is removed.
+
+        'max_size' -- The number of bytes to which the cache is
+        limited.  If the results take more space than this, the ones
+        used least recently are removed."""
+
+        now = time.time()
+        entries = []
+        size = 0
+        for directory, subdirectories, files in os.walk(self.__directory):
+            for name in files:
+                path = os.path.join(directory, name)
+                try:
+                    info = os.stat(path)
+                except OSError:
+                    continue
+                if now - info.st_mtime > max_age:
+                    self.__Remove(path)
+                else:
+                    entries.append((info.st_mtime, info.st_size, path))
+                    size += info.st_size
+        entries.sort()
+        for mtime, entry_size, path in entries:
+            if size <= max_size:
+                break
+            self.__Remove(path)
+            size -= entry_size
+
+
+    def __GetPath(self, fingerprint):
+        """Return the file in which the result for 'fingerprint' is kept.
+
+        'fingerprint' -- A fingerprint returned by 'GetFingerprint'.
+
+        returns -- The path to the file."""
+
+        # Spread the files among subdirectories so that no directory
+        # becomes too large.
+        return os.path.join(self.__directory, fingerprint[:2], fingerprint)
+
+
+    def __Remove(self, path):
+        """Remove the file at 'path', if it still exists.
+
+        'path' -- The path to a file in the cache."""
+
+        try:
+            os.remove(path)
+        except OSError:
+            # Another test run may have removed the file already.
+            pass
+
+
+    def __GetResourceFingerprint(self, resource_id):
+        """Return the fingerprint of a resource.
+
+        'resource_id' -- The name of the resource.
+
+        returns -- A string identifying the resource and everything it
+        depends upon."""
+
+        fingerprint = self.__resources.get(resource_id)
+        if fingerprint is None:
+            # A resource that requires itself is reported when the test
+            # is run; here it is enough not to recurse forever.
+            self.__resources[resource_id] = ""
+            try:
+                descriptor = self.__database.GetResource(resource_id)
+                digest = md5()
+                digest.update("resource\0")
+                self.__UpdateItem(digest, descriptor)
+            except:
+                # Do not leave the placeholder behind; a later test
+                # that uses the resource would be given a fingerprint
+                # that does not depend on the resource at all.
+                del self.__resources[resource_id]
+                raise
+            fingerprint = digest.hexdigest()
+            self.__resources[resource_id] = fingerprint
+        return fingerprint
+
+
+    def __UpdateItem(self, digest, descriptor):
+        """Add a test or resource to 'digest'.
+
+        'digest' -- The message digest being computed.
+
+        'descriptor' -- The 'ItemDescriptor' for the test or
+        resource."""
+
+        self.__UpdateValue(digest, descriptor.GetClassName())
+        digest.update(self.__GetSourceDigest(descriptor.GetClass()))
+        self.__UpdateValue(digest, descriptor.GetArguments())
+        digest.update(self.__context)
+        for resource_id in descriptor.GetResources():
+            self.__UpdateValue(digest, resource_id)
+            digest.update(self.__GetResourceFingerprint(resource_id))
+
+
+    def __GetSourceDigest(self, klass):
+        """Return a digest of the source code of 'klass'.
+
+        'klass' -- A test or resource class.
+
+        returns -- A digest of the modules that define 'klass' and its
+        base classes."""
+
+        source_digest = self.__sources.get(klass)
+        if source_digest is None:
+            digest = md5()
+            modules = {}
+            for c in inspect.getmro(klass):
+                module = sys.modules.get(c.__module__)
+                path = getattr(module, "__file__", None)
+                if path is None or modules.has_key(path):
+                    continue
+                modules[path] = None
+                # Use the source code, rather than the compiled code,
+                # when it is available.
+                if path[-4:] in (".pyc", ".pyo"):
+                    path = path[:-1]
+                self.__UpdateValue(digest, c.__module__)
+                try:
+                    f = open(path, "rb")
+                    try:
+                        digest.update(f.read())
+                    finally:
+                        f.close()
+                except IOError:
+                    pass
+            source_digest = digest.hexdigest()
+            self.__sources[klass] = source_digest
+        return source_digest
+
+
+    def __UpdateValue(self, digest, value):
+        """Add 'value' to 'digest'.
+
+        'digest' -- The message digest being computed.
+
+        'value' -- An argument value, or a part of one.
+
+        Each value is added along with its type and length, so that
+        different values never produce the same sequence of bytes."""
+
+        if isinstance(value, Attachment):
+            digest.update("attachment\0")
+            self.__UpdateValue(digest, value.GetMimeType())
+            self.__UpdateValue(digest, value.GetFileName())
+            digest.update(md5(value.GetData()).hexdigest())
+        elif isinstance(value, dict):
+            keys = value.keys()
+            keys.sort()
+            digest.update("dict %d\0" % len(keys))
+            for key in keys:
+                self.__UpdateValue(digest, key)
+                self.__UpdateValue(digest, value[key])
+        elif isinstance(value, (list, tuple)):
+            digest.update("sequence %d\0" % len(value))
+            for element in value:
+                self.__UpdateValue(digest, element)
+        else:
+            text = repr(value)
+            digest.update("value %d\0" % len(text))
+            digest.update(text)
+
+########################################################################
+# Local Variables:
+# mode: python
+# indent-tabs-mode: nil
+# fill-column: 72
+# End:
@@ -53,6 +53,10 @@ class Runnable(qm.extension.Extension):
     RESOURCE_FIELD_ID = "resources"
     """The name of the field that contains the resources on which this
     test or resource depends."""
+
+    LOCK_FIELD_ID = "locks"
+    """The name of the field that contains the locks held while this
+    test or resource runs."""
     
     arguments = [
         qm.fields.SetField(
@@ -66,6 +70,22 @@ class Runnable(qm.extension.Extension):
                 resources on which it depends will be set up.""",
                 not_empty_text = "true",
                 )),
+        qm.fields.SetField(
+            qm.fields.TextField(
+                name = LOCK_FIELD_ID,
+                title = "Locks",
+                description = \
+                """Locks held while this test or resource runs.
+
+                A lock is a name, such as the name of a network port
+                or a file, used by more than one test.  Tests that
+                hold the same lock are never run at the same time.  A
+                lock written as 'NAME:N' is shared: up to N tests may
+                hold it at once, but not at the same time as a test
+                that holds 'NAME' alone.  A test also holds the locks
+                of the resources it uses.""",
+                not_empty_text = "true",
+                )),
         ]
 
     
@@ -0,0 +1,211 @@
+########################################################################
+#
+# File:   sharding.py
+# Author: agent
+# Date:   2026-10-19
+#
+# Contents:
+#   Functions for dividing a test run among several machines.
+#
+# Copyright (c) 2026 by CodeSourcery, LLC.  All rights reserved.
+#
+# For license terms see the file COPYING.
+#
+########################################################################
+
+########################################################################
+# Imports
+########################################################################
+
+from   qm.common import md5
+from   qm.test.result import Result
+
+########################################################################
+# Functions
+########################################################################
+
+def parse_shard(shard):
+    """Parse a shard specification.
+
+    'shard' -- A string of the form 'I/N', where 'N' is the number of
+    shards and 'I', between 1 and 'N', is the shard to run.
+
+    returns -- A pair '(index, count)' of integers.  Raises
+    'ValueError' if 'shard' is not a valid specification."""
+
+    index, count = shard.split("/")
+    index = int(index)
+    count = int(count)
+    if count < 1 or index < 1 or index > count:
+        raise ValueError, shard
+    return index, count
+
+
+def load_durations(results):
+    """Return the times taken by the tests in a previous run.
+
+    'results' -- A 'ResultReader' for the results of a previous test
+    run.
+
+    returns -- A map from test IDs to the number of seconds taken to
+    run the tests.  Tests whose results do not record the time taken
+    are omitted."""
+
+    durations = {}
+    for result in results:
+        if result.GetKind() != Result.TEST:
+            continue
+        try:
+            durations[result.GetId()] = float(result[Result.ELAPSED_TIME])
+        except (KeyError, ValueError):
+            pass
+    return durations
+
+
+def select_shard(database, test_ids, index, count, durations = None):
+    """Return the tests to run in one shard of a test run.
+
+    'database' -- The 'Database' containing the tests.
+
+    'test_ids' -- A sequence giving the names of all of the tests in
+    the test run.
+
+    'index' -- The number of the shard, between 1 and 'count'.
+
+    'count' -- The total number of shards.
+
+    'durations' -- If not 'None', a map from test IDs to the times
+    taken to run the tests, as returned by 'load_durations'.
+
+    returns -- A list of the elements of 'test_ids' that belong to
+    shard 'index'.
+
+    A test is always in the same shard as the tests in 'test_ids' that
+    are its prerequisites.  Without 'durations', each group of tests
+    connected by prerequisites is assigned to a shard by hashing the
+    name of its first test, so that a test stays in the same shard as
+    tests are added to and removed from the database.  With
+    'durations', groups are assigned so as to give each shard about
+    the same amount of work.  Either way, the assignment depends only
+    on the arguments, so every machine computes the same shards."""
+
+    groups = _group_tests(database, test_ids)
+    if durations is None:
+        assignment = _assign_by_hash(groups, count)
+    else:
+        assignment = _assign_by_duration(groups, count, durations)
+    selected = []
+    for group, shard in zip(groups, assignment):
+        if shard == index - 1:
+            selected.extend(group)
+    return selected
+
+
+def _group_tests(database, test_ids):
+    """Divide 'test_ids' into groups connected by prerequisites.
+
+    'database' -- The 'Database' containing the tests.
+
+    'test_ids' -- A sequence of test names.
+
+    returns -- A list of lists of test names.  Each group, and the
+    list of groups, is sorted."""
+
+    # Find the representative of each test's group, using a
+    # union-find structure.
+    parents = {}
+    for test_id in test_ids:
+        parents[test_id] = test_id
+
+    def find(test_id):
+        root = test_id
+        while parents[root] != root:
+            root = parents[root]
+        while parents[test_id] != root:
+            parents[test_id], test_id = root, parents[test_id]
+        return root
+
+    for test_id in test_ids:
+        try:
+            descriptor = database.GetTest(test_id)
+        except:
+            # The test cannot be loaded, so its prerequisites are not
+            # known; the error is reported when the test is run.
+            continue
+        for prerequisite in descriptor.GetPrerequisites():
+            if parents.has_key(prerequisite):
+                a = find(test_id)
+                b = find(prerequisite)
+                if a != b:
+                    parents[max(a, b)] = min(a, b)
+
+    groups = {}
+    for test_id in test_ids:
+        groups.setdefault(find(test_id), []).append(test_id)
+    groups = groups.values()
+    for group in groups:
+        group.sort()
+    groups.sort()
+    return groups
+
+
+def _assign_by_hash(groups, count):
+    """Assign each group of tests to a shard by hashing its name.
+
+    'groups' -- A list of lists of test names, as returned by
+    '_group_tests'.
+
+    'count' -- The number of shards.
+
+    returns -- A list giving the shard, between zero and 'count - 1',
+    for each group."""
+
+    # The built-in 'hash' function gives different values on
+    # different platforms, so it cannot be used here.
+    return [int(md5(group[0]).hexdigest()[:8], 16) % count
+            for group in groups]
+
+
+def _assign_by_duration(groups, count, durations):
+    """Assign groups of tests to shards so as to balance the work.
+
+    'groups' -- A list of lists of test names, as returned by
+    '_group_tests'.
+
+    'count' -- The number of shards.
+
+    'durations' -- A map from test IDs to times, as returned by
+    'load_durations'.
+
+    returns -- A list giving the shard, between zero and 'count - 1',
+    for each group."""
+
+    # Tests that have not been run before are assumed to take as
+    # long as a typical test.
+    if durations:
+        default = sum(durations.values()) / len(durations)
+    else:
+        default = 1.0
+    weights = []
+    for i in xrange(len(groups)):
+        weight = 0.0
+        for test_id in groups[i]:
+            weight += durations.get(test_id, default)
+        weights.append((-weight, i))
+    # Give each group, largest first, to the shard with the least
+    # work so far.
+    weights.sort()
+    loads = [0.0] * count
+    assignment = [0] * len(groups)
+    for weight, i in weights:
+        shard = loads.index(min(loads))
+        assignment[i] = shard
+        loads[shard] -= weight
+    return assignment
+
+########################################################################
+# Local Variables:
+# mode: python
+# indent-tabs-mode: nil
+# fill-column: 72
+# End:
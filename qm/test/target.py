@@ -19,8 +19,10 @@
 
 import qm
 import qm.common
+import qm.executable
 import qm.extension
 import qm.platform
+from   qm.temporary_directory import TemporaryDirectory
 import qm.test.base
 from   qm.test.context import *
 from   qm.test.result import *
@@ -28,6 +30,8 @@ from   qm.test.database import NoSuchResourceError
 import re
 import signal
 import sys
+from   threading import Condition, Thread, currentThread
+import time
 
 ########################################################################
 # classes
@@ -71,7 +75,18 @@ class Target(qm.extension.Extension):
             Some tests may only be able to run on some targets.  A
             test can specify a pattern indicating the set of targets
             on which it will run.""",
-            default_value="")
+            default_value=""),
+        qm.fields.IntegerField(
+            name="resource_threads",
+            title="Resource Threads",
+            description="""The number of resources to set up at once.
+
+            If this value is greater than one, resources that do not
+            depend on one another are set up concurrently, and are
+            cleaned up concurrently when the target stops.  A resource
+            is never set up before the resources on which it depends,
+            or cleaned up before the resources that depend on it.""",
+            default_value=1),
         ]
 
     kind = "target"
@@ -103,6 +118,9 @@ class Target(qm.extension.Extension):
         super(Target, self).__init__(**args)
         
         self.__database = database
+        # Create a condition variable to guard accesses to the
+        # available resources table.
+        self.__resources_condition = Condition()
 
 
     def GetName(self):
@@ -143,6 +161,33 @@ class Target(qm.extension.Extension):
         raise NotImplementedError
 
 
+    def GetCapacity(self):
+        """Return the number of slots available on this target.
+
+        returns -- A positive integer.  Each test uses one or more
+        slots while it runs; the execution engine will not give the
+        target more tests than will fit in its slots.
+
+        Derived classes that can run more than one test at once
+        should override this method."""
+
+        return 1
+
+
+    def HasResource(self, resource_name):
+        """Return true if a resource has been set up on this target.
+
+        'resource_name' -- A string naming a resource.
+
+        returns -- True if an attempt has already been made to set up
+        the resource on this target, so that running a test which
+        requires the resource here will not set it up again.
+
+        Derived classes may override this method."""
+
+        return self.__resources.has_key(resource_name)
+
+
     def IsInGroup(self, group_pattern):
         """Returns true if this 'Target' is in a particular group.
 
@@ -174,6 +219,17 @@ class Target(qm.extension.Extension):
         # There are no resources available on this target yet.
         self.__resources = {}
         self.__order_of_resources = []
+        # A map from the names of resources that are being set up to
+        # the threads setting them up.
+        self.__resource_threads = {}
+        # A map from the names of resources that have been set up to
+        # the names of the resources on which they depend.
+        self.__resource_dependencies = {}
+        # A map from the names of resources that were set up
+        # concurrently to the 'TemporaryDirectory' objects they were
+        # given.  The directories are kept until the resources have
+        # been cleaned up.
+        self.__resource_directories = {}
 
         
     def Stop(self):
@@ -187,14 +243,25 @@ class Target(qm.extension.Extension):
         
         # Clean up any available resources.
         self.__order_of_resources.reverse()
+        names = []
         for name in self.__order_of_resources:
             rop = self.__resources[name]
             if rop and rop[1] == Result.PASS:
-                self._CleanUpResource(name, rop[0])
+                names.append(name)
+        if not self.__CleanUpResourcesConcurrently(names):
+            for name in names:
+                self._CleanUpResource(name, self.__resources[name][0])
+        # Remove the temporary directories of the resources, including
+        # those that could not be set up.
+        for directory in self.__resource_directories.values():
+            directory.Remove()
         del self.__response_queue
         del self.__engine
         del self.__resources
         del self.__order_of_resources
+        del self.__resource_threads
+        del self.__resource_dependencies
+        del self.__resource_directories
 
 
     def RunTest(self, descriptor, context):
@@ -222,6 +289,10 @@ class Target(qm.extension.Extension):
             context[context.ID_CONTEXT_PROPERTY] = descriptor.GetId()
             # Note the start time.
             result[Result.START_TIME] = qm.common.format_time_iso()
+            start_time = time.time()
+            # Charge the resources used by any child processes to
+            # this test.
+            qm.executable.start_resource_accounting()
             # Run the test.
             try:
                 descriptor.Run(context, result)
@@ -231,6 +302,9 @@ class Target(qm.extension.Extension):
             finally:
                 # Note the end time.
                 result[Result.END_TIME] = qm.common.format_time_iso()
+                usage = qm.executable.stop_resource_accounting()
+                self._NoteResourceUsage(result, time.time() - start_time,
+                                        usage)
         except KeyboardInterrupt:
             result.NoteException(cause = "Interrupted by user.")
             # We received a KeyboardInterrupt, indicating that the
@@ -262,6 +336,21 @@ class Target(qm.extension.Extension):
         self._RecordResult(result)
 
 
+    def CancelTest(self, test_id):
+        """Stop running the test given by 'test_id', if possible.
+
+        'test_id' -- The name of a test that was given to 'RunTest'.
+
+        The execution engine calls this method when it no longer needs
+        the result of the test.  If the test cannot be stopped, its
+        result may still be recorded; the execution engine will ignore
+        it.
+
+        Derived classes may override this method."""
+
+        pass
+    
+
     def _RecordResult(self, result):
         """Record the 'result'.
 
@@ -277,6 +366,31 @@ class Target(qm.extension.Extension):
         self.__response_queue.put(result)
             
 
+    def _NoteResourceUsage(self, result, elapsed, usage):
+        """Record the resources used by a test in its 'result'.
+
+        'result' -- The 'Result' of the test.
+
+        'elapsed' -- The wall-clock time, in seconds, taken by the
+        test.
+
+        'usage' -- The 'ResourceUsage' accumulated while the test
+        ran, or 'None'.
+
+        Derived classes may override this method."""
+
+        result[Result.ELAPSED_TIME] = "%.6f" % elapsed
+        if usage is None or not usage.children:
+            # The test did not create any child processes, or they
+            # could not be accounted for.
+            return
+        result[Result.USER_TIME] = "%.6f" % usage.user_time
+        result[Result.SYSTEM_TIME] = "%.6f" % usage.system_time
+        result[Result.MAX_RSS] = str(usage.max_rss)
+        result[Result.BLOCKS_IN] = str(usage.blocks_in)
+        result[Result.BLOCKS_OUT] = str(usage.blocks_out)
+
+
     def _BeginResourceSetUp(self, resource_name):
         """Begin setting up the indicated resource.
 
@@ -298,13 +412,41 @@ class Target(qm.extension.Extension):
         for this resource, then 'None' is returned, but the resource
         is marked as in the process of being set up.  It is the
         caller's responsibility to finish setting it up by calling
-        '_FinishResourceSetUp'."""
+        '_FinishResourceSetUp'.
 
-        rop = self.__resources.get(resource_name)
-        if rop:
-            return rop
-        self.__resources[resource_name] = (None, None, None)
-        return None
+        If another thread is in the process of setting up the
+        resource, this method waits for it to finish."""
+
+        # Acquire the lock.
+        self.__resources_condition.acquire()
+        try:
+            # Loop until either we are assigned to set up the resource
+            # or until some other thread has finished setting it up.
+            while 1:
+                rop = self.__resources.get(resource_name)
+                # If this is the first thread to call
+                # _BeginResourceSetUp for this resource, this thread
+                # will set up the resource.
+                if not rop:
+                    self.__resources[resource_name] = (None, None, None)
+                    self.__resource_threads[resource_name] \
+                        = currentThread()
+                    return None
+                # If this resource has already been set up, we do not
+                # need to do anything more.  If this thread is itself
+                # setting up the resource, there is a dependency
+                # cycle; waiting would never end.
+                if (rop[1]
+                    or (self.__resource_threads.get(resource_name)
+                        is currentThread())):
+                    return rop
+                # Otherwise, some other thread is in the process of
+                # setting up this resource so we just wait for it to
+                # finish its job.
+                self.__resources_condition.wait()
+        finally:
+            # Release the lock.
+            self.__resources_condition.release()
 
 
     def _FinishResourceSetUp(self, resource, result, properties):
@@ -327,11 +469,41 @@ class Target(qm.extension.Extension):
         # this resource as it was in the resource itself.
         del properties[Context.TMPDIR_CONTEXT_PROPERTY]
         rop = (resource, result.GetOutcome(), properties)
-        self.__resources[result.GetId()] = rop
-        self.__order_of_resources.append(result.GetId())
+        # Acquire the lock.
+        self.__resources_condition.acquire()
+        try:
+            # Record the fact that the resource is set up.
+            self.__resources[result.GetId()] = rop
+            self.__order_of_resources.append(result.GetId())
+            if self.__resource_threads.has_key(result.GetId()):
+                del self.__resource_threads[result.GetId()]
+            # Tell all the other threads that the resource has been set
+            # up.
+            self.__resources_condition.notifyAll()
+        finally:
+            # Release the lock.
+            self.__resources_condition.release()
         return rop
 
 
+    def NoteSharedResource(self, resource_name, properties):
+        """Note that a resource has been set up on behalf of this target.
+
+        'resource_name' -- A string naming a resource that has been
+        set up successfully somewhere else, such as in the process
+        that is controlling this target.
+
+        'properties' -- A dictionary of additional context properties
+        that should be provided to tests that depend on this resource.
+
+        Tests that require the resource will not set it up again.
+        This target is not responsible for cleaning up the resource.
+
+        Derived classes must not override this method."""
+
+        self.__resources[resource_name] = (None, Result.PASS, properties)
+
+
     def __SetUpResources(self, descriptor, context):
         """Set up all the resources associated with 'descriptor'.
 
@@ -344,6 +516,10 @@ class Target(qm.extension.Extension):
         returns -- A tuple of the same form as is returned by
         '_BeginResourceSetUp' when the resource has already been set
         up."""
+
+        # Set up independent resources concurrently, if permitted.
+        # Any resources that remain are set up by the loop below.
+        self.__SetUpResourcesConcurrently(descriptor, context)
         
         # See if there are resources that need to be set up.
         for resource in descriptor.GetResources():
@@ -383,6 +559,10 @@ class Target(qm.extension.Extension):
         # Get the resource descriptor.
         try:
             resource_desc = self.GetDatabase().GetResource(resource_name)
+            # Remember the dependencies, so that the resources can be
+            # cleaned up in the right order.
+            self.__resource_dependencies[resource_name] \
+                = resource_desc.GetResources()
             # Set up the resources on which this resource depends.
             self.__SetUpResources(resource_desc, wrapper)
             # Make the ID of the resource available.
@@ -400,8 +580,6 @@ class Target(qm.extension.Extension):
                         { result.RESOURCE : e.resource })
         except NoSuchResourceError:
             result.NoteException(cause="Resource is missing from the database.")
-            self._RecordResult(result)
-            return (None, result, None)
         except qm.test.base.CouldNotLoadExtensionError, e:
             result.NoteException(e.exc_info,
                                  cause = "Could not load extension class")
@@ -421,6 +599,169 @@ class Target(qm.extension.Extension):
                                          wrapper.GetAddedProperties())
 
 
+    def __SetUpResourcesConcurrently(self, descriptor, context):
+        """Set up the resources needed by 'descriptor' concurrently.
+
+        'descriptor' -- The 'TestDescriptor' or 'ResourceDescriptor'
+        indicating the test or resource that is about to be run.
+
+        'context' -- The 'Context' in which the resources will be
+        executed.
+
+        Resources are set up on up to 'resource_threads' threads at
+        once.  A resource is not set up until all of the resources on
+        which it depends have been set up.  Resources that have
+        already been set up are ignored.  If the resources cannot be
+        ordered, because they depend on one another, nothing is done;
+        the caller will diagnose the problem."""
+
+        if self.resource_threads <= 1:
+            return
+        
+        # Compute the dependency graph of the resources that have not
+        # yet been set up.
+        dependencies = {}
+        pending = list(descriptor.GetResources())
+        while pending:
+            name = pending.pop()
+            if dependencies.has_key(name) or self.__resources.has_key(name):
+                continue
+            try:
+                resource_desc = self.GetDatabase().GetResource(name)
+                dependencies[name] = resource_desc.GetResources()
+            except:
+                # The problem will be reported when '_SetUpResource'
+                # tries to load the resource.
+                dependencies[name] = []
+            pending.extend(dependencies[name])
+        if len(dependencies) < 2:
+            # There is nothing to be gained from concurrency.
+            return
+
+        # Restrict the graph to the resources that need to be set up.
+        for name, names in dependencies.items():
+            dependencies[name] = filter(dependencies.has_key, names)
+
+        def set_up(name):
+            # Each thread uses its own temporary directory.  The
+            # resource may keep files there until it is cleaned up.
+            temporary_directory = TemporaryDirectory()
+            self.__resource_directories[name] = temporary_directory
+            wrapper = Context(context)
+            wrapper[Context.TMPDIR_CONTEXT_PROPERTY] \
+                = temporary_directory.GetPath()
+            self._SetUpResource(name, wrapper)
+
+        self.__RunConcurrently(dependencies, set_up)
+        
+
+    def __CleanUpResourcesConcurrently(self, names):
+        """Clean up the resources given by 'names' concurrently.
+
+        'names' -- A sequence of the names of resources that have been
+        set up successfully.
+
+        returns -- True if the resources were cleaned up, false if
+        they should be cleaned up one at a time instead.
+
+        A resource is not cleaned up until all of the resources that
+        depend on it have been cleaned up."""
+
+        if self.resource_threads <= 1 or len(names) < 2:
+            return 0
+
+        # A resource must wait for the resources that depend on it.
+        dependants = {}
+        for name in names:
+            dependants[name] = []
+        for name in names:
+            for dependency in self.__resource_dependencies.get(name, []):
+                if dependants.has_key(dependency):
+                    dependants[dependency].append(name)
+
+        def clean_up(name):
+            self._CleanUpResource(name, self.__resources[name][0])
+            directory = self.__resource_directories.pop(name, None)
+            if directory is not None:
+                directory.Remove()
+
+        return self.__RunConcurrently(dependants, clean_up)
+
+
+    def __RunConcurrently(self, prerequisites, function):
+        """Call 'function' for each node of a graph, using many threads.
+
+        'prerequisites' -- A map from node names to lists of the names
+        of the nodes that must be processed before that node.
+
+        'function' -- A callable that accepts a node name.
+
+        returns -- True if every node was processed, false if nothing
+        was done because the graph contains a cycle.
+
+        At most 'resource_threads' threads are used."""
+
+        # Count the prerequisites of each node, and find the nodes that
+        # are waiting for each node.
+        counts = {}
+        waiting = {}
+        for name, names in prerequisites.items():
+            counts[name] = len(names)
+            for n in names:
+                waiting.setdefault(n, []).append(name)
+        ready = filter(lambda n: not counts[n], prerequisites.keys())
+
+        # Make sure that every node can eventually be processed.
+        remaining = counts.copy()
+        order = ready[:]
+        for name in order:
+            for n in waiting.get(name, []):
+                remaining[n] -= 1
+                if not remaining[n]:
+                    order.append(n)
+        if len(order) != len(prerequisites):
+            return 0
+
+        condition = Condition()
+        # The number of nodes that have not yet been processed.
+        state = { "unfinished" : len(prerequisites) }
+
+        def run():
+            condition.acquire()
+            try:
+                while 1:
+                    # Wait until there is a node that can be
+                    # processed, or until all nodes are finished.
+                    while not ready and state["unfinished"]:
+                        condition.wait()
+                    if not ready:
+                        return
+                    name = ready.pop(0)
+                    condition.release()
+                    try:
+                        function(name)
+                    finally:
+                        condition.acquire()
+                        state["unfinished"] -= 1
+                        for n in waiting.get(name, []):
+                            counts[n] -= 1
+                            if not counts[n]:
+                                ready.append(n)
+                        condition.notifyAll()
+            finally:
+                condition.release()
+
+        threads = []
+        for i in xrange(min(self.resource_threads, len(prerequisites))):
+            thread = Thread(target = run)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        return 1
+
+        
     def _CleanUpResource(self, name, resource):
         """Clean up the 'resource'.
 
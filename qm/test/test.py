@@ -100,6 +100,27 @@ class Test(qm.test.runnable.Runnable):
     exception that is not caught within the method itself, QMTest will
     catch the exception and continue processing."""
 
+    side_effect_free = 0
+    """True if running tests in this class has no side effects.
+
+    A test has no side effects if running it does not change anything
+    that another test could observe, and if its outcome does not
+    depend on anything its prerequisites do.  (The prerequisites
+    merely decide whether or not the test is worth running.)  If
+    speculation is enabled, such tests may be run before their
+    prerequisites have completed; if the prerequisites do not have
+    the expected outcomes, the results are discarded."""
+
+    idempotent = 0
+    """True if tests in this class may be run more than once at a time.
+
+    If backups are enabled, a test that is still running at the end
+    of a test run may be started again on another target, and the
+    first result to be received is used.  That is safe only if two
+    copies of the test cannot interfere with one another, for
+    example by writing to the same files, so test classes must opt
+    in by setting this to true."""
+
     class OutcomeField(qm.fields.EnumerationField):
         """An 'OutcomeField' contains an outcome."""
 
@@ -163,7 +184,26 @@ class Test(qm.test.runnable.Runnable):
                 Every test can depend on other tests.  Those tests will be
                 run before this test.  If the prerequisite test does not
                 have the outcome indicated, this test will not be run.""",
-                ))
+                )),
+        qm.fields.IntegerField(
+            name="slots",
+            title="Slots",
+            description="""The number of slots this test uses on a target.
+
+            Each target can run tests using a fixed number of slots
+            at once.  A test that runs several processes of its own,
+            or that uses a great deal of memory, should use more than
+            one slot so that fewer other tests are run beside it.  A
+            test that uses more slots than a target has is run on its
+            own.
+
+            This is an argument of the test, rather than a property of
+            the target or a context variable, because only the test
+            knows how much of the machine it uses.  For example, a
+            test that compiles several files at once runs as many
+            compiler processes as it has slots, while the other tests
+            run on the same target use one each.""",
+            default_value=1),
     ]
 
     kind = "test"
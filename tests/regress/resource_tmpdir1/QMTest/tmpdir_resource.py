@@ -0,0 +1,49 @@
+########################################################################
+#
+# File:   tmpdir_resource.py
+# Author: agent
+# Date:   2026-10-19
+#
+# Contents:
+#   Test resource that keeps a file in its temporary directory.
+#
+# Copyright (c) 2026 by CodeSourcery, LLC.  All rights reserved.
+#
+# For license terms see the file COPYING.
+#
+########################################################################
+
+########################################################################
+# Imports
+########################################################################
+
+import os.path
+from   qm.test.resource import Resource
+
+########################################################################
+# Classes
+########################################################################
+
+class TmpdirResource(Resource):
+    """A 'TmpdirResource' writes a file in its temporary directory.
+
+    The path to the file is made available to tests in the context
+    property named after the resource.  The file must still exist when
+    the resource is cleaned up."""
+
+    def SetUp(self, context, result):
+
+        name = context[context.ID_CONTEXT_PROPERTY]
+        self.__path = os.path.join(context.GetTemporaryDirectory(), "file")
+        f = open(self.__path, "w")
+        try:
+            f.write(name)
+        finally:
+            f.close()
+        context[name] = self.__path
+
+
+    def CleanUp(self, result):
+
+        if not os.path.exists(self.__path):
+            result.Fail("The temporary directory was removed too early.")
@@ -0,0 +1,211 @@
+########################################################################
+#
+# File:   ssh_host_test.py
+# Author: agent
+# Date:   2026-10-19
+#
+# Contents:
+#   Test class for the copies made by SSHHost.
+#
+# Copyright (c) 2026 by CodeSourcery, LLC.  All rights reserved.
+#
+# For license terms see the file COPYING.
+#
+########################################################################
+
+########################################################################
+# Imports
+########################################################################
+
+import os
+import os.path
+import qm.fields
+from   qm.test.base import get_extension_class
+from   qm.test.test import Test
+import shutil
+import tempfile
+
+########################################################################
+# Variables
+########################################################################
+
+_fake_ssh = """#!/bin/sh
+# Record the command, and run it on this machine.
+echo ssh "$@" >> %(log)s
+shift
+exec /bin/sh -c "$*"
+"""
+
+_fake_scp = """#!/bin/sh
+# Record the command, and copy the file on this machine.
+echo scp "$@" >> %(log)s
+exec cp `echo "$1" | sed 's/^fake://'` `echo "$2" | sed 's/^fake://'`
+"""
+
+########################################################################
+# Classes
+########################################################################
+
+class SSHHostTest(Test):
+    """An 'SSHHostTest' checks how an 'SSHHost' copies files.
+
+    The host uses fake remote shell and remote copy programs that run
+    commands and copy files on the local machine, and record each time
+    they are invoked.  The test fails if files are copied incorrectly,
+    or if the remote copy program is used at all."""
+
+    arguments = [
+        qm.fields.EnumerationField(
+            name="operation",
+            enumerals=["upload_and_run", "upload_and_run_cached",
+                       "copy_files", "copy_files_cached"]
+            )
+        ]
+
+
+    def Run(self, context, result):
+
+        directory = tempfile.mkdtemp()
+        try:
+            self.__directory = directory
+            self.__log = os.path.join(directory, "log")
+            self.__remote = os.path.join(directory, "remote")
+            os.mkdir(self.__remote)
+            getattr(self, "_Check_" + self.operation)(result)
+            if result.GetOutcome() == result.PASS and self.__Count("scp"):
+                result.Fail("The remote copy program was used.")
+        finally:
+            shutil.rmtree(directory, True)
+
+
+    def _Check_upload_and_run(self, result):
+
+        host = self.__MakeHost()
+        program = self.__WriteFile("hello", "#!/bin/sh\necho hello $1\n",
+                                   0755)
+        status, output = host.UploadAndRun(program, ["world"])
+        if status != 0 or output != "hello world\n":
+            result.Fail("Incorrect output from uploaded program.",
+                        { "output" : result.Quote(output) })
+        elif os.listdir(self.__remote):
+            result.Fail("Uploaded program was not deleted.")
+
+
+    def _Check_upload_and_run_cached(self, result):
+
+        host = self.__MakeHost(
+            upload_cache = os.path.join(self.__directory, "cache"))
+        program = self.__WriteFile("hello", "#!/bin/sh\necho hello $1\n",
+                                   0755)
+        for argument in ("world", "again"):
+            status, output = host.UploadAndRun(program, [argument])
+            if status != 0 or output != "hello %s\n" % argument:
+                result.Fail("Incorrect output from uploaded program.",
+                            { "output" : result.Quote(output) })
+                return
+        if self.__Count("tar") != 1:
+            result.Fail("The program was not uploaded exactly once.")
+
+
+    def _Check_copy_files(self, result):
+
+        host = self.__MakeHost()
+        files = [self.__WriteFile("a", "first\n"),
+                 self.__WriteFile("b", "second\n")]
+        host.UploadFiles(files)
+        for f in files:
+            copy = os.path.join(self.__remote, os.path.basename(f))
+            if (not os.path.exists(copy)
+                or open(copy).read() != open(f).read()):
+                result.Fail("Incorrect upload of %s." % os.path.basename(f))
+                return
+        local_dir = os.path.join(self.__directory, "download")
+        os.mkdir(local_dir)
+        host.DownloadFiles(["a", "b"], local_dir)
+        for f in files:
+            copy = os.path.join(local_dir, os.path.basename(f))
+            if (not os.path.exists(copy)
+                or open(copy).read() != open(f).read()):
+                result.Fail("Incorrect download of %s."
+                            % os.path.basename(f))
+                return
+        if self.__Count("ssh") != 2:
+            result.Fail("The files were not copied in two batches.")
+
+
+    def _Check_copy_files_cached(self, result):
+
+        cache = os.path.join(self.__directory, "cache")
+        host = self.__MakeHost(upload_cache = cache)
+        files = [self.__WriteFile("a", "first\n"),
+                 self.__WriteFile("b", "second\n")]
+        host.UploadFiles(files)
+        host.UploadFiles(files)
+        if self.__Count("tar") != 1:
+            result.Fail("Unchanged files were uploaded again.")
+            return
+        self.__WriteFile("b", "changed\n")
+        host.UploadFiles(files)
+        copy = os.path.join(self.__remote, "b")
+        if self.__Count("tar") != 2 or open(copy).read() != "changed\n":
+            result.Fail("A changed file was not uploaded again.")
+            return
+        # A different host, sharing the same record, has none of
+        # the files.
+        other = self.__MakeHost(upload_cache = cache, host_name = "other")
+        other.UploadFiles(files)
+        if self.__Count("tar") != 3:
+            result.Fail("Files uploaded to one host were not uploaded "
+                        "to another.")
+
+
+    def __MakeHost(self, **arguments):
+        """Return an 'SSHHost' that uses the fake programs.
+
+        'arguments' -- Additional arguments for the host."""
+
+        values = { "log" : self.__log }
+        arguments["ssh_program"] \
+            = self.__WriteFile("ssh", _fake_ssh % values, 0755)
+        arguments["scp_program"] \
+            = self.__WriteFile("scp", _fake_scp % values, 0755)
+        arguments.setdefault("host_name", "fake")
+        arguments["default_dir"] = self.__remote
+        host_class = get_extension_class("ssh_host.SSHHost", "host",
+                                         self.GetDatabase())
+        return host_class(arguments)
+
+
+    def __WriteFile(self, name, contents, mode = None):
+        """Write a file in the temporary directory.
+
+        'name' -- The basename of the file.
+
+        'contents' -- The contents of the file.
+
+        'mode' -- If not 'None', the mode of the file.
+
+        returns -- The path to the file."""
+
+        path = os.path.join(self.__directory, name)
+        f = open(path, "w")
+        try:
+            f.write(contents)
+        finally:
+            f.close()
+        if mode is not None:
+            os.chmod(path, mode)
+        return path
+
+
+    def __Count(self, word):
+        """Return the number of logged commands that mention 'word'.
+
+        'word' -- A string.
+
+        returns -- The number of commands recorded by the fake
+        programs that include 'word'."""
+
+        if not os.path.exists(self.__log):
+            return 0
+        return len([l for l in open(self.__log) if word in l.split()])